@@ -0,0 +1,221 @@
+"""
+Local stand-in for the parts of Pyrogram that bot.py touches.
+
+FakeMessage / FakeClient serve media from local files, so the real handlers
+in bot.py can be driven without a network or a bot token. Downloads, stream
+reads and uploads go through a Recorder, which is how the benchmark splits a
+merge into download / ffmpeg / upload time.
+"""
+
+import asyncio
+import itertools
+import mimetypes
+import os
+import shutil
+import time
+from types import SimpleNamespace
+
+from pyrogram import enums, raw
+from pyrogram.parser import Parser
+
+CHUNK = 1024 * 1024  # Telegram serves files in 1 MiB chunks
+
+_ids = itertools.count(1000)
+
+
+class Recorder:
+    """Accumulates wall time and bytes per stage ("download", "upload", ...)."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.wall = {}
+        self.bytes = {}
+        self.uploads = []
+        self.edits = 0
+        self.replies = []
+
+    def add(self, stage: str, seconds: float, nbytes: int = 0):
+        self.wall[stage] = self.wall.get(stage, 0.0) + seconds
+        self.bytes[stage] = self.bytes.get(stage, 0) + nbytes
+
+
+def media_for(path: str, kind: str, duration: float = 0.0):
+    """A Pyrogram-like media object describing a local file."""
+    mime = mimetypes.guess_type(path)[0] or ("video/mp4" if kind == "video" else "audio/mpeg")
+    size = os.path.getsize(path)
+    return SimpleNamespace(
+        file_unique_id=f"bench_{os.path.basename(path)}_{size}",
+        file_size=size,
+        mime_type=mime,
+        duration=int(duration),
+        _path=path,
+    )
+
+
+class FakeMessage:
+    def __init__(self, client, chat_id: int, user_id: int, text: str = None,
+                 path: str = None, kind: str = None, duration: float = 0.0,
+                 reply_to=None, media_group_id=None):
+        self._client = client
+        self.id = next(_ids)
+        self.chat = SimpleNamespace(id=chat_id, type=enums.ChatType.PRIVATE)
+        self.from_user = SimpleNamespace(id=user_id)
+        self.text = text
+        self.caption = None
+        self.reply_to_message = reply_to
+        self.media_group_id = media_group_id
+        self.video = self.audio = self.voice = self.document = self.photo = None
+        if path:
+            media = media_for(path, kind, duration)
+            if kind == "video":
+                self.video = media
+            else:
+                self.audio = media
+        client._messages[self.id] = self
+
+    def _media(self):
+        return self.video or self.audio or self.voice or self.document or self.photo
+
+    async def download(self, file_name: str = None, **_):
+        src = self._media()._path
+        rec = self._client.recorder
+        t0 = time.perf_counter()
+        await self._client._throttle(os.path.getsize(src))
+        await asyncio.get_running_loop().run_in_executor(None, shutil.copyfile, src, file_name)
+        rec.add("download", time.perf_counter() - t0, os.path.getsize(src))
+        return file_name
+
+    async def reply_text(self, text: str, **_):
+        self._client.recorder.replies.append(text)
+        return FakeMessage(self._client, self.chat.id, 0, text=text)
+
+    async def edit_text(self, text: str, **_):
+        self._client.recorder.edits += 1
+        self.text = text
+        return self
+
+    def _sent(self, kind: str, file_id: str):
+        """The message Telegram would return for a sent file."""
+        msg = FakeMessage(self._client, self.chat.id, 0)
+        setattr(msg, kind, SimpleNamespace(file_id=file_id))
+        return msg
+
+    async def _upload(self, path: str, kind: str):
+        rec = self._client.recorder
+        if not os.path.exists(path):
+            # a file_id: Telegram re-sends the stored file, nothing is uploaded
+            rec.uploads.append({"kind": kind, "bytes": 0, "file_id": path})
+            return self._sent(kind, path)
+        size = await self._client._transfer(path)
+        file_id = f"bench_file_{next(_ids)}"
+        rec.uploads.append({"kind": kind, "bytes": size, "file_id": file_id})
+        return self._sent(kind, file_id)
+
+    async def reply_video(self, video: str, **_):
+        return await self._upload(video, "video")
+
+    async def reply_audio(self, audio: str, **_):
+        return await self._upload(audio, "audio")
+
+    async def reply_document(self, document: str, **_):
+        return await self._upload(document, "document")
+
+    async def reply_photo(self, photo: str, **_):
+        return FakeMessage(self._client, self.chat.id, 0)
+
+
+class FakeClient:
+    """
+    Replaces bot.app. `bandwidth` (bytes/s, 0 = unlimited) simulates the
+    Telegram link so network-bound changes can be measured too.
+    """
+
+    def __init__(self, bandwidth: float = 0):
+        self.bandwidth = bandwidth
+        self.recorder = Recorder()
+        self._messages = {}
+        self._saved = {}  # save_file id -> bytes, until it is sent
+        self.parse_mode = enums.ParseMode.DEFAULT
+        self.parser = Parser(self)  # captions of SendMedia
+
+    async def _throttle(self, nbytes: int):
+        if self.bandwidth:
+            await asyncio.sleep(nbytes / self.bandwidth)
+
+    async def _transfer(self, path: str):
+        """Read a local file as an upload would; returns its size."""
+        t0 = time.perf_counter()
+        size = os.path.getsize(path)
+        await self._throttle(size)
+
+        def read_all():
+            with open(path, "rb") as f:
+                while f.read(CHUNK):
+                    pass
+        await asyncio.get_running_loop().run_in_executor(None, read_all)
+        self.recorder.add("upload", time.perf_counter() - t0, size)
+        return size
+
+    # ---- upload first, send later (bot.save_video / send_saved_video) ----
+    async def save_file(self, path, **_):
+        if path is None:
+            return None
+        if not isinstance(path, str):  # an in-memory thumbnail
+            return raw.types.InputFile(id=next(_ids), parts=1, name="thumb.jpg", md5_checksum="")
+        size = await self._transfer(path)
+        file = raw.types.InputFile(id=next(_ids), parts=1, name=os.path.basename(path), md5_checksum="")
+        self._saved[file.id] = size
+        return file
+
+    def guess_mime_type(self, filename: str):
+        return mimetypes.guess_type(filename)[0]
+
+    @staticmethod
+    def rnd_id():
+        return next(_ids)
+
+    async def resolve_peer(self, chat_id):
+        return raw.types.InputPeerUser(user_id=chat_id, access_hash=0)
+
+    async def invoke(self, query):
+        if not isinstance(query, raw.functions.messages.SendMedia):
+            raise NotImplementedError(type(query).__name__)
+        kind = "video" if query.media.mime_type.startswith("video") else "document"
+        file_id = f"bench_file_{next(_ids)}"
+        self.recorder.uploads.append({"kind": kind, "bytes": self._saved.pop(query.media.file.id), "file_id": file_id})
+        msg = FakeMessage(self, query.peer.user_id, 0)
+        setattr(msg, kind, SimpleNamespace(file_id=file_id))
+        update = raw.types.UpdateNewMessage(message=raw.types.MessageEmpty(id=msg.id), pts=0, pts_count=0)
+        return SimpleNamespace(updates=[update], users=[], chats=[])
+
+    async def get_messages(self, chat_id, message_ids):
+        if isinstance(message_ids, (list, tuple)):
+            return [self._messages[i] for i in message_ids]
+        return self._messages[message_ids]
+
+    async def get_media_group(self, chat_id, message_id):
+        group = self._messages[message_id].media_group_id
+        return [m for m in self._messages.values() if group and m.media_group_id == group]
+
+    async def send_message(self, chat_id, text, **_):
+        self.recorder.replies.append(text)
+        return FakeMessage(self, chat_id, 0, text=text)
+
+    async def stream_media(self, message, limit: int = 0, offset: int = 0):
+        src = message._media()._path
+        t0 = time.perf_counter()
+        sent = 0
+        with open(src, "rb") as f:
+            f.seek(offset * CHUNK)
+            n = 0
+            while not limit or n < limit:
+                chunk = f.read(CHUNK)
+                if not chunk:
+                    break
+                await self._throttle(len(chunk))
+                sent += len(chunk)
+                n += 1
+                yield chunk
+        self.recorder.add("download", time.perf_counter() - t0, sent)
@@ -0,0 +1,355 @@
+"""
+Offline benchmark for the merge pipelines (/merge_vv, /merge_aa, /merge_va).
+
+Synthetic inputs are generated with ffmpeg's lavfi sources (testsrc + sine),
+then the real handlers in bot.py are driven through bench/fake_telegram.py.
+Each case runs in its own subprocess (fresh data/ dir, clean rusage) and
+reports per stage (download / probe / ffmpeg / upload):
+
+    wall seconds, CPU seconds, bytes moved, peak data/tmp bytes
+
+plus peak RSS of the bot process and of its ffmpeg children.
+
+Usage:
+    python bench/run_bench.py                          # default matrix
+    python bench/run_bench.py --flows vv,vv_mixed --sizes 1280x720 --durations 30,120 --out new.json
+    python bench/run_bench.py --compare base.json new.json
+
+Needs ffmpeg/ffprobe on PATH and the bot's requirements installed; no
+Telegram credentials or network are used.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+FLOWS = ("vv", "vv_mixed", "aa", "va")
+DEFAULT_SIZES = "640x360,1280x720"
+DEFAULT_DURATIONS = "10,60"
+
+
+# ---------- input generation ----------
+def gen_video(path: str, size: str, duration: int, rate: int = 30):
+    if os.path.exists(path):
+        return path
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error",
+         "-f", "lavfi", "-i", f"testsrc=size={size}:rate={rate}:duration={duration}",
+         "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={duration}",
+         "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+         "-c:a", "aac", "-shortest", "-movflags", "+faststart", path],
+        check=True,
+    )
+    return path
+
+
+def gen_audio(path: str, duration: int, freq: int = 440):
+    if os.path.exists(path):
+        return path
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error",
+         "-f", "lavfi", "-i", f"sine=frequency={freq}:sample_rate=44100:duration={duration}",
+         "-c:a", "libmp3lame", "-q:a", "4", path],
+        check=True,
+    )
+    return path
+
+
+def case_inputs(inputs_dir: str, flow: str, size: str, duration: int):
+    """(first path, first kind, second path, second kind) for a case."""
+    if flow == "vv":
+        v = gen_video(os.path.join(inputs_dir, f"v_{size}_{duration}.mp4"), size, duration)
+        return v, "video", v, "video"
+    if flow == "vv_mixed":
+        # second clip at another frame rate forces the re-encode path
+        a = gen_video(os.path.join(inputs_dir, f"v_{size}_{duration}.mp4"), size, duration)
+        b = gen_video(os.path.join(inputs_dir, f"v_{size}_{duration}_25fps.mp4"), size, duration, rate=25)
+        return a, "video", b, "video"
+    if flow == "aa":
+        a = gen_audio(os.path.join(inputs_dir, f"a_{duration}.mp3"), duration)
+        b = gen_audio(os.path.join(inputs_dir, f"a_{duration}_660.mp3"), duration, freq=660)
+        return a, "audio", b, "audio"
+    if flow == "va":
+        v = gen_video(os.path.join(inputs_dir, f"v_{size}_{duration}.mp4"), size, duration)
+        a = gen_audio(os.path.join(inputs_dir, f"a_{duration}_660.mp3"), duration, freq=660)
+        return v, "video", a, "audio"
+    raise SystemExit(f"unknown flow {flow}")
+
+
+# ---------- one case (runs in a subprocess) ----------
+class StageMeter:
+    """Wall / CPU / peak-tmp accounting for overlapping stages."""
+
+    def __init__(self, tmp_dir: str):
+        self.tmp_dir = tmp_dir
+        self.active = collections.Counter()
+        self.stats = collections.defaultdict(lambda: {"wall": 0.0, "cpu": 0.0, "bytes": 0, "peak_tmp_bytes": 0, "calls": 0})
+        self.peak_tmp = 0
+
+    def tmp_bytes(self):
+        total = 0
+        try:
+            with os.scandir(self.tmp_dir) as it:
+                for e in it:
+                    try:
+                        if e.is_file(follow_symlinks=False):
+                            total += e.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return total
+
+    async def sample(self, every: float = 0.05):
+        while True:
+            now = self.tmp_bytes()
+            self.peak_tmp = max(self.peak_tmp, now)
+            for name, n in self.active.items():
+                if n > 0:
+                    st = self.stats[name]
+                    st["peak_tmp_bytes"] = max(st["peak_tmp_bytes"], now)
+            await asyncio.sleep(every)
+
+    def wrap(self, name: str, func, children: bool):
+        """Wrap an async function so its calls are accounted to stage `name`."""
+        who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+
+        async def wrapper(*args, **kwargs):
+            self.active[name] += 1
+            r0, t0 = resource.getrusage(who), time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                r1 = resource.getrusage(who)
+                st = self.stats[name]
+                st["wall"] += time.perf_counter() - t0
+                st["cpu"] += (r1.ru_utime - r0.ru_utime) + (r1.ru_stime - r0.ru_stime)
+                st["calls"] += 1
+                self.active[name] -= 1
+        return wrapper
+
+
+async def run_case(flow: str, first: str, first_kind: str, second: str, second_kind: str, bandwidth: float):
+    import bot
+    from fake_telegram import FakeClient, FakeMessage
+
+    client = FakeClient(bandwidth=bandwidth)
+    bot.app = client
+    meter = StageMeter(bot.TMP_DIR)
+
+    # stage hooks: ffmpeg/ffprobe are child processes, download/upload run in this process
+    bot.run_cmd = meter.wrap("ffmpeg", bot.run_cmd, children=True)
+    bot.probe_input = meter.wrap("probe", bot.probe_input, children=True)
+    FakeMessage.download = meter.wrap("download", FakeMessage.download, children=False)
+    FakeMessage._upload = meter.wrap("upload", FakeMessage._upload, children=False)
+    client.stream_media = _wrap_agen(meter, "download", client.stream_media)
+
+    command = {"vv": "/merge_vv", "vv_mixed": "/merge_vv", "aa": "/merge_aa", "va": "/merge_va"}[flow]
+    start_handler = {"vv": bot.merge_vv_start, "vv_mixed": bot.merge_vv_start,
+                     "aa": bot.merge_aa_start, "va": bot.merge_va_start}[flow]
+    chat = user = 4242
+    sampler = asyncio.create_task(meter.sample())
+    t0 = time.perf_counter()
+    r0_self, r0_child = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    m1 = FakeMessage(client, chat, user, path=first, kind=first_kind, duration=_duration(first))
+    cmd = FakeMessage(client, chat, user, text=command, reply_to=m1)
+    await start_handler(client, cmd)
+    m2 = FakeMessage(client, chat, user, path=second, kind=second_kind, duration=_duration(second))
+    await bot.second_media_handler(client, m2)
+    total = time.perf_counter() - t0
+    r1_self, r1_child = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    sampler.cancel()
+
+    for name in ("download", "upload"):
+        meter.stats[name]["bytes"] = client.recorder.bytes.get(name, 0)
+    uploads = client.recorder.uploads
+    return {
+        "ok": bool(uploads),
+        "total_wall": total,
+        "total_cpu": (r1_self.ru_utime - r0_self.ru_utime) + (r1_self.ru_stime - r0_self.ru_stime)
+                     + (r1_child.ru_utime - r0_child.ru_utime) + (r1_child.ru_stime - r0_child.ru_stime),
+        "stages": dict(meter.stats),
+        "peak_tmp_bytes": meter.peak_tmp,
+        # ru_maxrss is KiB on Linux; children = largest ffmpeg/ffprobe of this case
+        "peak_rss_kb": {"bot": r1_self.ru_maxrss, "ffmpeg": r1_child.ru_maxrss},
+        "output_bytes": sum(u["bytes"] for u in uploads),
+        "output_parts": len(uploads),
+        "replies": client.recorder.replies[-3:],
+    }
+
+
+def _wrap_agen(meter, name, agen_func):
+    def wrapper(*args, **kwargs):
+        async def gen():
+            meter.active[name] += 1
+            t0 = time.perf_counter()
+            try:
+                async for chunk in agen_func(*args, **kwargs):
+                    yield chunk
+            finally:
+                # streamed inputs overlap with ffmpeg; wall here is time-to-last-chunk
+                meter.stats[name]["wall"] += time.perf_counter() - t0
+                meter.stats[name]["calls"] += 1
+                meter.active[name] -= 1
+        return gen()
+    return wrapper
+
+
+def _duration(path: str):
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+        capture_output=True, text=True,
+    ).stdout.strip()
+    try:
+        return float(out)
+    except ValueError:
+        return 0.0
+
+
+def one(args):
+    """Entry point of the per-case subprocess: prints one JSON line."""
+    flow, size, duration = args.one.split(":")
+    first, fk, second, sk = case_inputs(args.inputs, flow, size, int(duration))
+    case_dir = tempfile.mkdtemp(prefix=f"case_{flow}_", dir=args.workdir)
+    os.chdir(case_dir)  # bot.py keeps data/ relative to the cwd
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "bench")
+    os.environ.setdefault("BOT_TOKEN", "1:bench")
+    if not args.cache:
+        os.environ["CACHE_MAX_BYTES"] = "0"
+    result = asyncio.run(run_case(flow, first, fk, second, sk, args.bandwidth * 1024 * 1024))
+    result.update({"case": args.one, "flow": flow, "size": size, "duration": int(duration)})
+    print(json.dumps(result))
+
+
+# ---------- driver ----------
+def git_rev():
+    try:
+        return subprocess.run(["git", "-C", REPO, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run_matrix(args):
+    os.makedirs(args.inputs, exist_ok=True)
+    results = []
+    cases = [
+        f"{flow}:{size}:{dur}"
+        for flow in args.flows.split(",")
+        for size in (args.sizes.split(",") if flow != "aa" else ["-"])
+        for dur in args.durations.split(",")
+    ]
+    for case in cases:
+        for rep in range(args.repeat):
+            cmd = [sys.executable, os.path.abspath(__file__), "--one", case,
+                   "--inputs", args.inputs, "--workdir", args.workdir,
+                   "--bandwidth", str(args.bandwidth)] + (["--cache"] if args.cache else [])
+            proc = subprocess.run(cmd, capture_output=True, text=True)
+            lines = [l for l in proc.stdout.splitlines() if l.startswith("{")]
+            if proc.returncode != 0 or not lines:
+                print(f"{case} #{rep}: FAILED\n{proc.stderr[-2000:]}", file=sys.stderr)
+                results.append({"case": case, "repeat": rep, "ok": False})
+                continue
+            res = json.loads(lines[-1])
+            res["repeat"] = rep
+            results.append(res)
+            print_row(res)
+    report = {
+        "meta": {
+            "rev": git_rev(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "bandwidth_mib_s": args.bandwidth,
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote {args.out}")
+    return report
+
+
+def print_row(res):
+    st = res.get("stages", {})
+
+    def cell(name):
+        s = st.get(name)
+        return f"{s['wall']:7.2f}s/{s['cpu']:6.2f}c" if s else " " * 16
+
+    print(
+        f"{res['case']:<22} {'ok ' if res['ok'] else 'ERR'} total {res['total_wall']:7.2f}s "
+        f"dl {cell('download')} probe {cell('probe')} ffmpeg {cell('ffmpeg')} up {cell('upload')} "
+        f"tmp {res['peak_tmp_bytes'] / 1e6:7.1f}MB rss {res['peak_rss_kb']['ffmpeg'] / 1024:6.1f}MB"
+    )
+
+
+def compare(base_path: str, new_path: str):
+    """Print per-case wall/CPU change between two result files (mean over repeats)."""
+    def load(path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        agg = collections.defaultdict(list)
+        for r in data["results"]:
+            if r.get("ok"):
+                agg[r["case"]].append(r)
+        return data["meta"], {
+            k: {"wall": sum(r["total_wall"] for r in v) / len(v), "cpu": sum(r["total_cpu"] for r in v) / len(v)}
+            for k, v in agg.items()
+        }
+    mb, base = load(base_path)
+    mn, new = load(new_path)
+    print(f"base {mb.get('rev')} ({mb.get('time')})  vs  new {mn.get('rev')} ({mn.get('time')})")
+    for case in sorted(set(base) | set(new)):
+        b, n = base.get(case), new.get(case)
+        if not b or not n:
+            print(f"{case:<22} only in {'base' if b else 'new'}")
+            continue
+        dw = (n["wall"] - b["wall"]) / b["wall"] * 100 if b["wall"] else 0
+        dc = (n["cpu"] - b["cpu"]) / b["cpu"] * 100 if b["cpu"] else 0
+        print(f"{case:<22} wall {b['wall']:7.2f}s -> {n['wall']:7.2f}s ({dw:+6.1f}%)   "
+              f"cpu {b['cpu']:7.2f}s -> {n['cpu']:7.2f}s ({dc:+6.1f}%)")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--flows", default=",".join(FLOWS), help=f"comma list of {FLOWS}")
+    ap.add_argument("--sizes", default=DEFAULT_SIZES, help="comma list of WxH")
+    ap.add_argument("--durations", default=DEFAULT_DURATIONS, help="comma list of seconds")
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--bandwidth", type=float, default=0, help="simulated Telegram MiB/s (0 = unlimited)")
+    ap.add_argument("--cache", action="store_true", help="keep the download cache enabled")
+    ap.add_argument("--inputs", default=os.path.join(tempfile.gettempdir(), "merge_bench_inputs"))
+    ap.add_argument("--workdir", default=None)
+    ap.add_argument("--out", help="write machine-readable results (json) here")
+    ap.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"))
+    ap.add_argument("--one", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.one:
+        one(args)
+        return
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix="merge_bench_")
+    run_matrix(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ Features included:
     /merge_vv  -> video + video (concatenate sequentially)
     /merge_aa  -> audio + audio (mix using amix)
     /merge_va  -> video + audio (replace video's audio with provided audio)
+    /merge_many -> any number of clips / albums, merged in one ffmpeg run on /done
 Usage:
 - Reply to the FIRST media with the merge command (e.g. reply to first video with /merge_vv).
 - Bot will ask you to send the SECOND media (same chat, from same user).
@@ -18,30 +19,124 @@ Usage:
 
 import os
 import asyncio
-import shlex
 import json
 import logging
 import uuid
 import time
 import shutil
+import hashlib
+import io
+import signal
+import socket
+import sys
+import collections
+import functools
 
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle, enums, raw, utils as pyro_utils
+from pyrogram.errors import FilePartMissing
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
 
+from utils import ffmpeg_tools, streaming, downloader
+from utils.scheduler import JobScheduler, JobHandle, PRIORITY_PRO, PRIORITY_FREE, PRIORITY_BATCH
+from utils.admission import Admission
+from utils.progress import ProgressReporter, CombinedProgress
+from utils.cache import MediaCache
+from utils.sessions import SessionStore
+from utils.tmpspace import TempSpaceManager, TempSpaceError
+from utils.metrics import Metrics
+from utils.broker import JobBroker, ProgressRelay
+from utils.settings import SettingsStore, THUMB_MAX_BYTES, THUMB_MAX_SIDE
+from utils.results import ResultCache, result_key
+from utils.api import MergeApi, ApiJob
+
 # ---------- CONFIG ----------
 API_ID = int(os.environ.get("API_ID", "0"))
 API_HASH = os.environ.get("API_HASH", "")
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 OWNER_ID = int(os.environ.get("OWNER_ID", "0")) if os.environ.get("OWNER_ID") else None
+# comma separated user ids on the Pro plan (faster queue)
+PRO_USERS = {int(x) for x in os.environ.get("PRO_USERS", "").replace(" ", "").split(",") if x}
+if OWNER_ID:
+    PRO_USERS.add(OWNER_ID)
 
 if not (API_ID and API_HASH and BOT_TOKEN):
     raise SystemExit("Please set API_ID, API_HASH and BOT_TOKEN environment variables.")
+# feed sequentially-readable inputs to ffmpeg through FIFOs instead of temp files
+STREAM_INPUTS = os.environ.get("STREAM_INPUTS", "1") != "0"
+# inputs streamed at once across all runs (each holds a pyrogram transmission
+# slot for its whole stream); a run with more streamable inputs downloads the rest
+STREAM_MAX_INPUTS = 4
 
 SESSION_NAME = "hassan_merge_bot"
 DATA_DIR = "data"
-THUMB_PATH = os.path.join(DATA_DIR, "thumb.jpg")
-META_PATH = os.path.join(DATA_DIR, "meta.json")
+THUMB_PATH = os.path.join(DATA_DIR, "thumb.jpg")  # old global thumbnail, migrated to OWNER_ID on start
+META_PATH = os.path.join(DATA_DIR, "meta.json")  # old global metadata, same
+THUMBS_DIR = os.path.join(DATA_DIR, "thumbs")
+SETTINGS_DB = os.environ.get("SETTINGS_DB", os.path.join(DATA_DIR, "settings.db"))
 TMP_DIR = os.path.join(DATA_DIR, "tmp")
+CACHE_DIR = os.path.join(DATA_DIR, "cache")
+# point this at persistent storage to keep pending sessions across dyno restarts
+SESSION_DB = os.environ.get("SESSION_DB", os.path.join(DATA_DIR, "sessions.db"))
+SESSION_SWEEP_INTERVAL = 60
+# data/tmp budget: jobs wait (then get refused) instead of filling the disk
+TMP_QUOTA_BYTES = int(os.environ.get("TMP_QUOTA_BYTES", str(4 * 1024 * 1024 * 1024)))
+TMP_MIN_FREE_BYTES = int(os.environ.get("TMP_MIN_FREE_BYTES", str(256 * 1024 * 1024)))
+TMP_MAX_AGE = 60 * 60  # unreferenced tmp files older than this are removed
+TMP_SWEEP_INTERVAL = 60
+# byte budget of the file_unique_id download cache, 0 disables it
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# already-sent results (Telegram file_ids) by action + inputs + thumbnail; 0 disables
+RESULT_CACHE_DB = os.environ.get("RESULT_CACHE_DB", os.path.join(DATA_DIR, "results.db"))
+RESULT_CACHE_MAX = int(os.environ.get("RESULT_CACHE_MAX", "5000"))
+RESULT_CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Telegram's upload limit; bigger results are bitrate-capped or sent in parts
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(2000 * 1024 * 1024)))
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", "3"))
+
+# per-user limits (utils/admission.py): merges queued or running at once, and
+# estimated cpu-seconds per hour (Pro users get PRO_BUDGET_FACTOR times that); 0 = no limit
+USER_MAX_JOBS = int(os.environ.get("USER_MAX_JOBS", "2"))
+USER_CPU_BUDGET = float(os.environ.get("USER_CPU_BUDGET", "1800"))
+USER_BUDGET_WINDOW = 3600
+PRO_BUDGET_FACTOR = 4
+
+# inputs at least PARALLEL_DOWNLOAD_MIN_BYTES big are fetched as byte ranges
+# over this many connections at once (utils/downloader.py); 1 = plain msg.download()
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "4"))
+PARALLEL_DOWNLOAD_MIN_BYTES = int(os.environ.get("PARALLEL_DOWNLOAD_MIN_BYTES", str(20 * 1024 * 1024)))
+
+# long re-encodes are cut at keyframes and encoded by up to this many ffmpeg
+# processes at once (shared by all jobs), then stitched with stream copy; 1 turns it off
+PARALLEL_ENCODE_JOBS = int(os.environ.get("PARALLEL_ENCODE_JOBS", str(os.cpu_count() or 1)))
+PARALLEL_MIN_SECONDS = int(os.environ.get("PARALLEL_MIN_SECONDS", "120"))
+
+# /merge_vv sends a low-res preview of the join first and renders only once
+# the user confirms; always with PREVIEW_MERGES=1, else with /merge_vv preview
+PREVIEW_MERGES = os.environ.get("PREVIEW_MERGES", "0") == "1"
+
+# worker mode: ffmpeg steps go through a SQLite broker to `python3 bot.py worker`
+# processes (same data/ dir) instead of running in this process
+USE_WORKERS = os.environ.get("USE_WORKERS", "0") == "1"
+BROKER_DB = os.environ.get("BROKER_DB", os.path.join("data", "jobs.db"))
+BROKER_LEASE = 60  # seconds a claimed job stays with a worker without a heartbeat
+BROKER_POLL = 1.0
+
+# /metrics endpoint (Prometheus text format); METRICS_PORT=0 turns it off
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+
+# HTTP batch API (utils/api.py) for scripts; API_PORT=0 (default) turns it off,
+# API_TOKEN is required. Local input paths are only read under API_INPUT_DIRS,
+# uploads (multipart) are capped at API_MAX_UPLOAD_BYTES per request.
+API_HOST = os.environ.get("API_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("API_PORT", "0"))
+API_TOKEN = os.environ.get("API_TOKEN", "")
+API_INPUT_DIRS = [d.strip() for d in os.environ.get("API_INPUT_DIRS", "").split(",") if d.strip()]
+API_RESULT_DIR = os.path.join(DATA_DIR, "api")
+API_RESULT_TTL = int(os.environ.get("API_RESULT_TTL", str(24 * 3600)))
+API_MAX_UPLOAD_BYTES = int(os.environ.get("API_MAX_UPLOAD_BYTES", str(4 * 1024 ** 3)))
 
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(TMP_DIR, exist_ok=True)
@@ -54,70 +149,1021 @@ logging.basicConfig(
 log = logging.getLogger(__name__)
 
 # ---------- pyrogram client ----------
-app = Client(SESSION_NAME, api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# pyrogram allows one file transfer at a time unless told otherwise. Downloads
+# and streamed inputs share one semaphore of this size (uploads have their own):
+# STREAM_MAX_INPUTS slots for the feeds stream_budget hands out, plus a full
+# set of ranged-download connections, so a download running next to a fully
+# streamed merge doesn't have to wait for its feeds (or they for it)
+TRANSFER_SLOTS = STREAM_MAX_INPUTS + max(DOWNLOAD_CONNECTIONS, UPLOAD_CONCURRENCY)
+app = Client(
+    SESSION_NAME, api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN,
+    max_concurrent_transmissions=TRANSFER_SLOTS,
+)
+
+# ---------- per-chat state ----------
+# SQLite-backed with per-action TTLs (utils/sessions.py); survives restarts.
+pending = SessionStore(SESSION_DB)  # chat_id -> { "action": str, "owner": user_id, "first_file": path, "first_msg": msg id, "first_uid": file_unique_id, "first_type": "video"/"audio", "ts": timestamp }
+
+# ---------- per-user settings ----------
+# title / caption / thumbnail per user, cached in memory (utils/settings.py)
+settings = SettingsStore(SETTINGS_DB, THUMBS_DIR)
+
+# ---------- download cache ----------
+# repeat inputs (same file_unique_id) skip both the download and the ffprobe
+media_cache = MediaCache(CACHE_DIR, CACHE_MAX_BYTES)
+
+# ---------- result cache ----------
+# the same forwarded pair merged again is answered with the file we already sent
+result_cache = ResultCache(RESULT_CACHE_DB, RESULT_CACHE_MAX, RESULT_CACHE_MAX_AGE)
+
+# ---------- ffmpeg job queue ----------
+# at most FFMPEG_SLOTS (default: cpu count) ffmpeg jobs run at once, Pro users go
+# first, cheap jobs before expensive ones, USER_MAX_RUNNING (default 1) per user
+scheduler = JobScheduler()
+admission = Admission(USER_MAX_JOBS, USER_CPU_BUDGET, USER_BUDGET_WINDOW)
+job_files = collections.Counter()  # tmp paths used by queued/running jobs
+running_jobs = {}  # chat_id -> set of JobHandle, for /cancel
+stream_budget = streaming.StreamBudget(STREAM_MAX_INPUTS)
+# ffmpeg processes of parallel encodes (transcode_parallel), across all jobs
+encode_pool = asyncio.Semaphore(max(1, PARALLEL_ENCODE_JOBS))
+job_broker = JobBroker(BROKER_DB) if USE_WORKERS else None
+
+# ---------- temp space ----------
+def files_in_use():
+    """tmp paths the cleanup must not touch: pending sessions' files and job files."""
+    paths = set(job_files) | merge_api.files_in_use()
+    for p in list(job_files):
+        # numbered parts written for a job file (the segment muxer, split_output) are the job's too
+        paths.update(ffmpeg_tools.part_files(p))
+    for _, state in pending.items():
+        paths.update(state_files(state))
+    return paths
+
+tmp_space = TempSpaceManager(TMP_DIR, TMP_QUOTA_BYTES, TMP_MIN_FREE_BYTES, TMP_MAX_AGE, in_use=files_in_use)
+
+# ---------- metrics ----------
+# per-stage histograms: queue, download, probe, ffmpeg, upload
+metrics = Metrics()
+running_procs = collections.Counter()  # tool name ("ffmpeg") -> live subprocesses
 
-# ---------- in-memory per-chat state ----------
-# persistent production system should use DB; this is simple and ephemeral.
-pending = {}  # chat_id -> { "action": str, "owner": user_id, "first_file": path, "first_type": "video"/"audio", "ts": timestamp }
+metrics.gauge("queue_depth", "Jobs waiting for an ffmpeg slot.", lambda: scheduler.queue_depth())
+metrics.gauge("jobs_running", "Jobs holding an ffmpeg slot.", lambda: scheduler.active())
+metrics.gauge("jobs_refused", "Jobs refused over a user's job or cpu budget.", lambda: admission.refused)
+metrics.gauge("ffmpeg_processes", "Running ffmpeg processes.", lambda: running_procs["ffmpeg"])
+metrics.gauge("tmp_used_bytes", "Bytes in data/tmp at the last scan.", lambda: tmp_space.used)
+metrics.gauge("tmp_reserved_bytes", "Bytes of data/tmp reserved by in-flight work.", lambda: tmp_space.reserved)
+metrics.gauge("pending_sessions", "Chats waiting for their next file.", lambda: len(pending))
+metrics.gauge("cache_bytes", "Bytes in the download cache.", lambda: media_cache.total_bytes())
+if job_broker is not None:
+    metrics.gauge("broker_queued", "Jobs waiting for a worker.", lambda: job_broker.counts().get("queued", 0))
+    metrics.gauge("broker_leased", "Jobs running on workers.", lambda: job_broker.counts().get("leased", 0))
 
 # ---------- Helpers ----------
-async def run_cmd(cmd: str, cwd: str = None, timeout: int = 600):
+STDERR_TAIL_LINES = 40  # how much of ffmpeg's log is kept for error replies
+
+async def _read_lines(stream, on_line):
+    """Read a pipe in chunks and call on_line per line (LF or CR terminated, no readline size limit)."""
+    buf = b""
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        buf += chunk.replace(b"\r", b"\n")
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            if line:
+                await on_line(line[-4096:].decode(errors="ignore"))
+        if len(buf) > 65536:
+            buf = buf[-4096:]
+    if buf:
+        await on_line(buf[-4096:].decode(errors="ignore"))
+
+async def run_cmd(cmd: str, cwd: str = None, timeout: int = 600, progress=None):
     """
     Run shell command asynchronously and return (returncode, stdout, stderr).
+    Output is read incrementally and only the last STDERR_TAIL_LINES lines of
+    each stream are kept. For ffmpeg commands with a ProgressReporter,
+    `-progress pipe:1` is added and its output drives the reporter.
+    Runtime goes into the metrics histogram named after the tool ("ffmpeg").
+    The command runs in its own process group; on timeout or when the
+    calling task is cancelled (JobHandle.cancel) the whole group is killed.
+    Pass ffmpeg_tools.job_timeout() for media work, the default is for unknown lengths.
     """
+    tool = cmd.split(" ", 1)[0]
+    running_procs[tool] += 1
+    try:
+        with metrics.timer(tool):
+            return await _run_cmd(cmd, cwd, timeout, progress)
+    finally:
+        running_procs[tool] -= 1
+
+async def _run_cmd(cmd: str, cwd: str, timeout: int, progress):
+    if cmd.startswith("ffmpeg "):
+        extra = "-nostats -progress pipe:1 " if progress is not None else "-nostats "
+        cmd = "ffmpeg " + extra + cmd[len("ffmpeg "):]
     log.info("Run cmd: %s", cmd)
+    out_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+    err_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+
+    async def on_out(line):
+        if progress is not None and await progress.feed_line(line):
+            return
+        out_tail.append(line)
+
+    async def on_err(line):
+        err_tail.append(line)
+
     try:
         proc = await asyncio.create_subprocess_shell(
             cmd,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
-            cwd=cwd
+            cwd=cwd,
+            start_new_session=True,
         )
+        pumps = asyncio.gather(_read_lines(proc.stdout, on_out), _read_lines(proc.stderr, on_err), proc.wait())
+        # on timeout / cancel nobody awaits pumps again; don't let it log "exception never retrieved"
+        pumps.add_done_callback(lambda f: f.cancelled() or f.exception())
         try:
-            out, err = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+            await asyncio.wait_for(pumps, timeout=timeout)
         except asyncio.TimeoutError:
-            proc.kill()
-            return -1, "", "Timeout"
-        return proc.returncode, out.decode(errors="ignore"), err.decode(errors="ignore")
+            kill_group(proc)
+            await proc.wait()
+            log.warning("timed out after %ss: %s", timeout, cmd)
+            return -1, "", f"Timeout ({timeout}s)"
+        except asyncio.CancelledError:
+            kill_group(proc)
+            await proc.wait()
+            log.info("cancelled: %s", cmd)
+            raise
+        return proc.returncode, "\n".join(out_tail), "\n".join(err_tail)
     except Exception as e:
         return -1, "", str(e)
 
-def clean_tmp(folder=TMP_DIR):
-    """Remove all files in tmp folder older than some threshold (safety)."""
-    now = time.time()
-    for fname in os.listdir(folder):
-        fpath = os.path.join(folder, fname)
+def kill_group(proc):
+    """SIGKILL the process group run_cmd started proc in (the shell and ffmpeg under it)."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def remove_files(*paths):
+    """Best-effort delete of temp files."""
+    for p in paths:
         try:
-            if os.path.isfile(fpath) and (now - os.path.getmtime(fpath) > 60*60):  # 1 hour
-                os.remove(fpath)
+            if p and os.path.exists(p):
+                os.remove(p)
         except Exception:
             pass
 
+async def merge_videos(paths: list, out: str, progress=None):
+    """
+    Join videos in order into out. Probes the inputs first and uses the concat
+    demuxer with stream copy when possible; only falls back to a full
+    filter_complex re-encode when the video streams don't match.
+    When the result is predicted to exceed MAX_UPLOAD_BYTES it is written as
+    numbered parts (see has_result / ffmpeg_tools.part_files) or, for a
+    re-encode, capped to a bitrate that fits.
+    Returns (returncode, stdout, stderr) like run_cmd.
+    """
+    infos = [await probe_input(p) for p in paths]
+    duration = sum(i["duration"] for i in infos if i)
+    if progress is not None:
+        progress.set_total(duration)
+    plan = ffmpeg_tools.plan_concat(infos)
+    log.info("Concat plan: %s (%s)", plan["mode"], plan["reason"])
+    sizes = [files_size([p]) for p in paths]
+    # concat filter needs equal frame sizes / rates; use the first clip's
+    frame, fps = ffmpeg_tools.output_frame(infos)
+    if plan["mode"] != "transcode":
+        fit = ffmpeg_tools.plan_output(infos, sizes, plan["mode"], MAX_UPLOAD_BYTES)
+        log.info("Output plan: %s (predicted %d bytes)", fit["reason"], fit["predicted"])
+        parts = list(paths)
+        if plan["mode"] == "copy_video":
+            # re-encode only the audio so every input shares the same audio params
+            parts = [tmp_path("norm", "mp4") for _ in paths]
+        list_path = tmp_path("concat", "txt")
+        temps = [p for p in parts if p not in paths] + [list_path]
+        job_files.update(temps)
+        code, outp, err = 0, "", ""
+        try:
+            if plan["mode"] == "copy_video":
+                for p, fixed, info in zip(paths, parts, infos):
+                    code, outp, err = await run_cmd(
+                        ffmpeg_tools.normalize_audio_cmd(p, fixed), timeout=ffmpeg_tools.job_timeout(info["duration"], "audio"),
+                    )
+                    if code != 0:
+                        break
+            if code == 0:
+                ffmpeg_tools.write_concat_list(parts, list_path)
+                code, outp, err = await run_cmd(
+                    ffmpeg_tools.concat_copy_cmd(list_path, out, fit["segment_marks"]), progress=progress,
+                    timeout=ffmpeg_tools.job_timeout(duration, "copy"),
+                )
+        finally:
+            remove_files(*temps)
+            job_files.subtract(temps)
+            for f in temps:
+                if job_files[f] <= 0:
+                    del job_files[f]
+        if code == 0 and has_result(out):
+            return code, outp, err
+        remove_files(out, *ffmpeg_tools.part_files(out))
+        log.warning("stream copy concat failed, re-encoding: %s", (err or "")[-500:])
+    fit = ffmpeg_tools.plan_output(infos, sizes, "transcode", MAX_UPLOAD_BYTES, frame, fps)
+    log.info("Output plan: %s (predicted %d bytes)", fit["reason"], fit["predicted"])
+    if PARALLEL_ENCODE_JOBS > 1 and frame and duration >= PARALLEL_MIN_SECONDS and all(i and i["audio"] for i in infos):
+        code, outp, err = await transcode_parallel(paths, infos, out, frame, fps, fit, progress)
+        if code == 0 and has_result(out):
+            return code, outp, err
+        remove_files(out, *ffmpeg_tools.part_files(out))
+        log.warning("parallel encode failed, using a single ffmpeg: %s", (err or "")[-500:])
+    return await run_cmd(
+        ffmpeg_tools.concat_transcode_cmd(
+            paths, out, size=frame, fps=fps, video_bitrate=fit["video_bitrate"], segment_marks=fit["segment_marks"],
+        ),
+        progress=progress,
+        timeout=ffmpeg_tools.job_timeout(duration, "transcode"),
+    )
+
+async def transcode_parallel(paths: list, infos: list, out: str, frame: tuple, fps: float, fit: dict, progress=None):
+    """
+    merge_videos' re-encode spread over the cores: every input is cut into
+    keyframe-aligned ranges (ffmpeg_tools.plan_segments) whose video is
+    encoded by up to PARALLEL_ENCODE_JOBS ffmpeg processes at once, the audio
+    is encoded in a single pass next to them, and the pieces are joined with
+    stream copy. No process handles more than SEGMENT_MAX_SECONDS of video,
+    so long merges stay well inside run_cmd's timeout.
+    Returns (returncode, stdout, stderr) like run_cmd.
+    """
+    indexes = [await ffmpeg_tools.keyframe_index(p) for p in paths]
+    if any(ix is None for ix in indexes):
+        return -1, "", "Could not read the inputs' keyframes."
+    duration = sum(i["duration"] for i in infos)
+    target = ffmpeg_tools.segment_length(duration, PARALLEL_ENCODE_JOBS)
+    ranges = []  # (path, start, frames, seconds)
+    for p, info, ix in zip(paths, infos, indexes):
+        for start, frames in ffmpeg_tools.plan_segments(ix, target):
+            in_fps = info["video"].get("fps")
+            ranges.append((p, start, frames, frames / in_fps if frames and in_fps else ix["duration"] - start))
+    log.info("Parallel encode: %d ranges of ~%.0fs, %d at a time", len(ranges), target, PARALLEL_ENCODE_JOBS)
+    combined = CombinedProgress(progress) if progress is not None else None
+    segs = [tmp_path("seg", "mp4") for _ in ranges]
+    audio = tmp_path("seg_audio", "m4a")
+    list_path = tmp_path("concat", "txt")
+    temps = segs + [audio, list_path]
+    job_files.update(temps)
+    # the pool already fills the cores, so each encoder gets its share of threads
+    threads = max(1, (os.cpu_count() or 1) // PARALLEL_ENCODE_JOBS)
+    keyframe_every = ffmpeg_tools.keyframe_spacing(fit["segment_marks"])
+    failed = []
+
+    async def pooled(cmd, timeout, part_progress=None):
+        async with encode_pool:
+            if failed:
+                return -1, "", "skipped"
+            res = await run_cmd(cmd, progress=part_progress, timeout=timeout)
+            if res[0] != 0:
+                failed.append(res)
+            return res
+
+    try:
+        await asyncio.gather(
+            pooled(
+                ffmpeg_tools.concat_audio_track_cmd(paths, [ix["duration"] for ix in indexes], audio),
+                ffmpeg_tools.job_timeout(duration, "audio"),
+            ),
+            *(
+                pooled(
+                    ffmpeg_tools.segment_encode_cmd(
+                        src, segs[i], start, frames, frame, fps, video_bitrate=fit["video_bitrate"],
+                        keyframe_every=keyframe_every, threads=threads,
+                    ),
+                    ffmpeg_tools.job_timeout(seconds, "transcode"),
+                    combined.part(i) if combined else None,
+                )
+                for i, (src, start, frames, seconds) in enumerate(ranges)
+            ),
+        )
+        if failed:
+            return failed[0]
+        ffmpeg_tools.write_concat_list(segs, list_path)
+        return await run_cmd(
+            ffmpeg_tools.concat_segments_cmd(list_path, audio, out, fit["segment_marks"]),
+            timeout=ffmpeg_tools.job_timeout(duration, "copy"),
+        )
+    finally:
+        remove_files(*temps)
+        job_files.subtract(temps)
+        for f in temps:
+            if job_files[f] <= 0:
+                del job_files[f]
+
+def has_result(out: str):
+    """True if a job wrote out, either whole or as numbered parts."""
+    return os.path.exists(out) or bool(ffmpeg_tools.part_files(out))
+
+async def concat_audio(paths: list, out: str, copy: bool, normalize: bool = False, progress=None):
+    """Audio tracks in order into out: stream copy when planned, else one re-encode (+ loudnorm)."""
+    duration = sum([await input_duration(p) for p in paths])
+    if progress is not None:
+        progress.set_total(duration)
+    if copy:
+        list_path = tmp_path("concat", "txt")
+        ffmpeg_tools.write_concat_list(paths, list_path)
+        code, outp, err = await run_cmd(
+            ffmpeg_tools.audio_concat_copy_cmd(list_path, out), progress=progress,
+            timeout=ffmpeg_tools.job_timeout(duration, "copy"),
+        )
+        remove_files(list_path)
+        if code == 0 and os.path.exists(out):
+            return code, outp, err
+        log.warning("audio stream copy concat failed, re-encoding: %s", (err or "")[-500:])
+    return await run_cmd(
+        ffmpeg_tools.audio_concat_cmd(paths, out, normalize), progress=progress,
+        timeout=ffmpeg_tools.job_timeout(duration, "audio"),
+    )
+
+async def replace_audio(video: str, audio: str, out: str, progress=None):
+    """Copy the video stream and swap in audio; the audio is copied too when mp4 can hold it."""
+    vinfo = await probe_input(video)
+    ainfo = await probe_input(audio)
+    duration = 0
+    if vinfo and ainfo:
+        # -shortest: output ends with the shorter input
+        duration = min(vinfo["duration"], ainfo["duration"]) or vinfo["duration"]
+    if progress is not None:
+        progress.set_total(duration)
+    plan = ffmpeg_tools.plan_replace_audio(vinfo, ainfo)
+    log.info("Replace-audio plan: copy=%s (%s)", plan["audio_copy"], plan["reason"])
+    timeout = ffmpeg_tools.job_timeout(duration, "audio")
+    code, outp, err = await run_cmd(
+        ffmpeg_tools.replace_audio_cmd(video, audio, out, plan["audio_copy"]), progress=progress, timeout=timeout,
+    )
+    if code != 0 and plan["audio_copy"]:
+        code, outp, err = await run_cmd(ffmpeg_tools.replace_audio_cmd(video, audio, out), progress=progress, timeout=timeout)
+    return code, outp, err
+
+def files_size(paths):
+    total = 0
+    for p in paths:
+        try:
+            total += os.path.getsize(p)
+        except (OSError, TypeError):
+            pass
+    return total
+
+async def run_job(kind: str, args: dict, progress=None):
+    """
+    The ffmpeg step of every flow, by name, so it can run in this process or
+    on a worker (there args are json, so paths only — no Messages):
+      concat         {"paths", "out"}                         videos joined in order
+      amix           {"inputs", "out", "normalize"}           audios mixed; Message inputs are streamed
+      audio_concat   {"paths", "out", "copy", "normalize"}    audios one after the other
+      replace_audio  {"video", "audio", "out", "audio_copy"}  audio_copy None = decide by probing
+      preview        {"paths", "out"}                         low-res look at the joins (/merge_vv preview)
+    """
+    if kind == "concat":
+        return await merge_videos(args["paths"], args["out"], progress)
+    if kind == "preview":
+        infos = [await probe_input(p) for p in args["paths"]]
+        frame, _ = ffmpeg_tools.output_frame(infos)
+        return await run_cmd(
+            ffmpeg_tools.preview_cmd(
+                args["paths"], [i["duration"] if i else 0 for i in infos], args["out"], frame,
+                audio=all(i and i["audio"] for i in infos),
+            ),
+            timeout=ffmpeg_tools.job_timeout(ffmpeg_tools.PREVIEW_SECONDS * len(infos), "transcode"),
+        )
+    if kind == "amix":
+        out, normalize = args["out"], args.get("normalize", False)
+        # amix duration=longest
+        duration = max([await input_duration(x) for x in args["inputs"]] or [0])
+        return await run_streamed(
+            args["inputs"], lambda p: ffmpeg_tools.amix_cmd(p, out, normalize), "a", progress,
+            timeout=ffmpeg_tools.job_timeout(duration, "audio"),
+        )
+    if kind == "audio_concat":
+        return await concat_audio(args["paths"], args["out"], args.get("copy"), args.get("normalize", False), progress)
+    if kind == "replace_audio":
+        out, audio_copy = args["out"], args.get("audio_copy")
+        if isinstance(args["audio"], str) and audio_copy is None:
+            return await replace_audio(args["video"], args["audio"], out, progress)
+        durations = [await input_duration(args["video"]), await input_duration(args["audio"])]
+        return await run_streamed(
+            [args["video"], args["audio"]],
+            lambda p: ffmpeg_tools.replace_audio_cmd(p[0], p[1], out, bool(audio_copy)),
+            "a_replace",
+            progress,
+            timeout=ffmpeg_tools.job_timeout(min(durations) or durations[0], "audio"),
+        )
+    raise ValueError(f"unknown job kind {kind}")
+
+async def job_cost(kind: str, args: dict):
+    """
+    Estimated cpu-seconds of run_job(kind, args), for admission and queue order.
+    Paths are probed (concat also gets planned: stream copy or re-encode);
+    streamed Message inputs count with their Telegram duration.
+    """
+    if kind == "concat":
+        infos = [await probe_input(p) for p in args["paths"]]
+        plan = ffmpeg_tools.plan_concat(infos)
+        mode = {"copy": "copy", "copy_video": "audio"}.get(plan["mode"], "transcode")
+        frame, fps = ffmpeg_tools.output_frame(infos)
+        return ffmpeg_tools.estimate_cost(sum(i["duration"] for i in infos if i), mode, frame, fps)
+    if kind == "preview":
+        return ffmpeg_tools.estimate_cost(
+            ffmpeg_tools.PREVIEW_SECONDS * len(args["paths"]), "transcode",
+            ffmpeg_tools.preview_frame(), ffmpeg_tools.PREVIEW_FPS,
+        )
+    if kind == "amix":
+        return ffmpeg_tools.estimate_cost(max([await input_duration(x) for x in args["inputs"]] or [0]), "audio")
+    if kind == "audio_concat":
+        duration = sum([await input_duration(p) for p in args["paths"]])
+        return ffmpeg_tools.estimate_cost(duration, "copy" if args.get("copy") else "audio")
+    if kind == "replace_audio":
+        # the video is stream-copied; at most the audio is re-encoded
+        return ffmpeg_tools.estimate_cost(await input_duration(args["video"]), "audio")
+    return 0.0
+
+async def run_queued(m: Message, kind: str, args: dict, label: str, progress=None, files: list = None, reserve_bytes: int = 0):
+    """
+    Run job `kind` (see run_job) on behalf of message m's sender, through the
+    local job scheduler or, with USE_WORKERS, through the broker on a worker.
+    files are protected from tmp cleanup while the job is queued/running and
+    reserve_bytes of temp space (the expected output) is reserved up front.
+    Tells the user their queue position when they have to wait.
+    The job can be stopped with /cancel in m's chat (see JobHandle).
+    Refused up front when the user is over their job count or cpu budget (see Admission).
+    """
+    files = [f for f in (files or []) if f]
+    uid = m.from_user.id if m.from_user else None
+    priority = PRIORITY_PRO if uid in PRO_USERS else PRIORITY_FREE
+    cost = await job_cost(kind, args)
+    refused = admission.admit(uid, cost, PRO_BUDGET_FACTOR if priority == PRIORITY_PRO else 1)
+    if refused:
+        log.info("job %s for user %s refused (cost %.0f cpu-s): %s", label, uid, cost, refused)
+        return -1, "", refused
+    ran = False
+    # protected before reserving: the cleanup reserve() may run must not take the job's own inputs
+    job_files.update(files)
+    try:
+        res = await tmp_space.reserve(reserve_bytes)
+    except TempSpaceError as e:
+        log.warning("job %s refused: %s", label, e)
+        admission.release(uid, refund=cost)
+        job_files.subtract(files)
+        for f in files:
+            if job_files[f] <= 0:
+                del job_files[f]
+        return -1, "", "Server temp disk is full right now — please try again in a few minutes."
+    handle = JobHandle(owner=uid, label=label)
+    running_jobs.setdefault(m.chat.id, set()).add(handle)
+    try:
+        if job_broker is not None:
+            ran = True  # can't tell from here whether a worker picked it up
+            return await handle.run(run_remote(m, kind, args, progress, uid, priority, cost))
+        job, position = scheduler.submit(
+            lambda: handle.run(run_job(kind, args, progress)), owner=uid, priority=priority, label=label, cost=cost,
+        )
+        handle.job = job
+        if position > 0 and (scheduler.active() >= scheduler.slots or scheduler.owner_full(uid)):
+            lane = "Pro" if priority == PRIORITY_PRO else "Free"
+            await m.reply_text(f"⏳ Queued ({lane}) — position {position}. Starting as soon as a slot is free.")
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            # cancelled while still queued
+            if handle.cancelled:
+                return JobHandle.CANCELLED
+            raise
+        except Exception as e:
+            return -1, "", str(e)
+        finally:
+            ran = job.started is not None
+            if job.started:
+                metrics.observe("queue", job.started - job.created)
+    finally:
+        admission.release(uid, refund=0.0 if ran else cost)
+        handles = running_jobs.get(m.chat.id, set())
+        handles.discard(handle)
+        if not handles:
+            running_jobs.pop(m.chat.id, None)
+        if handle.cancelled:
+            remove_files(args.get("out"), *ffmpeg_tools.part_files(args.get("out") or ""))
+        res.release()
+        job_files.subtract(files)
+        for f in files:
+            if job_files[f] <= 0:
+                del job_files[f]
+
+async def run_remote(m: Message, kind: str, args: dict, progress, owner, priority: int, cost: float = 0.0,
+                     on_start=None):
+    """
+    Enqueue the job for a worker and wait for its result, relaying its progress
+    to `progress`. m (None for API jobs) is told when it has to wait;
+    on_start() is called once a worker has leased it.
+    """
+    args = dict(args)
+    staged = []
+    try:
+        # workers can't stream from Telegram: Message inputs are downloaded here first
+        for key in ("inputs", "audio"):
+            items = args.get(key)
+            many = isinstance(items, list)
+            paths = []
+            for item in (items if many else [items]):
+                if item is None or isinstance(item, str):
+                    paths.append(item)
+                    continue
+                dest = tmp_path("staged", "media")
+                staged.append(dest)
+                if not await download_media_to_path(item, dest):
+                    return -1, "", "Failed to download input."
+                paths.append(dest)
+            if key in args:
+                args[key] = paths if many else paths[0]
+        job_files.update(staged)
+        job_id = job_broker.enqueue(kind, args, owner=owner, priority=priority, cost=cost)
+        log.info("job %s (%s) handed to the workers", job_id, kind)
+        told = False
+        try:
+            while True:
+                await asyncio.sleep(BROKER_POLL)
+                job = job_broker.get(job_id)
+                if job is None:
+                    return -1, "", "Job disappeared from the queue."
+                if job["status"] == "queued" and not told and m is not None:
+                    told = True
+                    lane = "Pro" if priority == PRIORITY_PRO else "Free"
+                    await m.reply_text(f"⏳ Queued ({lane}) — position {job_broker.position(job_id)}. Waiting for a worker.")
+                if job["status"] != "queued" and on_start is not None:
+                    on_start()
+                    on_start = None
+                p = job["progress"]
+                if p and progress is not None:
+                    progress.set_total(p.get("total"))
+                    for line in (f"out_time_us={p.get('out_time_us')}", f"speed={p.get('speed')}", "progress=continue"):
+                        await progress.feed_line(line)
+                if job["status"] in ("done", "failed"):
+                    job_broker.forget(job_id)
+                    code, outp, err = job["result"] or (-1, "", "Job failed.")
+                    return code, outp, err
+        except asyncio.CancelledError:
+            # /cancel (wherever it lands, reply_text and progress edits too): never
+            # claimed if still queued, else the worker stops it at its next heartbeat
+            job_broker.cancel(job_id)
+            raise
+    finally:
+        job_files.subtract(staged)
+        for f in staged:
+            if job_files[f] <= 0:
+                del job_files[f]
+        remove_files(*staged)
+
+# ---------- HTTP batch API ----------
+async def api_job_args(job: ApiJob):
+    """run_job (kind, args) for an API job, the same steps the chat flows pick."""
+    normalize = job.options.get("normalize", False)
+    if job.type == "vv":
+        return "concat", {"paths": job.inputs, "out": merge_api.result_path(job, "mp4")}
+    if job.type == "va":
+        return "replace_audio", {"video": job.inputs[0], "audio": job.inputs[1], "out": merge_api.result_path(job, "mp4"), "audio_copy": None}
+    if job.options.get("mode") == "concat":
+        plan = ffmpeg_tools.plan_audio_concat([await probe_input(p) for p in job.inputs], normalize)
+        return "audio_concat", {"paths": job.inputs, "out": merge_api.result_path(job, plan["ext"]), "copy": plan["copy"], "normalize": normalize}
+    return "amix", {"inputs": job.inputs, "out": merge_api.result_path(job, "mp3"), "normalize": normalize}
+
+async def api_submit(jobs: list):
+    """
+    Queue API jobs in the batch lane (behind every chat user's merges). A
+    batch is probed first and then put in the queue in one go, so it runs
+    together, cheapest jobs first. Not subject to the per-user limits.
+    """
+    ready = []
+    for job in jobs:
+        try:
+            kind, args = await api_job_args(job)
+            ready.append((job, kind, args, await job_cost(kind, args)))
+        except Exception as e:
+            log.warning("api job %s could not be prepared: %s", job.id, e)
+            job.finish((-1, "", str(e)), [])
+    for job, kind, args, cost in ready:
+        job.handle = JobHandle(label=f"api_{job.type}")
+        job.progress = ProgressReporter(None, "api")
+        if job_broker is not None:
+            waiting = job.handle.run(run_remote(None, kind, args, job.progress, None, PRIORITY_BATCH, cost, on_start=job.start))
+        else:
+            queued, _ = scheduler.submit(
+                lambda job=job, kind=kind, args=args: api_run(job, kind, args),
+                priority=PRIORITY_BATCH, label=f"api_{job.type}", cost=cost,
+            )
+            job.handle.job = queued
+            waiting = queued.future
+        job.task = asyncio.create_task(api_wait(job, args["out"], waiting))
+
+async def api_run(job: ApiJob, kind: str, args: dict):
+    job.start()
+    return await job.handle.run(run_job(kind, args, job.progress))
+
+async def api_wait(job: ApiJob, out: str, waiting):
+    try:
+        result = await waiting
+    except asyncio.CancelledError:
+        result = JobHandle.CANCELLED  # cancelled while still queued
+    except Exception as e:
+        result = (-1, "", str(e))
+    outputs = ffmpeg_tools.part_files(out) or ([out] if os.path.exists(out) else [])
+    if result[0] != 0:
+        remove_files(*outputs)
+        outputs = []
+    job.finish(result, outputs, cancelled=job.handle.cancelled)
+    log.info("api job %s (%s): %s", job.id, job.type, job.status)
+
+merge_api = MergeApi(
+    api_submit, API_RESULT_DIR, TMP_DIR, API_TOKEN, API_INPUT_DIRS, API_RESULT_TTL,
+    tmp_space=tmp_space, max_upload=API_MAX_UPLOAD_BYTES,
+)
+
 async def download_media_to_path(msg: Message, dest_path: str):
     """
     Download attached media (video/audio/document/photo) to dest_path.
+    Goes through the download cache, so a file seen before is just linked in.
+    Reserves the file's size in data/tmp first (waits, then fails, if the disk is full).
     Returns True on success.
     """
+    size = getattr(streaming.media_of(msg), "file_size", 0) or 0
     try:
-        await msg.download(file_name=dest_path)
+        res = await tmp_space.reserve(size)
+    except TempSpaceError as e:
+        log.warning("download refused: %s", e)
+        return False
+    ok = False
+    try:
+        ok = await media_cache.fetch(msg, dest_path, _download)
+        return ok
+    finally:
+        res.release(written=ok)
+
+async def _download(msg: Message, dest_path: str):
+    media = streaming.media_of(msg)
+    size = getattr(media, "file_size", 0) or 0
+    try:
+        with metrics.timer("download"):
+            if DOWNLOAD_CONNECTIONS > 1 and size >= PARALLEL_DOWNLOAD_MIN_BYTES:
+                await downloader.download(app, msg, media, dest_path, DOWNLOAD_CONNECTIONS)
+            else:
+                await msg.download(file_name=dest_path)
         return True
     except Exception as e:
         log.exception("download error: %s", e)
+        remove_files(dest_path)
         return False
 
-def save_meta(title: str, caption: str):
-    with open(META_PATH, "w", encoding="utf-8") as f:
-        json.dump({"title": title, "caption": caption}, f, ensure_ascii=False, indent=2)
+async def run_streamed(inputs: list, build_cmd, prefix: str, progress=None, timeout: int = ffmpeg_tools.TIMEOUT_UNKNOWN):
+    """
+    Run an ffmpeg command over inputs without staging them on disk first.
+    inputs holds file paths and/or Messages; every Message is streamed from
+    Telegram into a named FIFO while ffmpeg reads it. build_cmd(paths) must
+    return the command for the resulting input paths.
+    At most STREAM_MAX_INPUTS Messages are streamed, the others downloaded
+    first; the streams wait until stream_budget has slots for all of them.
+    If the streamed run fails, the messages are downloaded and the command is
+    retried once from regular files.
+    Returns (returncode, stdout, stderr) like run_cmd.
+    """
+    feeds, paths, downloaded = {}, [], []
+
+    async def download(item):
+        dest = tmp_path(prefix, "media")
+        downloaded.append(dest)
+        return dest if await download_media_to_path(item, dest) else None
 
-def load_meta():
-    if not os.path.exists(META_PATH):
+    try:
+        for i, item in enumerate(inputs):
+            if isinstance(item, str):
+                paths.append(item)
+            elif len(feeds) < STREAM_MAX_INPUTS:
+                feeds[i] = streaming.MediaFeed(app, item, tmp_path(prefix + "_fifo", "pipe"))
+                paths.append(feeds[i].path)
+            else:
+                paths.append(await download(item))
+                if paths[-1] is None:
+                    return -1, "", "Failed to download input."
+        async with stream_budget.reserve(len(feeds)):
+            for feed in feeds.values():
+                feed.start()
+            try:
+                code, outp, err = await run_cmd(build_cmd(paths), progress=progress, timeout=timeout)
+            finally:
+                fed = await asyncio.gather(*(f.finish() for f in feeds.values()))
+        if not feeds or (code == 0 and all(fed)):
+            return code, outp, err
+        log.warning("streamed run failed (code %s), retrying from disk", code)
+        for i in feeds:
+            paths[i] = await download(inputs[i])
+            if paths[i] is None:
+                return -1, "", "Failed to download input."
+        return await run_cmd(build_cmd(paths), progress=progress, timeout=timeout)
+    finally:
+        remove_files(*downloaded)
+
+async def probe_input(path: str):
+    """ffmpeg_tools.probe_media with the download cache's stored result in front of it."""
+    info = media_cache.probe_info(path)
+    if info is None:
+        with metrics.timer("probe"):
+            info = await ffmpeg_tools.probe_media(path)
+        media_cache.store_probe(path, info)
+    return info
+
+def should_stream(msg: Message):
+    """Stream msg into ffmpeg instead of downloading it (a cached copy beats both)."""
+    if USE_WORKERS:
+        return False  # workers read inputs from the shared data dir
+    return STREAM_INPUTS and streaming.is_streamable(msg) and not media_cache.contains_msg(msg)
+
+async def input_duration(item):
+    """Duration in seconds of a path (ffprobe) or a Message (Telegram metadata); 0 if unknown."""
+    if isinstance(item, str):
+        info = await probe_input(item)
+        return info["duration"] if info else 0.0
+    return float(getattr(streaming.media_of(item), "duration", 0) or 0)
+
+async def make_thumbnail(src: str, out: str):
+    """Convert an image into a Telegram video thumb (JPEG, <= 320px, < 200 KB). Returns True on success."""
+    for quality in (3, 8, 15, 25):
+        code, _, err = await run_cmd(ffmpeg_tools.thumbnail_cmd(src, out, quality, THUMB_MAX_SIDE), timeout=60)
+        if code != 0:
+            log.warning("thumbnail conversion failed: %s", (err or "")[-300:])
+            return False
+        if files_size([out]) < THUMB_MAX_BYTES:
+            return True
+    return False
+
+async def save_thumb(user_id: int, file_id: str, src: str):
+    """Convert the downloaded photo src and make it user_id's thumbnail."""
+    jpg = tmp_path("thumb", "jpg")
+    try:
+        if not await make_thumbnail(src, jpg):
+            return False
+        settings.set_thumb(user_id, jpg, file_id)
+        return True
+    finally:
+        remove_files(jpg)
+
+async def user_thumb(user_id: int):
+    """
+    The user's thumbnail as an in-memory JPEG for reply_video, or None.
+    If the file is gone but the photo's file_id is known, it is fetched again.
+    """
+    data = settings.thumb_bytes(user_id)
+    file_id = settings.get(user_id)["thumb_file_id"]
+    if data is None and file_id:
+        src = tmp_path("thumb_src", "jpg")
+        try:
+            await app.download_media(file_id, file_name=src)
+            if await save_thumb(user_id, file_id, src):
+                data = settings.thumb_bytes(user_id)
+        except Exception as e:
+            log.warning("could not restore thumbnail of %s: %s", user_id, e)
+        finally:
+            remove_files(src)
+    if data is None:
         return None
-    with open(META_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
+    buf = io.BytesIO(data)
+    buf.name = "thumb.jpg"
+    return buf
+
+async def migrate_global_settings():
+    """The old bot had one meta.json / thumb.jpg for everybody: they become OWNER_ID's."""
+    if not OWNER_ID:
+        return
+    if os.path.exists(THUMB_PATH) and not settings.has_thumb(OWNER_ID):
+        if await save_thumb(OWNER_ID, None, THUMB_PATH):
+            remove_files(THUMB_PATH)
+            log.info("moved global thumbnail to owner %s", OWNER_ID)
+    if os.path.exists(META_PATH) and settings.meta(OWNER_ID) is None:
+        try:
+            with open(META_PATH, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            settings.set_meta(OWNER_ID, meta.get("title", ""), meta.get("caption", ""))
+            os.remove(META_PATH)
+            log.info("moved global metadata to owner %s", OWNER_ID)
+        except (OSError, ValueError) as e:
+            log.warning("meta.json migration failed: %s", e)
 
 def now_ts():
     return int(time.time())
 
+async def split_output(path: str):
+    """Cut a finished file that is over MAX_UPLOAD_BYTES into parts at keyframes (stream copy). Returns the parts."""
+    info = await probe_input(path)
+    duration = info["duration"] if info else 0
+    if not duration:
+        return []
+    parts = ffmpeg_tools.split_parts(files_size([path]), MAX_UPLOAD_BYTES)
+    code, _, err = await run_cmd(
+        ffmpeg_tools.split_cmd(path, path, ffmpeg_tools.segment_marks(duration, parts)),
+        timeout=ffmpeg_tools.job_timeout(duration, "copy"),
+    )
+    if code != 0:
+        log.warning("split failed: %s", (err or "")[-500:])
+        remove_files(*ffmpeg_tools.part_files(path))
+        return []
+    return ffmpeg_tools.part_files(path)
+
+async def fit_parts(paths: list):
+    """
+    Make every file fit MAX_UPLOAD_BYTES, re-cutting the ones that don't
+    (the size prediction is an estimate). Returns the files in order, or None
+    if one can't be cut small enough (too few keyframes).
+    """
+    fitted = []
+    for p in paths:
+        if files_size([p]) <= MAX_UPLOAD_BYTES:
+            fitted.append(p)
+            continue
+        sub = await split_output(p)
+        if not sub or any(files_size([s]) > MAX_UPLOAD_BYTES for s in sub):
+            remove_files(*sub)
+            return None
+        remove_files(p)
+        fitted.extend(sub)
+    return fitted
+
+def part_caption(caption: str, i: int, n: int):
+    return f"{caption}\n\nPart {i}/{n}".strip() if n > 1 else caption
+
+def sent_file_id(sent):
+    """file_id of the media in a message we just sent (None if unknown)."""
+    media = getattr(sent, "video", None) or getattr(sent, "audio", None) or getattr(sent, "document", None)
+    return getattr(media, "file_id", None)
+
+async def upload_video(m: Message, path: str, caption: str):
+    thumb = await user_thumb(m.from_user.id) if m.from_user else None
+    with metrics.timer("upload"):
+        if thumb:
+            return await m.reply_video(path, caption=caption or None, thumb=thumb)
+        return await m.reply_video(path, caption=caption or None)
+
+async def save_video(m: Message, path: str):
+    """Upload a video's bytes (and the sender's thumbnail) without sending it; returns the InputMedia for send_saved_video."""
+    thumb = await user_thumb(m.from_user.id) if m.from_user else None
+    with metrics.timer("upload"):
+        file = await app.save_file(path)
+        thumb = await app.save_file(thumb) if thumb else None
+    # what send_video builds for a local file
+    return raw.types.InputMediaUploadedDocument(
+        mime_type=app.guess_mime_type(path) or "video/mp4",
+        file=file,
+        thumb=thumb,
+        attributes=[
+            raw.types.DocumentAttributeVideo(supports_streaming=True, duration=0, w=0, h=0),
+            raw.types.DocumentAttributeFilename(file_name=os.path.basename(path)),
+        ],
+    )
+
+async def send_saved_video(m: Message, path: str, media, caption: str):
+    """Send a video uploaded by save_video as a reply to m, like m.reply_video would."""
+    while True:
+        try:
+            r = await app.invoke(raw.functions.messages.SendMedia(
+                peer=await app.resolve_peer(m.chat.id),
+                media=media,
+                reply_to_msg_id=m.id if m.chat.type != enums.ChatType.PRIVATE else None,
+                random_id=app.rnd_id(),
+                **await pyro_utils.parse_text_entities(app, caption or "", None, None),
+            ))
+        except FilePartMissing as e:
+            await app.save_file(path, file_id=media.file.id, file_part=e.value)
+            continue
+        for u in r.updates:
+            if isinstance(u, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await app.get_messages(m.chat.id, u.message.id)
+        return None
+
+async def upload_parts(m: Message, parts: list, caption: str):
+    """
+    Upload numbered parts concurrently (UPLOAD_CONCURRENCY at a time), but send
+    them in order: each part goes out once its bytes and every earlier part are
+    up, so "Part 2/3" never lands above "Part 1/3". Returns the sent messages /
+    exceptions in order.
+    """
+    if len(parts) == 1:
+        try:
+            return [await upload_video(m, parts[0], caption)]
+        except Exception as e:
+            return [e]
+    sem = asyncio.Semaphore(max(1, UPLOAD_CONCURRENCY))
+
+    async def save(path):
+        async with sem:
+            return await save_video(m, path)
+
+    saving = [asyncio.ensure_future(save(p)) for p in parts]
+    sent = []
+    try:
+        for i, (path, task) in enumerate(zip(parts, saving), 1):
+            try:
+                sent.append(await send_saved_video(m, path, await task, part_caption(caption, i, len(parts))))
+            except Exception as e:
+                sent.append(e)
+    finally:
+        for task in saving:
+            task.cancel()
+    return sent
+
+async def send_video_result(m: Message, out: str, what: str = "Merged", key: str = None):
+    """
+    Reply to m with the output video (sender's thumbnail + metadata caption if set), then delete it.
+    Results over MAX_UPLOAD_BYTES go out as numbered parts, uploaded concurrently.
+    With a result-cache key, the sent file_ids are remembered for the next identical request.
+    """
+    caption = settings.caption_for(m.from_user.id) if m.from_user else ""
+    written = ffmpeg_tools.part_files(out) or [out]
+    job_files.update(written)  # keep tmp cleanup away while they are cut / uploaded
+    parts = []
+    try:
+        parts = await fit_parts(written)
+        if parts is None:
+            await m.reply_text(f"{what} but the result is over the upload limit and could not be cut into parts.")
+        else:
+            sent = await upload_parts(m, parts, caption)
+            failed = [r for r in sent if isinstance(r, Exception)]
+            if failed:
+                log.error("send %s parts: %d failed: %s", what.lower(), len(failed), failed[0])
+                if len(parts) == 1:
+                    raise failed[0]
+                await m.reply_text(f"{what} but {len(failed)} of {len(parts)} parts failed to send: {failed[0]}")
+            elif key:
+                remember_result(key, "video", sent)
+    except Exception as e:
+        log.exception("send %s video error", what.lower())
+        await m.reply_text(f"{what} but failed to send: " + str(e))
+    finally:
+        job_files.subtract(written)
+        for p in written:
+            if job_files[p] <= 0:
+                del job_files[p]
+    remove_files(out, *written, *(parts or []))
+
+async def send_audio_result(m: Message, out: str, key: str = None, caption: str = "Mixed audio"):
+    """Reply to m with the merged audio, then delete it."""
+    try:
+        with metrics.timer("upload"):
+            sent = await m.reply_audio(out, caption=caption)
+        if key:
+            remember_result(key, "audio", [sent])
+    except Exception as e:
+        log.exception("send mixed audio error")
+        await m.reply_text("Mixed but failed to send: " + str(e))
+    remove_files(out)
+
+# ---------- result cache ----------
+def media_uid(msg):
+    return getattr(streaming.media_of(msg), "file_unique_id", None) if msg else None
+
+def thumb_key(user_id: int):
+    """What identifies the thumbnail baked into a user's video results."""
+    s = settings.get(user_id)
+    if s["thumb_file_id"]:
+        return s["thumb_file_id"]
+    data = settings.thumb_bytes(user_id)
+    return hashlib.sha1(data).hexdigest() if data else ""
+
+def flow_key(action: str, input_uids: list, user_id: int, video: bool = True):
+    """Result-cache key, or None when an input's file_unique_id is unknown (or the cache is off)."""
+    if not result_cache.enabled or not input_uids or not all(input_uids):
+        return None
+    return result_key(action, input_uids, thumb_key(user_id) if video else "")
+
+def remember_result(key: str, kind: str, sent: list):
+    file_ids = [sent_file_id(s) for s in sent]
+    if all(file_ids):
+        result_cache.put(key, kind, file_ids)
+
+async def send_cached_result(m: Message, key: str, audio_caption: str = "Mixed audio"):
+    """Answer m from the result cache. False on a miss (or if Telegram refuses the old file_id)."""
+    hit = result_cache.get(key) if key else None
+    if not hit:
+        return False
+    ids = hit["file_ids"]
+    try:
+        with metrics.timer("upload"):
+            if hit["kind"] == "audio":
+                await m.reply_audio(ids[0], caption=audio_caption)
+            else:
+                caption = settings.caption_for(m.from_user.id)
+                for i, file_id in enumerate(ids, 1):
+                    await m.reply_video(file_id, caption=part_caption(caption, i, len(ids)) or None)
+    except Exception as e:
+        log.warning("cached result %s not accepted any more: %s", key, e)
+        result_cache.forget(key)
+        return False
+    log.info("answered from result cache: %s", key)
+    return True
+
 # ---------- Inline Menus ----------
 MAIN_MENU = InlineKeyboardMarkup(
     [
@@ -147,6 +1193,32 @@ META_MENU = InlineKeyboardMarkup(
     ]
 )
 
+# ---------- Handlers that wait ----------
+# pyrogram runs handlers on a fixed pool of update workers (min(32, cpu + 4));
+# a merge waiting for its download, temp space or a queue slot would hold one
+# of them, and with enough queued merges /cancel, /status and the buttons stop
+# being processed. Those handlers are registered through detached(): every
+# update gets its own task and the worker is free again at once. The module
+# name still refers to the plain coroutine function.
+handler_tasks = set()
+
+def detached(register):
+    """detached(app.on_message(...)) in place of @app.on_message(...)."""
+    def deco(handler):
+        @functools.wraps(handler)
+        async def spawn(client, update):
+            task = asyncio.create_task(handler(client, update))
+            handler_tasks.add(task)
+            task.add_done_callback(_handler_done)
+        register(spawn)
+        return handler
+    return deco
+
+def _handler_done(task):
+    handler_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("handler failed", exc_info=task.exception())
+
 # ---------- Start ----------
 @app.on_message(filters.command("start") & filters.private)
 async def start_cmd(_, m: Message):
@@ -154,7 +1226,7 @@ async def start_cmd(_, m: Message):
     await m.reply_text(txt, reply_markup=MAIN_MENU)
 
 # ---------- Callback query handler ----------
-@app.on_callback_query()
+@detached(app.on_callback_query())
 async def cb_handler(_, cq):
     data = cq.data or ""
     uid = cq.from_user.id
@@ -165,13 +1237,14 @@ async def cb_handler(_, cq):
         pending[cq.message.chat.id] = {"action": "set_thumb", "owner": uid, "ts": now_ts()}
         await cq.answer("এখন একটি ছবি সেন্ড করো — সেট করা হবে থাম্বনেইল হিসেবে.", show_alert=True)
     elif data == "thumb_show":
-        if os.path.exists(THUMB_PATH):
-            await cq.message.reply_photo(THUMB_PATH, caption="Current thumbnail")
+        if settings.has_thumb(uid):
+            # the photo is already on Telegram: send it by file_id, no re-upload
+            file_id = settings.get(uid)["thumb_file_id"]
+            await cq.message.reply_photo(file_id or settings.thumb_path(uid), caption="Current thumbnail")
         else:
             await cq.answer("No thumbnail set.", show_alert=True)
     elif data == "thumb_del":
-        if os.path.exists(THUMB_PATH):
-            os.remove(THUMB_PATH)
+        if settings.clear_thumb(uid):
             await cq.answer("Thumbnail deleted.", show_alert=True)
         else:
             await cq.answer("No thumbnail to delete.", show_alert=True)
@@ -181,14 +1254,13 @@ async def cb_handler(_, cq):
         pending[cq.message.chat.id] = {"action": "set_meta", "owner": uid, "ts": now_ts()}
         await cq.answer("Use /setmeta Title|Caption or reply to a message with /setmeta.", show_alert=True)
     elif data == "meta_show":
-        meta = load_meta()
+        meta = settings.meta(uid)
         if meta:
             await cq.answer(f"Title: {meta.get('title','')}\nCaption: {meta.get('caption','')}", show_alert=True)
         else:
             await cq.answer("No metadata saved.", show_alert=True)
     elif data == "meta_del":
-        if os.path.exists(META_PATH):
-            os.remove(META_PATH)
+        if settings.clear_meta(uid):
             await cq.answer("Metadata deleted.", show_alert=True)
         else:
             await cq.answer("No metadata to delete.", show_alert=True)
@@ -197,9 +1269,11 @@ async def cb_handler(_, cq):
     elif data == "menu_help":
         help_text = (
             "Help:\n"
-            "• /merge_vv — Reply to 1st video with this command, then send 2nd video.\n"
-            "• /merge_aa — Reply to 1st audio with this command, then send 2nd audio.\n"
+            "• /merge_vv — Reply to 1st video with this command, then send 2nd video. /merge_vv preview shows a quick low-res look at the join first.\n"
+            "• /merge_aa — Reply to 1st audio with this command, then send 2nd audio. Mixes them; /merge_aa concat plays them one after the other, add norm to even out loudness.\n"
             "• /merge_va — Reply to video with this command, then send audio to replace.\n"
+            "• /merge_many — Send any number of videos (or an album), then /done to join them all at once. /merge_many aa mixes audios.\n"
+            "• /cancel — Drop a pending merge, or stop one that is already running.\n"
             "• Thumbnail: set/show/delete via menu.\n"
         )
         await cq.message.edit_text(help_text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Back", callback_data="menu_back")]]))
@@ -207,6 +1281,8 @@ async def cb_handler(_, cq):
         await cq.message.edit_text("About: Hassan Video Merge Bot\nDeveloper: You\nVersion: 1.0", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Back", callback_data="menu_back")]]))
     elif data == "menu_back":
         await cq.message.edit_text("Main menu:", reply_markup=MAIN_MENU)
+    elif data in ("preview_render", "preview_abort"):
+        await preview_choice(cq, data == "preview_render")
     else:
         await cq.answer("Unknown action.")
 
@@ -216,14 +1292,20 @@ async def photo_handler(_, m: Message):
     chat_id = m.chat.id
     state = pending.get(chat_id)
     if state and state.get("action") == "set_thumb" and state.get("owner") == m.from_user.id:
-        # download as thumb.jpg
+        # download, shrink to Telegram's thumb limits, keep per user
+        src = tmp_path("thumb_src", "jpg")
         try:
-            await m.download(file_name=THUMB_PATH)
+            await m.download(file_name=src)
+            if not await save_thumb(m.from_user.id, m.photo.file_id, src):
+                await m.reply_text("Failed to convert this image to a thumbnail.", quote=True)
+                return
             pending.pop(chat_id, None)
             await m.reply_text("✅ Thumbnail saved!", quote=True)
         except Exception as e:
             log.exception("thumb save error")
             await m.reply_text("Failed to save thumbnail: " + str(e), quote=True)
+        finally:
+            remove_files(src)
 
 # ---------- Metadata command ----------
 @app.on_message(filters.command("setmeta") & filters.private)
@@ -240,12 +1322,12 @@ async def setmeta_cmd(_, m: Message):
         title, caption = payload.split("|", 1)
     else:
         title, caption = payload, ""
-    save_meta(title.strip(), caption.strip())
+    settings.set_meta(m.from_user.id, title.strip(), caption.strip())
     await m.reply_text("✅ Metadata saved.")
 
 @app.on_message(filters.command("showmeta") & filters.private)
 async def showmeta_cmd(_, m: Message):
-    meta = load_meta()
+    meta = settings.meta(m.from_user.id)
     if meta:
         await m.reply_text(f"Title: {meta.get('title','')}\nCaption: {meta.get('caption','')}")
     else:
@@ -253,8 +1335,7 @@ async def showmeta_cmd(_, m: Message):
 
 @app.on_message(filters.command("delmeta") & filters.private)
 async def delmeta_cmd(_, m: Message):
-    if os.path.exists(META_PATH):
-        os.remove(META_PATH)
+    if settings.clear_meta(m.from_user.id):
         await m.reply_text("Metadata deleted.")
     else:
         await m.reply_text("No metadata to delete.")
@@ -264,15 +1345,18 @@ async def delmeta_cmd(_, m: Message):
 def tmp_path(prefix: str, ext: str):
     return os.path.join(TMP_DIR, f"{prefix}_{uuid.uuid4().hex}.{ext}")
 
-# Clean up old tmp files periodically (light)
-@app.on_message(filters.private)
-async def cleanup_trigger(_, m: Message):
-    # occasionally run cleanup
-    if int(time.time()) % 50 == 0:
-        clean_tmp()
+def is_video_msg(msg: Message):
+    return bool(msg.video or (msg.document and msg.document.mime_type and "video" in msg.document.mime_type))
+
+def is_audio_msg(msg: Message):
+    return bool(msg.audio or msg.voice or (msg.document and msg.document.mime_type and msg.document.mime_type.startswith("audio")))
+
+def state_files(state: dict):
+    """All temp files a pending state owns."""
+    return [state.get("first_file"), state.get("second_file")] + [c.get("file") for c in state.get("clips", [])]
 
 # Start merge command (reply to first file)
-@app.on_message(filters.command("merge_vv") & filters.reply & filters.private)
+@detached(app.on_message(filters.command("merge_vv") & filters.reply & filters.private))
 async def merge_vv_start(_, m: Message):
     first = m.reply_to_message
     if not first:
@@ -282,17 +1366,138 @@ async def merge_vv_start(_, m: Message):
     if not (first.video or (first.document and first.document.mime_type and "video" in (first.document.mime_type))):
         await m.reply_text("Reply to a video file (first) with /merge_vv")
         return
-    # download first
-    f1 = tmp_path("v1", "mp4")
-    ok = await download_media_to_path(first, f1)
-    if not ok:
-        await m.reply_text("Failed to download first video.")
-        return
+    # /merge_vv [preview]: confirm a low-res preview of the join before the full render
+    preview = PREVIEW_MERGES or "preview" in [a.lower() for a in (m.text or "").split()[1:]]
     chat_id = m.chat.id
-    pending[chat_id] = {"action": "merge_vv_wait_second", "owner": m.from_user.id, "first_file": f1, "first_type": "video", "ts": now_ts()}
-    await m.reply_text("First video saved. এখন SECOND video পাঠাও (একই চ্যাটে)।")
+    # downloaded only once the second video misses the result cache (download_first)
+    pending[chat_id] = {"action": "merge_vv_wait_second", "owner": m.from_user.id, "first_file": None, "first_msg": first.id, "first_uid": media_uid(first), "first_type": "video", "preview": preview, "ts": now_ts()}
+    await m.reply_text("First video noted. এখন SECOND video পাঠাও (একই চ্যাটে)।")
+
+first_downloads = {}  # chat_id -> task downloading the pending merge's first input
+
+async def download_first(chat_id: int, state: dict, prefix: str):
+    """
+    Download a pending merge's first input on demand: /merge_vv and /merge_va
+    only note its message, so an identical pair answered from the result
+    cache never fetches it. Concurrent callers share one download.
+    Returns the path, or None if it failed.
+    """
+    if state.get("first_file") and chat_id not in first_downloads:
+        return state["first_file"]
+    task = first_downloads.get(chat_id)
+    if task is None:
+        path = tmp_path(prefix, "mp4")
+        state["first_file"] = path  # from here on /cancel and tmp cleanup know it
+        pending.save(chat_id)
+
+        async def fetch():
+            try:
+                first = await app.get_messages(chat_id, state["first_msg"])
+                if not getattr(first, "empty", False) and await download_media_to_path(first, path):
+                    return path
+                state["first_file"] = None  # tried again with the next second input
+                pending.save(chat_id)
+                return None
+            finally:
+                first_downloads.pop(chat_id, None)
+
+        task = first_downloads[chat_id] = asyncio.ensure_future(fetch())
+    return await asyncio.shield(task)
+
+PREVIEW_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Render full", callback_data="preview_render"),
+     InlineKeyboardButton("✖️ Abort", callback_data="preview_abort")]
+])
+
+async def send_preview(m: Message, state: dict, f2: str, key: str):
+    """
+    Encode and send the low-res preview of the join, then park the merge as
+    merge_vv_confirm until the user presses a button (preview_choice). While
+    it encodes the merge sits as merge_vv_previewing, so more media is refused.
+    Returns False if no preview could be made (the caller renders right away);
+    True once the preview is out (or /cancel stopped it and the merge is dropped).
+    """
+    previewing = dict(state, action="merge_vv_previewing", second_file=f2, second_msg=m.id, ts=now_ts())
+    pending[m.chat.id] = previewing
+    status = await m.reply_text("Got second video — making a quick preview...")
+    prev = tmp_path("preview", "mp4")
+    code, outp, err = await run_queued(
+        m, "preview", {"paths": [state["first_file"], f2], "out": prev}, "preview",
+        files=[state["first_file"], f2, prev], reserve_bytes=0,
+    )
+    try:
+        # /cancel before the job was queued drops the pending state instead of the job
+        if (code, outp, err) == JobHandle.CANCELLED or pending.get(m.chat.id) is not previewing:
+            remove_files(f2, *state_files(state))
+            pending.pop(m.chat.id, None)
+            await m.reply_text("Merge cancelled.")
+            return True
+        if code != 0 or not has_result(prev):
+            log.warning("preview failed, rendering directly: %s", (err or outp or "")[-300:])
+            return False
+        sent = await m.reply_video(
+            prev, caption="👀 Preview of the join (low quality). Render the full merge?", reply_markup=PREVIEW_BUTTONS,
+        )
+    except Exception as e:
+        log.warning("preview send failed, rendering directly: %s", e)
+        return False
+    finally:
+        remove_files(prev)
+        try:
+            await status.delete()
+        except Exception:
+            pass
+    pending[m.chat.id] = {
+        "action": "merge_vv_confirm", "owner": m.from_user.id, "first_file": state["first_file"], "first_msg": state["first_msg"],
+        "second_file": f2, "second_msg": m.id, "preview_msg": sent.id, "key": key, "ts": now_ts(),
+    }
+    return True
+
+async def preview_choice(cq, render: bool):
+    """Render or drop a merge parked behind its preview (the buttons under it)."""
+    chat_id = cq.message.chat.id
+    state = pending.get(chat_id)
+    if (not state or state.get("action") != "merge_vv_confirm" or state.get("owner") != cq.from_user.id
+            or state.get("preview_msg") != cq.message.id):
+        await cq.answer("This preview is no longer pending.", show_alert=True)
+        return
+    # popped before anything is awaited, so a double tap can't render twice
+    pending.pop(chat_id, None)
+    await cq.answer("Rendering..." if render else "Aborted.")
+    try:
+        await cq.message.edit_reply_markup(None)
+    except Exception:
+        pass
+    if not render:
+        remove_files(*state_files(state))
+        await cq.message.reply_text("Merge aborted — nothing was rendered.")
+        return
+    m = await app.get_messages(chat_id, state["second_msg"])
+    if getattr(m, "empty", False):
+        remove_files(*state_files(state))
+        await cq.message.reply_text("The second video was deleted — start the merge again.")
+        return
+    await merge_vv_render(m, state["first_file"], state["second_file"], state.get("key"))
 
-@app.on_message(filters.command("merge_aa") & filters.reply & filters.private)
+async def merge_vv_render(m: Message, f1: str, f2: str, key: str):
+    """The full /merge_vv: concat f1 + f2 through the job queue and send the result."""
+    status = await m.reply_text("Got second video — merging now (may take some time)...")
+    progress = ProgressReporter(status, "Merging videos")
+    out = tmp_path("out_merge", "mp4")
+    # stream copy when both inputs match, re-encode otherwise
+    code, outp, err = await run_queued(
+        m, "concat", {"paths": [f1, f2], "out": out}, "merge_vv", progress,
+        files=[f1, f2, out], reserve_bytes=files_size([f1, f2]),
+    )
+    await progress.done("✅ Done — uploading..." if code == 0 else "❌ Merge failed.")
+    # cleanup first & second
+    remove_files(f1, f2)
+    if code == 0 and has_result(out):
+        await send_video_result(m, out, "Merged", key)
+    else:
+        await m.reply_text("Merge failed:\n" + (err or outp or "Unknown error"))
+
+@detached(app.on_message(filters.command("merge_aa") & filters.reply & filters.private))
 async def merge_aa_start(_, m: Message):
     first = m.reply_to_message
     if not first:
@@ -307,17 +1512,26 @@ async def merge_aa_start(_, m: Message):
     if not ok_type:
         await m.reply_text("Reply to an audio/voice file with /merge_aa")
         return
+    # /merge_aa [concat] [norm]: mix (default) or one after the other, optionally loudness-normalised
+    args = [a.lower() for a in (m.text or "").split()[1:]]
+    mode = "concat" if any(a in ("concat", "join", "seq") for a in args) else "mix"
+    normalize = any(a in ("norm", "normalize", "loudnorm") for a in args)
+    chat_id = m.chat.id
+    if mode == "mix" and should_stream(first):
+        # nothing to download yet: it is streamed into ffmpeg once the second audio arrives
+        pending[chat_id] = {"action": "merge_aa_wait_second", "owner": m.from_user.id, "first_file": None, "first_msg": first.id, "first_uid": media_uid(first), "first_type": "audio", "mode": mode, "normalize": normalize, "ts": now_ts()}
+        await m.reply_text("First audio noted. এখন SECOND audio পাঠাও (একই চ্যাটে)।")
+        return
     f1 = tmp_path("a1", "mp3")
     # download
     ok = await download_media_to_path(first, f1)
     if not ok:
         await m.reply_text("Failed to download first audio.")
         return
-    chat_id = m.chat.id
-    pending[chat_id] = {"action": "merge_aa_wait_second", "owner": m.from_user.id, "first_file": f1, "first_type": "audio", "ts": now_ts()}
+    pending[chat_id] = {"action": "merge_aa_wait_second", "owner": m.from_user.id, "first_file": f1, "first_msg": first.id, "first_uid": media_uid(first), "first_type": "audio", "mode": mode, "normalize": normalize, "ts": now_ts()}
     await m.reply_text("First audio saved. এখন SECOND audio পাঠাও (একই চ্যাটে)।")
 
-@app.on_message(filters.command("merge_va") & filters.reply & filters.private)
+@detached(app.on_message(filters.command("merge_va") & filters.reply & filters.private))
 async def merge_va_start(_, m: Message):
     first = m.reply_to_message
     if not first:
@@ -326,17 +1540,126 @@ async def merge_va_start(_, m: Message):
     if not (first.video or (first.document and first.document.mime_type and "video" in first.document.mime_type)):
         await m.reply_text("Reply to a video file with /merge_va")
         return
-    fvideo = tmp_path("v", "mp4")
-    ok = await download_media_to_path(first, fvideo)
-    if not ok:
-        await m.reply_text("Failed to download video.")
-        return
     chat_id = m.chat.id
-    pending[chat_id] = {"action": "merge_va_wait_audio", "owner": m.from_user.id, "first_file": fvideo, "first_type": "video", "ts": now_ts()}
-    await m.reply_text("Video saved. এখন AUDIO পাঠাও যাতে ভিডিওর অডিও রেপ্লেস করব।")
+    # downloaded only once the audio misses the result cache (download_first)
+    pending[chat_id] = {"action": "merge_va_wait_audio", "owner": m.from_user.id, "first_file": None, "first_msg": first.id, "first_uid": media_uid(first), "first_type": "video", "ts": now_ts()}
+    await m.reply_text("Video noted. এখন AUDIO পাঠাও যাতে ভিডিওর অডিও রেপ্লেস করব।")
+
+# ---------- N-way merge sessions ----------
+# /merge_many collects any number of clips (albums included), /done merges them in one ffmpeg run
+MAX_SESSION_CLIPS = int(os.environ.get("MAX_SESSION_CLIPS", "20"))
+session_downloads = {}  # chat_id -> set of clip download tasks still running
+
+async def add_session_clip(chat_id: int, state: dict, msg: Message):
+    """
+    Download msg (or just remember it, if it can be streamed later) as a session clip.
+    Only the first STREAM_MAX_INPUTS streamable clips are left for streaming.
+    """
+    clip = {"msg_id": msg.id, "uid": media_uid(msg), "file": None}
+    streamed = sum(1 for c in state["clips"] if not c["file"])
+    if state["kind"] == "audio" and streamed < STREAM_MAX_INPUTS and should_stream(msg):
+        pass
+    else:
+        clip["file"] = tmp_path("clip", "mp4" if state["kind"] == "video" else "mp3")
+        if not await download_media_to_path(msg, clip["file"]):
+            return False
+    if pending.get(chat_id) is not state:
+        # session was cancelled or finished while downloading
+        remove_files(clip["file"])
+        return False
+    state["clips"].append(clip)
+    pending.save(chat_id)
+    return True
+
+def start_clip_download(chat_id: int, state: dict, msg: Message):
+    task = asyncio.create_task(add_session_clip(chat_id, state, msg))
+    tasks = session_downloads.setdefault(chat_id, set())
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+def session_size(chat_id: int, state: dict):
+    return len(state["clips"]) + len(session_downloads.get(chat_id, ()))
+
+@detached(app.on_message(filters.command("merge_many") & filters.private))
+async def merge_many_start(_, m: Message):
+    # /merge_many -> videos joined in order, /merge_many aa -> audios mixed together
+    args = (m.text or "").split()[1:]
+    kind = "audio" if args and args[0].lower() in ("aa", "audio") else "video"
+    chat_id = m.chat.id
+    old = pending.get(chat_id)
+    if old:
+        remove_files(*state_files(old))
+    state = {"action": "session_collect", "owner": m.from_user.id, "kind": kind, "clips": [], "groups": [], "ts": now_ts()}
+    pending[chat_id] = state
+    first = m.reply_to_message
+    if first:
+        msgs = [first]
+        if first.media_group_id:
+            try:
+                msgs = await app.get_media_group(chat_id, first.id)
+            except Exception:
+                log.exception("get_media_group failed")
+        wanted = is_video_msg if kind == "video" else is_audio_msg
+        tasks = [start_clip_download(chat_id, state, x) for x in msgs[:MAX_SESSION_CLIPS] if wanted(x)]
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await m.reply_text(
+        f"Session started ({kind}, {len(state['clips'])} clip(s) so far). "
+        f"এখন বাকি ক্লিপগুলো পাঠাও (album চলবে), তারপর /done দাও। Max {MAX_SESSION_CLIPS} clips."
+    )
+
+@detached(app.on_message(filters.command("done") & filters.private))
+async def done_cmd(_, m: Message):
+    chat_id = m.chat.id
+    state = pending.get(chat_id)
+    if not state or state.get("action") != "session_collect" or state.get("owner") != m.from_user.id:
+        await m.reply_text("No merge session. Start one with /merge_many")
+        return
+    tasks = list(session_downloads.get(chat_id, ()))
+    if tasks:
+        await m.reply_text(f"Waiting for {len(tasks)} clip(s) to finish downloading...")
+        await asyncio.gather(*tasks, return_exceptions=True)
+    clips = sorted(state["clips"], key=lambda c: c["msg_id"])
+    if len(clips) < 2:
+        await m.reply_text(f"Need at least 2 clips, got {len(clips)}. Send more or /cancel.")
+        return
+    pending.pop(chat_id, None)
+    session_downloads.pop(chat_id, None)
+    key = flow_key("merge_many_" + state["kind"], [c.get("uid") for c in clips], m.from_user.id, state["kind"] == "video")
+    if await send_cached_result(m, key):
+        remove_files(*state_files(state))
+        return
+    status = await m.reply_text(f"Merging {len(clips)} clips in one pass (may take some time)...")
+    progress = ProgressReporter(status, f"Merging {len(clips)} clips")
+    if state["kind"] == "video":
+        out = tmp_path("out_many", "mp4")
+        kind, args = "concat", {"paths": [c["file"] for c in clips], "out": out}
+    else:
+        out = tmp_path("out_many", "mp3")
+        stream_ids = [c["msg_id"] for c in clips if not c["file"]]
+        msgs = {}
+        if stream_ids:
+            msgs = {x.id: x for x in await app.get_messages(chat_id, stream_ids)}
+        inputs = [c["file"] or msgs[c["msg_id"]] for c in clips]
+        # amix duration=longest
+        progress.set_total(max([await input_duration(x) for x in inputs]))
+        kind, args = "amix", {"inputs": inputs, "out": out}
+    code, outp, err = await run_queued(
+        m, kind, args, "merge_many", progress,
+        files=state_files(state) + [out], reserve_bytes=files_size(state_files(state)),
+    )
+    remove_files(*state_files(state))
+    await progress.done("✅ Done — uploading..." if code == 0 else "❌ Merge failed.")
+    if code == 0 and has_result(out):
+        if state["kind"] == "video":
+            await send_video_result(m, out, "Merged", key)
+        else:
+            await send_audio_result(m, out, key)
+    else:
+        await m.reply_text("Merge failed:\n" + (err or outp or "Unknown error"))
 
 # Handler for receiving second media (generic)
-@app.on_message(filters.private & (filters.video | filters.audio | filters.voice | filters.document | filters.audio))
+@detached(app.on_message(filters.private & (filters.video | filters.audio | filters.voice | filters.document | filters.audio)))
 async def second_media_handler(_, m: Message):
     chat_id = m.chat.id
     state = pending.get(chat_id)
@@ -347,54 +1670,58 @@ async def second_media_handler(_, m: Message):
         # not the owner; ignore
         return
     action = state.get("action")
+    # N-way session: collect another clip
+    if action == "session_collect":
+        wanted = is_video_msg if state["kind"] == "video" else is_audio_msg
+        if not wanted(m):
+            await m.reply_text(f"This session collects {state['kind']} clips — send a {state['kind']} or /done.")
+            return
+        if session_size(chat_id, state) >= MAX_SESSION_CLIPS:
+            await m.reply_text(f"Session is full ({MAX_SESSION_CLIPS} clips). Send /done to merge.")
+            return
+        if m.media_group_id:
+            # albums arrive as one message per item; acknowledge the album once
+            if m.media_group_id not in state["groups"]:
+                state["groups"].append(m.media_group_id)
+                pending.save(chat_id)
+                await m.reply_text("Album received — adding its clips. Send more or /done.")
+            if not await start_clip_download(chat_id, state, m):
+                await m.reply_text("Failed to add one of the album clips.", quote=True)
+            return
+        if await start_clip_download(chat_id, state, m):
+            await m.reply_text(f"Clip {len(state['clips'])} added. Send more or /done to merge.", quote=True)
+        else:
+            await m.reply_text("Failed to download this clip.", quote=True)
+        return
+
     # video+video second
     if action == "merge_vv_wait_second":
         # ensure the incoming message contains a video
         if not (m.video or (m.document and m.document.mime_type and "video" in (m.document.mime_type or ""))):
             await m.reply_text("Please send a video file as the SECOND file for merging.")
             return
+        key = flow_key("merge_vv", [state.get("first_uid"), media_uid(m)], m.from_user.id)
+        if await send_cached_result(m, key):
+            remove_files(*state_files(state))
+            pending.pop(chat_id, None)
+            return
         f2 = tmp_path("v2", "mp4")
-        ok = await download_media_to_path(m, f2)
+        f1, ok = await asyncio.gather(download_first(chat_id, state, "v1"), download_media_to_path(m, f2))
+        if not f1:
+            remove_files(f2)
+            await m.reply_text("Failed to download first video.")
+            return
         if not ok:
             await m.reply_text("Failed to download second video.")
             return
-        await m.reply_text("Got second video — merging now (may take some time)...")
-        out = tmp_path("out_merge", "mp4")
-        # Use ffmpeg filter_complex concat (works even if codecs differ, but re-encodes)
-        # Build command
-        cmd = (
-            f"ffmpeg -y -i {shlex.quote(state['first_file'])} -i {shlex.quote(f2)} "
-            f"-filter_complex \"[0:v:0][0:a:0][1:v:0][1:a:0]concat=n=2:v=1:a=1[outv][outa]\" "
-            f"-map \"[outv]\" -map \"[outa]\" -preset veryfast -movflags +faststart {shlex.quote(out)}"
-        )
-        code, outp, err = await run_cmd(cmd)
-        # cleanup first & second
-        try:
-            if os.path.exists(state['first_file']): os.remove(state['first_file'])
-            if os.path.exists(f2): os.remove(f2)
-        except Exception:
-            pass
+        if state.get("preview") and await send_preview(m, state, f2, key):
+            return
         pending.pop(chat_id, None)
-        if code == 0 and os.path.exists(out):
-            # send with thumbnail if set
-            caption = ""
-            meta = load_meta()
-            if meta:
-                caption = f"{meta.get('title','')}\n\n{meta.get('caption','')}"
-            try:
-                if os.path.exists(THUMB_PATH):
-                    await m.reply_video(out, caption=caption or None, thumb=THUMB_PATH)
-                else:
-                    await m.reply_video(out, caption=caption or None)
-            except Exception as e:
-                log.exception("send merged video error")
-                await m.reply_text("Merged but failed to send: " + str(e))
-            try:
-                os.remove(out)
-            except Exception:
-                pass
-        else:
-            await m.reply_text("Merge failed:\n" + (err or outp or "Unknown error"))
+        await merge_vv_render(m, state["first_file"], f2, key)
+        return
+
+    if action == "merge_vv_previewing":
+        await m.reply_text("Still making the preview of your merge — wait for it, or /cancel.")
         return
 
     # audio+audio second
@@ -408,37 +1735,50 @@ async def second_media_handler(_, m: Message):
         if not ok_type:
             await m.reply_text("Please send an audio/voice file as the SECOND audio.")
             return
-        f2 = tmp_path("a2", "mp3")
-        ok = await download_media_to_path(m, f2)
-        if not ok:
-            await m.reply_text("Failed to download second audio.")
+        mode, normalize = state.get("mode", "mix"), state.get("normalize", False)
+        caption = "Joined audio" if mode == "concat" else "Mixed audio"
+        key = flow_key(f"merge_aa_{mode}" + ("_norm" if normalize else ""), [state.get("first_uid"), media_uid(m)],
+                       m.from_user.id, video=False)
+        if await send_cached_result(m, key, caption):
+            remove_files(*state_files(state))
+            pending.pop(chat_id, None)
             return
-        await m.reply_text("Got second audio — mixing now...")
-        out = tmp_path("out_mix", "mp3")
-        # Use amix to mix two audios
-        cmd = (
-            f"ffmpeg -y -i {shlex.quote(state['first_file'])} -i {shlex.quote(f2)} "
-            f"-filter_complex \"amix=inputs=2:duration=longest:dropout_transition=2\" -c:a libmp3lame -q:a 4 {shlex.quote(out)}"
+        first_in = state.get('first_file')
+        if not first_in:
+            first_in = await app.get_messages(chat_id, state['first_msg'])
+        f2 = None
+        if mode == "mix" and should_stream(m):
+            second_in = m
+        else:
+            f2 = second_in = tmp_path("a2", "mp3")
+            ok = await download_media_to_path(m, f2)
+            if not ok:
+                await m.reply_text("Failed to download second audio.")
+                return
+        verb = "Joining" if mode == "concat" else "Mixing"
+        status = await m.reply_text(f"Got second audio — {verb.lower()} now...")
+        progress = ProgressReporter(status, f"{verb} audio")
+        if mode == "concat":
+            plan = ffmpeg_tools.plan_audio_concat([await probe_input(first_in), await probe_input(second_in)], normalize)
+            log.info("Audio concat plan: copy=%s (%s)", plan["copy"], plan["reason"])
+            out = tmp_path("out_join", plan["ext"])
+            kind, args = "audio_concat", {"paths": [first_in, second_in], "out": out, "copy": plan["copy"], "normalize": normalize}
+        else:
+            # amix duration=longest
+            progress.set_total(max(await input_duration(first_in), await input_duration(second_in)))
+            out = tmp_path("out_mix", "mp3")
+            kind, args = "amix", {"inputs": [first_in, second_in], "out": out, "normalize": normalize}
+        code, outp, err = await run_queued(
+            m, kind, args, "merge_aa", progress,
+            files=[state.get('first_file'), f2, out], reserve_bytes=files_size([state.get('first_file'), f2]),
         )
-        code, outp, err = await run_cmd(cmd)
-        try:
-            if os.path.exists(state['first_file']): os.remove(state['first_file'])
-            if os.path.exists(f2): os.remove(f2)
-        except Exception:
-            pass
+        remove_files(state.get('first_file'), f2)
+        await progress.done("✅ Done — uploading..." if code == 0 else f"❌ {verb} failed.")
         pending.pop(chat_id, None)
         if code == 0 and os.path.exists(out):
-            try:
-                await m.reply_audio(out, caption="Mixed audio")
-            except Exception as e:
-                log.exception("send mixed audio error")
-                await m.reply_text("Mixed but failed to send: " + str(e))
-            try:
-                os.remove(out)
-            except Exception:
-                pass
+            await send_audio_result(m, out, key, caption)
         else:
-            await m.reply_text("Mix failed:\n" + (err or outp or "Unknown error"))
+            await m.reply_text(f"{verb} failed:\n" + (err or outp or "Unknown error"))
         return
 
     # video + audio (replace audio)
@@ -452,42 +1792,44 @@ async def second_media_handler(_, m: Message):
         if not ok_type:
             await m.reply_text("Please send an audio file to replace the video's audio.")
             return
-        fa = tmp_path("a_replace", "mp3")
-        ok = await download_media_to_path(m, fa)
-        if not ok:
-            await m.reply_text("Failed to download audio.")
+        key = flow_key("merge_va", [state.get("first_uid"), media_uid(m)], m.from_user.id)
+        if await send_cached_result(m, key):
+            remove_files(*state_files(state))
+            pending.pop(chat_id, None)
             return
-        await m.reply_text("Got audio — replacing video audio now...")
         out = tmp_path("out_va", "mp4")
-        # replace audio: copy video stream, map new audio
-        cmd = (
-            f"ffmpeg -y -i {shlex.quote(state['first_file'])} -i {shlex.quote(fa)} "
-            f"-c:v copy -map 0:v:0 -map 1:a:0 -shortest {shlex.quote(out)}"
+        fa = None
+        status = await m.reply_text("Got audio — replacing video audio now...")
+        progress = ProgressReporter(status, "Replacing audio")
+        if should_stream(m):
+            fvideo = await download_first(chat_id, state, "v")
+            if not fvideo:
+                await m.reply_text("Failed to download video.")
+                return
+            # audio is read sequentially, so stream it straight into ffmpeg;
+            # without a file to probe, only mp3 is known to be copyable
+            audio_copy = streaming.mime_of(m) in ("audio/mpeg", "audio/mp3")
+            vdur, adur = await input_duration(fvideo), await input_duration(m)
+            progress.set_total(min(vdur, adur) or vdur)
+            args = {"video": fvideo, "audio": m, "out": out, "audio_copy": audio_copy}
+        else:
+            fa = tmp_path("a_replace", "mp3")
+            fvideo, ok = await asyncio.gather(download_first(chat_id, state, "v"), download_media_to_path(m, fa))
+            if not fvideo or not ok:
+                remove_files(fa)
+                await m.reply_text("Failed to download video." if not fvideo else "Failed to download audio.")
+                return
+            args = {"video": fvideo, "audio": fa, "out": out, "audio_copy": None}
+        # replace audio: copy video stream, map new audio (copied too if mp4-compatible)
+        code, outp, err = await run_queued(
+            m, "replace_audio", args, "merge_va", progress,
+            files=[state['first_file'], fa, out], reserve_bytes=files_size([state['first_file']]),
         )
-        code, outp, err = await run_cmd(cmd)
-        try:
-            if os.path.exists(state['first_file']): os.remove(state['first_file'])
-            if os.path.exists(fa): os.remove(fa)
-        except Exception:
-            pass
+        remove_files(state['first_file'], fa)
+        await progress.done("✅ Done — uploading..." if code == 0 else "❌ Processing failed.")
         pending.pop(chat_id, None)
         if code == 0 and os.path.exists(out):
-            caption = ""
-            meta = load_meta()
-            if meta:
-                caption = f"{meta.get('title','')}\n\n{meta.get('caption','')}"
-            try:
-                if os.path.exists(THUMB_PATH):
-                    await m.reply_video(out, caption=caption or None, thumb=THUMB_PATH)
-                else:
-                    await m.reply_video(out, caption=caption or None)
-            except Exception as e:
-                log.exception("send va output error")
-                await m.reply_text("Processed but failed to send: " + str(e))
-            try:
-                os.remove(out)
-            except Exception:
-                pass
+            await send_video_result(m, out, "Processed", key)
         else:
             await m.reply_text("Processing failed:\n" + (err or outp or "Unknown error"))
         return
@@ -496,15 +1838,18 @@ async def second_media_handler(_, m: Message):
 @app.on_message(filters.command("cancel") & filters.private)
 async def cancel_pending(_, m: Message):
     chat_id = m.chat.id
+    handles = [h for h in running_jobs.get(chat_id, ()) if not h.cancelled]
+    if handles:
+        # the flow that started the job cleans up its files once it returns
+        for h in handles:
+            h.cancel()
+        await m.reply_text("Stopping the running job...")
+        return
     if chat_id in pending:
-        # remove first_file if exists
-        try:
-            f = pending[chat_id].get("first_file")
-            if f and os.path.exists(f):
-                os.remove(f)
-        except Exception:
-            pass
+        # remove first_file / session clips if they exist
+        remove_files(*state_files(pending[chat_id]))
         pending.pop(chat_id, None)
+        session_downloads.pop(chat_id, None)
         await m.reply_text("Pending action cancelled.")
     else:
         await m.reply_text("No pending action.")
@@ -514,18 +1859,198 @@ async def cancel_pending(_, m: Message):
 async def status_cmd(_, m: Message):
     chat_id = m.chat.id
     st = pending.get(chat_id)
+    queue = f"Queue: {scheduler.queue_depth()} waiting, {scheduler.active()}/{scheduler.slots} running"
+    if media_cache.enabled:
+        cs = media_cache.stats()
+        queue += f"\nCache: {cs['hits']} hits / {cs['misses']} misses, {cs['bytes'] // (1024 * 1024)} MB"
+    if result_cache.enabled:
+        rs = result_cache.stats()
+        queue += f"\nResults: {rs['hits']} reused, {rs['entries']} cached"
+    ts = tmp_space.stats()
+    queue += f"\nTmp: {ts['used'] // (1024 * 1024)} MB used, {ts['reserved'] // (1024 * 1024)} MB reserved of {ts['quota'] // (1024 * 1024)} MB"
+    if m.from_user:
+        us = admission.stats(m.from_user.id)
+        queue += f"\nYou: {us['active']} merges in progress"
+        if us["budget"]:
+            factor = PRO_BUDGET_FACTOR if m.from_user.id in PRO_USERS else 1
+            queue += f", {us['spent'] / 60:.0f} of {us['budget'] * factor / 60:.0f} cpu-min used this hour"
     if st:
-        await m.reply_text(f"Pending: {st.get('action')} (owner: {st.get('owner')})")
+        await m.reply_text(f"Pending: {st.get('action')} (owner: {st.get('owner')})\n{queue}")
     else:
-        await m.reply_text("No pending action.")
+        await m.reply_text("No pending action.\n" + queue)
 
 # ---------- Graceful stop (owner only) ----------
 @app.on_message(filters.command("stop") & filters.user(OWNER_ID) & filters.private)
 async def stop_bot(_, m: Message):
     await m.reply_text("Stopping...")
+    # kill running ffmpeg first, it would outlive the bot otherwise
+    for handles in list(running_jobs.values()):
+        for h in list(handles):
+            h.cancel()
+    await asyncio.sleep(0.5)
     await app.stop()
 
+# ---------- Session expiry / recovery ----------
+async def session_sweeper():
+    """Expire stale pending states in the background and delete their files."""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            for chat_id, state in pending.expire():
+                log.info("session expired: chat %s (%s)", chat_id, state.get("action"))
+                remove_files(*state_files(state))
+                session_downloads.pop(chat_id, None)
+                try:
+                    await app.send_message(chat_id, f"⌛ Pending action ({state.get('action')}) expired. Start again if you still need it.")
+                except Exception:
+                    pass
+            if job_broker is not None:
+                job_broker.purge(TMP_MAX_AGE)
+            merge_api.purge()
+        except Exception:
+            log.exception("session sweep failed")
+
+async def recover_sessions():
+    """
+    Pick up sessions that were pending when the bot went down. Input files
+    lost with the old dyno's disk are fetched again from their messages.
+    """
+    for chat_id, state in pending.items():
+        try:
+            if state.get("action") == "merge_vv_previewing":
+                # the preview died with the old process: ask for the second video again
+                remove_files(state.pop("second_file", None))
+                state.pop("second_msg", None)
+                state["action"] = "merge_vv_wait_second"
+            for name in ("first", "second"):
+                path = state.get(f"{name}_file")
+                if path and not os.path.exists(path):
+                    msg = await app.get_messages(chat_id, state[f"{name}_msg"])
+                    if not await download_media_to_path(msg, path):
+                        raise RuntimeError(f"{name} file lost")
+            for clip in state.get("clips", []):
+                if clip.get("file") and not os.path.exists(clip["file"]):
+                    msg = await app.get_messages(chat_id, clip["msg_id"])
+                    if not await download_media_to_path(msg, clip["file"]):
+                        raise RuntimeError("clip lost")
+            pending.save(chat_id)
+            await app.send_message(chat_id, f"♻️ Bot restarted — your pending action ({state.get('action')}) is still active.")
+            log.info("recovered session: chat %s (%s)", chat_id, state.get("action"))
+        except Exception as e:
+            log.warning("could not recover session for chat %s: %s", chat_id, e)
+            remove_files(*state_files(state))
+            pending.pop(chat_id, None)
+            try:
+                await app.send_message(chat_id, "Bot restarted and your pending action was lost — please start again.")
+            except Exception:
+                pass
+
 # ---------- Run ----------
+async def main():
+    await app.start()
+    await migrate_global_settings()
+    for _chat_id, state in pending.expire():
+        remove_files(*state_files(state))
+    await recover_sessions()
+    metrics_runner = None
+    if METRICS_PORT:
+        try:
+            metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            log.warning("metrics endpoint not started: %s", e)
+    api_runner = None
+    if API_PORT and not API_TOKEN:
+        log.warning("API_PORT is set but API_TOKEN is empty; HTTP API not started")
+    elif API_PORT:
+        try:
+            api_runner = await merge_api.serve(API_HOST, API_PORT)
+        except OSError as e:
+            log.warning("HTTP API not started: %s", e)
+    tasks = [
+        asyncio.create_task(session_sweeper()),
+        # tmp cleanup runs here now (off the event loop), not from a message handler
+        asyncio.create_task(tmp_space.run_forever(TMP_SWEEP_INTERVAL)),
+    ]
+    await idle()
+    for t in tasks:
+        t.cancel()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    if api_runner:
+        await api_runner.cleanup()
+    await app.stop()
+
+# ---------- Worker mode ----------
+async def keep_lease(job_id: str, worker: str, run: asyncio.Task, lost: asyncio.Event):
+    """Heartbeat every BROKER_LEASE / 3; stop the job once it is cancelled or its lease has moved on."""
+    while True:
+        await asyncio.sleep(BROKER_LEASE / 3)
+        if not job_broker.heartbeat(job_id, worker, BROKER_LEASE):
+            log.warning("job %s: cancelled or lease lost, stopping it", job_id)
+            lost.set()
+            run.cancel()
+            return
+
+async def worker_loop(worker: str):
+    """Claim jobs from the broker one at a time and run them."""
+    while True:
+        try:
+            job = job_broker.claim(worker, BROKER_LEASE)
+        except Exception:
+            log.exception("claim failed")
+            job = None
+        if job is None:
+            await asyncio.sleep(BROKER_POLL)
+            continue
+        log.info("%s: running job %s (%s, attempt %d)", worker, job["id"], job["kind"], job["attempts"])
+        args = dict(job["args"])
+        final = args["out"]
+        # a crashed attempt's ffmpeg can outlive its worker, so every attempt
+        # writes its own file and only the one that still holds the lease is moved into place
+        stem, ext = os.path.splitext(final)
+        args["out"] = f"{stem}.try{job['attempts']}{ext}"
+
+        def attempt_files(out=args["out"]):
+            # listed once the attempt is over, the parts only exist by then
+            return [out] + ffmpeg_tools.part_files(out)
+
+        run = asyncio.create_task(run_job(job["kind"], args, ProgressRelay(job_broker, job["id"])))
+        lost = asyncio.Event()
+        beat = asyncio.create_task(keep_lease(job["id"], worker, run, lost))
+        try:
+            result = await run
+        except asyncio.CancelledError:
+            if not lost.is_set():
+                raise
+            result = JobHandle.CANCELLED
+        except Exception as e:
+            log.exception("job %s failed", job["id"])
+            result = (-1, "", str(e))
+        finally:
+            beat.cancel()
+        if not job_broker.heartbeat(job["id"], worker, BROKER_LEASE):
+            log.warning("job %s was cancelled or its lease moved to another worker; result dropped", job["id"])
+            remove_files(*attempt_files())
+            continue
+        for path in attempt_files():
+            if os.path.exists(path):
+                # x.try2.mp4 -> x.mp4, x.try2.part000.mp4 -> x.part000.mp4
+                os.replace(path, stem + path[len(f"{stem}.try{job['attempts']}"):])
+        job_broker.complete(job["id"], worker, result)
+
+async def worker_main():
+    """`python3 bot.py worker`: FFMPEG_SLOTS job loops, no Telegram client."""
+    global job_broker, media_cache
+    job_broker = job_broker or JobBroker(BROKER_DB)
+    # the bot process owns the cache index; a second writer would clobber it
+    media_cache = MediaCache(CACHE_DIR, 0)
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    log.info("Worker %s started with %d slots on %s", name, scheduler.slots, BROKER_DB)
+    await asyncio.gather(*(worker_loop(f"{name}/{i}") for i in range(scheduler.slots)))
+
 if __name__ == "__main__":
-    log.info("Starting Hassan Video Merge Bot...")
-    app.run()
+    if sys.argv[1:2] == ["worker"]:
+        asyncio.run(worker_main())
+    else:
+        log.info("Starting Hassan Video Merge Bot...")
+        app.run(main())
@@ -0,0 +1,86 @@
+"""
+Per-user admission control for ffmpeg jobs.
+
+Before a job is queued it gets a cost estimate in cpu-seconds
+(ffmpeg_tools.estimate_cost, from the probed duration, resolution and whether
+it is a stream copy or a re-encode). A user may have at most `max_jobs` jobs
+queued or running, and the estimates of the jobs they started in the last
+`window` seconds must fit their budget; anything over that is refused with a
+hint on when to come back. One job bigger than the whole budget is still let
+in when the user has spent nothing in the window, so large merges remain
+possible — they just can't be stacked.
+
+Bookkeeping is in memory: a restart forgives everyone.
+"""
+
+import collections
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Admission:
+    def __init__(self, max_jobs: int, budget: float, window: float):
+        self.max_jobs = max_jobs  # 0 = no limit
+        self.budget = budget  # cpu-seconds per window, 0 = no limit
+        self.window = window
+        self.active = collections.Counter()  # user -> jobs queued or running
+        self._spent = collections.defaultdict(collections.deque)  # user -> (time, cost), oldest first
+        self.refused = 0
+
+    def spent(self, user, now: float = None):
+        """cpu-seconds the user's jobs were estimated at within the window."""
+        now = now or time.time()
+        spent = self._spent.get(user)
+        if not spent:
+            return 0.0
+        while spent and spent[0][0] < now - self.window:
+            spent.popleft()
+        return sum(c for _, c in spent)
+
+    def admit(self, user, cost: float, factor: float = 1.0):
+        """
+        Book a job of `cost` for user (factor scales the budget, e.g. for Pro).
+        Returns None when admitted, else the reason to tell the user.
+        Every admitted job must be ended with release().
+        """
+        if user is None:
+            return None
+        if self.max_jobs and self.active[user] >= self.max_jobs:
+            self.refused += 1
+            return f"You already have {self.active[user]} merges in progress — wait for one to finish."
+        now = time.time()
+        spent = self.spent(user, now)
+        budget = self.budget * factor
+        if self.budget and spent and spent + cost > budget:
+            self.refused += 1
+            # when enough of the window's oldest jobs have aged out
+            freed, wait = spent, self.window
+            for ts, c in self._spent[user]:
+                freed -= c
+                if freed + cost <= budget:
+                    wait = ts + self.window - now
+                    break
+            log.info("user %s over budget: %.0f + %.0f > %.0f cpu-s", user, spent, cost, budget)
+            return f"That's over your processing budget for now — try again in about {max(1, int(wait // 60) + 1)} min."
+        self.active[user] += 1
+        self._spent[user].append((now, cost))
+        return None
+
+    def release(self, user, refund: float = 0.0):
+        """The job ended; refund its cost if it never ran (cancelled while queued)."""
+        if user is None:
+            return
+        self.active[user] -= 1
+        if self.active[user] <= 0:
+            del self.active[user]
+        if refund:
+            spent = self._spent.get(user)
+            for i in range(len(spent or ()) - 1, -1, -1):
+                if spent[i][1] == refund:
+                    del spent[i]
+                    break
+
+    def stats(self, user):
+        return {"active": self.active.get(user, 0), "spent": self.spent(user), "budget": self.budget}
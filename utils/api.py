@@ -0,0 +1,356 @@
+"""
+Local HTTP API for batch merges (API_PORT, off by default).
+
+Scripts submit the same merges the chat commands make, without Telegram:
+vv (videos joined), aa (audios mixed, or joined with "mode": "concat") and
+va (a video's audio replaced by an audio file).
+
+  POST   /jobs               one job, or {"jobs": [...]} for a batch
+  GET    /jobs/{id}          status, progress and result links
+  GET    /jobs/{id}/result   the output (?part=N when it came out in parts)
+  DELETE /jobs/{id}          cancel a job, or delete a finished one's result
+  GET    /batches/{id}       every job of a batch
+
+A job is JSON {"type": "vv", "inputs": [path, ...], "mode": "concat",
+"normalize": true} with local paths (only under `input_dirs`), or a
+multipart/form-data POST with type / mode / normalize fields and the input
+files as parts, in order. An upload may be at most `max_upload` bytes and
+reserves its Content-Length (or `max_upload` without one) in `tmp_space`
+before it is read. Every request needs "Authorization: Bearer <token>".
+
+This module only validates, stages uploads and keeps track of jobs;
+`submit` (bot.py's api_submit) queues them and calls ApiJob.finish(). Jobs
+live in memory; results stay in `result_dir` for `result_ttl` seconds after
+the job ends (purge()).
+"""
+
+import asyncio
+import collections
+import hmac
+import logging
+import os
+import re
+import time
+import uuid
+
+from utils.tmpspace import TempSpaceError
+
+log = logging.getLogger(__name__)
+
+# inputs: vv / aa take 2 or more, va exactly a video and an audio
+TYPES = {"vv": (2, None), "aa": (2, None), "va": (2, 2)}
+MAX_INPUTS = 50
+UPLOAD_CHUNK = 1024 * 1024
+
+
+class ApiError(Exception):
+    """A bad request; the message goes back to the client with `status` (400 by default)."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class ApiJob:
+    def __init__(self, job_type: str, inputs: list, options: dict, batch: str = None, staged: list = None):
+        self.id = uuid.uuid4().hex
+        self.batch = batch
+        self.type = job_type
+        self.inputs = inputs
+        self.options = options
+        self.staged = staged or []  # uploaded inputs, deleted when the job ends
+        self.status = "queued"  # queued / running / done / failed / cancelled
+        self.error = None
+        self.outputs = []
+        self.progress = None  # a ProgressReporter without a message, set by the runner
+        self.handle = None  # the runner's JobHandle, for cancel()
+        self.task = None  # the runner's task waiting for the result
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.status = "running"
+        self.started = time.time()
+
+    def finish(self, result, outputs: list, cancelled: bool = False):
+        code, outp, err = result
+        if cancelled:
+            self.status = "cancelled"
+        elif code == 0 and outputs:
+            self.status = "done"
+        else:
+            self.status = "failed"
+            self.error = (err or outp or "Unknown error")[-1000:]
+        self.outputs = outputs
+        self.finished = time.time()
+        for path in self.staged:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+
+    def to_dict(self):
+        d = {
+            "id": self.id, "batch": self.batch, "type": self.type, "status": self.status,
+            "created": self.created, "started": self.started, "finished": self.finished,
+        }
+        p = self.progress
+        if self.status == "running" and p is not None and p.total:
+            d["progress"] = round(min(p.out_time / p.total, 1.0), 3)
+        if self.error:
+            d["error"] = self.error
+        if self.outputs:
+            d["results"] = [f"/jobs/{self.id}/result?part={i}" for i in range(1, len(self.outputs) + 1)]
+        return d
+
+
+class MergeApi:
+    def __init__(self, submit, result_dir: str, tmp_dir: str, token: str, input_dirs: list = (),
+                 result_ttl: float = 24 * 3600, max_batch: int = 1000, tmp_space=None,
+                 max_upload: int = 4 * 1024 ** 3):
+        self.submit = submit  # async (list of ApiJob) -> None, queues them
+        self.result_dir = result_dir
+        self.tmp_dir = tmp_dir
+        self.tmp_space = tmp_space  # TempSpaceManager of tmp_dir, or None
+        self.max_upload = max_upload
+        self.token = token
+        self.input_dirs = [os.path.realpath(d) for d in input_dirs]
+        self.result_ttl = result_ttl
+        self.max_batch = max_batch
+        self.jobs = {}  # id -> ApiJob
+        self._uploading = set()  # files of multipart requests still being read
+        os.makedirs(result_dir, exist_ok=True)
+
+    def result_path(self, job: ApiJob, ext: str):
+        return os.path.join(self.result_dir, f"{job.id}.{ext}")
+
+    def files_in_use(self):
+        """Staged inputs of unfinished jobs, kept away from tmp cleanup."""
+        paths = set(self._uploading)
+        for job in self.jobs.values():
+            if job.finished is None:
+                paths.update(job.staged)
+        return paths
+
+    def purge(self, now: float = None):
+        """Forget jobs that ended over result_ttl ago and delete their results (and strays from before a restart)."""
+        now = now or time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and job.finished < now - self.result_ttl:
+                self._remove(job.outputs)
+                del self.jobs[job_id]
+        live = {os.path.basename(p) for job in self.jobs.values() for p in job.outputs}
+        for name in os.listdir(self.result_dir):
+            path = os.path.join(self.result_dir, name)
+            try:
+                if name not in live and name.split(".")[0] not in self.jobs and os.path.getmtime(path) < now - self.result_ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _remove(paths):
+        for p in paths:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    # ---------- requests -> jobs ----------
+    def _local_path(self, path):
+        if not self.input_dirs:
+            raise ApiError("local paths are disabled; upload the files or set API_INPUT_DIRS")
+        if not isinstance(path, str):
+            raise ApiError("inputs must be paths")
+        real = os.path.realpath(path)
+        if not any(os.path.commonpath([real, d]) == d for d in self.input_dirs):
+            raise ApiError(f"{path} is outside API_INPUT_DIRS")
+        if not os.path.isfile(real):
+            raise ApiError(f"{path} does not exist")
+        return real
+
+    @staticmethod
+    def _options(job_type: str, fields: dict):
+        mode = str(fields.get("mode") or "mix").lower()
+        if job_type == "aa" and mode not in ("mix", "concat"):
+            raise ApiError("mode must be mix or concat")
+        normalize = fields.get("normalize")
+        if isinstance(normalize, str):
+            normalize = normalize.lower() in ("1", "true", "yes", "on")
+        return {"mode": mode, "normalize": bool(normalize)}
+
+    @staticmethod
+    def _check_type(job_type, count: int):
+        if job_type not in TYPES:
+            raise ApiError("type must be one of " + ", ".join(TYPES))
+        least, most = TYPES[job_type]
+        most = most or MAX_INPUTS
+        if not least <= count <= most:
+            raise ApiError(f"{job_type} takes {least}" + (f" to {most}" if most != least else "") + f" inputs, got {count}")
+
+    def _job_from_json(self, spec, batch: str = None):
+        if not isinstance(spec, dict):
+            raise ApiError("a job is an object with type and inputs")
+        inputs = spec.get("inputs")
+        if not isinstance(inputs, list):
+            raise ApiError("inputs must be a list of paths")
+        self._check_type(spec.get("type"), len(inputs))
+        return ApiJob(spec["type"], [self._local_path(p) for p in inputs], self._options(spec["type"], spec), batch)
+
+    async def _job_from_multipart(self, request):
+        size = request.content_length
+        if size is not None and size > self.max_upload:
+            raise ApiError(f"uploads are limited to {self.max_upload} bytes", 413)
+        res = None
+        if self.tmp_space is not None:
+            try:
+                res = await self.tmp_space.reserve(size if size is not None else self.max_upload)
+            except TempSpaceError as e:
+                raise ApiError(f"no room for the upload: {e}", 507) from None
+        cap = self.max_upload if size is None else size
+        loop = asyncio.get_running_loop()
+        fields, staged, received = {}, [], 0
+        reader = await request.multipart()
+        try:
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                if not part.filename:
+                    fields[part.name] = (await part.text()).strip()
+                    continue
+                ext = os.path.splitext(part.filename)[1].lower()
+                ext = ext if re.fullmatch(r"\.[a-z0-9]{1,5}", ext) else ".bin"
+                dest = os.path.join(self.tmp_dir, f"api_{uuid.uuid4().hex}{ext}")
+                staged.append(dest)
+                self._uploading.add(dest)
+                # disk writes go to a thread, the loop keeps serving the bot meanwhile
+                f = await loop.run_in_executor(None, open, dest, "wb")
+                try:
+                    while True:
+                        chunk = await part.read_chunk(UPLOAD_CHUNK)
+                        if not chunk:
+                            break
+                        received += len(chunk)
+                        if received > cap:  # chunked, or more than its Content-Length said
+                            raise ApiError(f"upload is over {cap} bytes", 413)
+                        await loop.run_in_executor(None, f.write, chunk)
+                finally:
+                    await loop.run_in_executor(None, f.close)
+            self._check_type(fields.get("type"), len(staged))
+            job = ApiJob(fields["type"], list(staged), self._options(fields["type"], fields), staged=list(staged))
+        except BaseException:
+            self._remove(staged)
+            if res is not None:
+                res.release()
+            raise
+        finally:
+            self._uploading.difference_update(staged)
+        if res is not None:
+            res.release(written=received)
+        return job
+
+    # ---------- HTTP ----------
+    def _authorized(self, request):
+        header = request.headers.get("Authorization", "")
+        return bool(self.token) and hmac.compare_digest(header.encode(), f"Bearer {self.token}".encode())
+
+    async def serve(self, host: str, port: int):
+        """Serve the API on the current loop. Returns the aiohttp runner (call .cleanup() to stop)."""
+        from aiohttp import web
+
+        def error(status: int, message: str):
+            return web.json_response({"error": message}, status=status)
+
+        @web.middleware
+        async def auth(request, handler):
+            if not self._authorized(request):
+                return error(401, "missing or wrong API token")
+            try:
+                return await handler(request)
+            except ApiError as e:
+                return error(e.status, str(e))
+
+        def find(request):
+            job = self.jobs.get(request.match_info["id"])
+            if job is None:
+                raise web.HTTPNotFound(text='{"error": "no such job"}', content_type="application/json")
+            return job
+
+        async def submit_jobs(request):
+            if request.content_type.startswith("multipart/"):
+                jobs, batch = [await self._job_from_multipart(request)], None
+            else:
+                try:
+                    body = await request.json()
+                except ValueError:
+                    raise ApiError("body must be JSON or multipart/form-data") from None
+                batch = None
+                specs = [body]
+                if isinstance(body, dict) and "jobs" in body:
+                    specs = body["jobs"]
+                    if not isinstance(specs, list) or not specs:
+                        raise ApiError("jobs must be a non-empty list")
+                    if len(specs) > self.max_batch:
+                        raise ApiError(f"at most {self.max_batch} jobs per batch")
+                    batch = uuid.uuid4().hex
+                jobs = [self._job_from_json(spec, batch) for spec in specs]
+            for job in jobs:
+                self.jobs[job.id] = job
+            await self.submit(jobs)
+            log.info("api: %d job(s) submitted%s", len(jobs), f" as batch {batch}" if batch else "")
+            return web.json_response({"batch": batch, "jobs": [j.to_dict() for j in jobs]}, status=202)
+
+        async def job_status(request):
+            return web.json_response(find(request).to_dict())
+
+        async def job_result(request):
+            job = find(request)
+            if job.status != "done":
+                return error(409, f"job is {job.status}")
+            try:
+                part = int(request.query.get("part", "1"))
+            except ValueError:
+                part = 0
+            if not 1 <= part <= len(job.outputs):
+                return error(404, f"part must be 1 to {len(job.outputs)}")
+            path = job.outputs[part - 1]
+            if not os.path.exists(path):
+                return error(410, "result has been deleted")
+            return web.FileResponse(path, headers={
+                "Content-Disposition": f"attachment; filename=\"{os.path.basename(path)}\"",
+            })
+
+        async def job_delete(request):
+            job = find(request)
+            if job.finished is None:
+                job.cancel()
+                return web.json_response({"id": job.id, "status": "cancelling"}, status=202)
+            self._remove(job.outputs)
+            del self.jobs[job.id]
+            return web.json_response({"id": job.id, "status": "deleted"})
+
+        async def batch_status(request):
+            batch = request.match_info["id"]
+            jobs = [j for j in self.jobs.values() if j.batch == batch]
+            if not jobs:
+                return error(404, "no such batch")
+            counts = collections.Counter(j.status for j in jobs)
+            return web.json_response({"batch": batch, "counts": counts, "jobs": [j.to_dict() for j in jobs]})
+
+        web_app = web.Application(middlewares=[auth])
+        web_app.router.add_post("/jobs", submit_jobs)
+        web_app.router.add_get("/jobs/{id}", job_status)
+        web_app.router.add_get("/jobs/{id}/result", job_result)
+        web_app.router.add_delete("/jobs/{id}", job_delete)
+        web_app.router.add_get("/batches/{id}", batch_status)
+        runner = web.AppRunner(web_app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        log.info("batch API on http://%s:%d/jobs", host, port)
+        return runner
@@ -0,0 +1,215 @@
+"""
+SQLite job broker for worker mode (USE_WORKERS=1).
+
+The bot process enqueues each ffmpeg step as a named job (kind + json args:
+input paths, output path, options). Worker processes (`python3 bot.py worker`)
+claim jobs with a lease, run them and write (returncode, stdout, stderr) back;
+the bot polls for the result, relays progress to the status message and does
+the upload itself. Input and output files live in data/tmp, so bot and
+workers must share the data directory.
+
+A worker keeps its lease alive while the job runs. If it dies, the lease runs
+out and the next claim() hands the job to another worker, up to MAX_ATTEMPTS
+claims before the job is failed. A cancelled job (or one whose lease moved on)
+fails the heartbeat, and the worker stops it.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+import uuid
+
+from utils.scheduler import COST_WEIGHT
+
+log = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          TEXT PRIMARY KEY,
+    kind        TEXT NOT NULL,
+    args        TEXT NOT NULL,
+    owner       INTEGER,
+    priority    INTEGER NOT NULL DEFAULT 1,
+    cost        REAL NOT NULL DEFAULT 0,  -- estimated cpu-seconds, pushes the job back in line
+    status      TEXT NOT NULL,      -- queued / leased / done / failed / cancelled
+    worker      TEXT,
+    lease_until REAL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    progress    TEXT,
+    result      TEXT,
+    created     REAL NOT NULL,
+    updated     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs(status, priority, created);
+"""
+
+
+class JobBroker:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # autocommit; claim() opens its own write transaction
+        self._db = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        try:
+            # databases from before the cost column
+            self._db.execute("ALTER TABLE jobs ADD COLUMN cost REAL NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+
+    def enqueue(self, kind: str, args: dict, owner=None, priority: int = 1, cost: float = 0.0):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._db.execute(
+            "INSERT INTO jobs (id, kind, args, owner, priority, cost, status, created, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, kind, json.dumps(args), owner, priority, cost, now, now),
+        )
+        return job_id
+
+    def claim(self, worker: str, lease: float):
+        """
+        Take the next runnable job: queued, or leased by a worker whose lease
+        ran out; Pro lane first, then by arrival pushed back by cost (as in
+        JobScheduler). Returns {"id", "kind", "args", "attempts"} or None.
+        """
+        now = time.time()
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                row = db.execute(
+                    "SELECT id, kind, args, attempts, status FROM jobs "
+                    "WHERE status = 'queued' OR (status = 'leased' AND lease_until < ?) "
+                    "ORDER BY priority, created + cost * ? LIMIT 1",
+                    (now, COST_WEIGHT),
+                ).fetchone()
+                if row is None:
+                    db.execute("COMMIT")
+                    return None
+                job_id, kind, args, attempts, status = row
+                if attempts >= MAX_ATTEMPTS:
+                    log.warning("job %s lost its worker %d times, failing it", job_id, attempts)
+                    db.execute(
+                        "UPDATE jobs SET status = 'failed', result = ?, updated = ? WHERE id = ?",
+                        (json.dumps([-1, "", "Worker crashed while running this job."]), now, job_id),
+                    )
+                    continue
+                if status == "leased":
+                    log.warning("re-leasing job %s (lease expired)", job_id)
+                db.execute(
+                    "UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                    "updated = ? WHERE id = ?",
+                    (worker, now + lease, now, job_id),
+                )
+                db.execute("COMMIT")
+                return {"id": job_id, "kind": kind, "args": json.loads(args), "attempts": attempts + 1}
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def heartbeat(self, job_id: str, worker: str, lease: float):
+        """Extend the lease; False if the job was taken away from this worker."""
+        cur = self._db.execute(
+            "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+            (time.time() + lease, time.time(), job_id, worker),
+        )
+        return cur.rowcount == 1
+
+    def set_progress(self, job_id: str, progress: dict):
+        self._db.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+
+    def complete(self, job_id: str, worker: str, result):
+        """Store the (returncode, stdout, stderr) result. False if the lease had moved on."""
+        cur = self._db.execute(
+            "UPDATE jobs SET status = 'done', result = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+            (json.dumps(list(result)), time.time(), job_id, worker),
+        )
+        return cur.rowcount == 1
+
+    def cancel(self, job_id: str):
+        """
+        Withdraw a job: a queued one is never claimed, a leased one fails its
+        worker's next heartbeat and the worker stops it.
+        """
+        self._db.execute(
+            "UPDATE jobs SET status = 'cancelled', updated = ? WHERE id = ? AND status IN ('queued', 'leased')",
+            (time.time(), job_id),
+        )
+
+    def get(self, job_id: str):
+        row = self._db.execute(
+            "SELECT status, progress, result, worker FROM jobs WHERE id = ?", (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        status, progress, result, worker = row
+        return {
+            "status": status,
+            "progress": json.loads(progress) if progress else None,
+            "result": json.loads(result) if result else None,
+            "worker": worker,
+        }
+
+    def position(self, job_id: str):
+        """1-based place among queued jobs (0 once claimed)."""
+        row = self._db.execute("SELECT priority, created, status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row[2] != "queued":
+            return 0
+        (n,) = self._db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND (priority < ? OR (priority = ? AND created <= ?))",
+            (row[0], row[0], row[1]),
+        ).fetchone()
+        return n
+
+    def counts(self):
+        return dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def forget(self, job_id: str):
+        self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def purge(self, max_age: float):
+        """Drop finished jobs (and abandoned ones) older than max_age seconds."""
+        cutoff = time.time() - max_age
+        self._db.execute("DELETE FROM jobs WHERE updated < ? AND status IN ('done', 'failed', 'cancelled')", (cutoff,))
+
+
+class ProgressRelay:
+    """
+    Worker-side stand-in for ProgressReporter: collects ffmpeg's -progress
+    blocks and writes the latest one to the job row (at most every
+    `interval` seconds) for the bot to show.
+    """
+
+    def __init__(self, broker: JobBroker, job_id: str, interval: float = 2.0):
+        self.broker = broker
+        self.job_id = job_id
+        self.interval = interval
+        self.total = 0.0
+        self._block = {}
+        self._next_write = 0.0
+
+    def set_total(self, seconds: float):
+        if seconds and seconds > 0:
+            self.total = float(seconds)
+
+    async def feed_line(self, line: str):
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            return False
+        self._block[key] = value
+        if key != "progress":
+            return True
+        block, self._block = self._block, {}
+        now = time.monotonic()
+        if value == "end" or now >= self._next_write:
+            self._next_write = now + self.interval
+            self.broker.set_progress(self.job_id, {
+                "total": self.total,
+                "out_time_us": block.get("out_time_us") or block.get("out_time_ms"),
+                "speed": block.get("speed"),
+            })
+        return True
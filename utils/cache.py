@@ -0,0 +1,199 @@
+"""
+On-disk download cache keyed by Telegram's file_unique_id.
+
+The same intro/outro clip gets merged into many videos; with the cache it is
+downloaded (and ffprobed) once. Cached files live in their own folder and are
+handed to jobs as hard links inside data/tmp, so jobs can delete "their" copy
+as before and eviction never pulls a file out from under a running ffmpeg.
+
+Eviction is LRU under a byte budget. The index (LRU order, sizes and cached
+probe results) is kept in index.json next to the files.
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import os
+import shutil
+
+log = logging.getLogger(__name__)
+
+
+def _media_of(msg):
+    return msg.audio or msg.voice or msg.video or msg.document or msg.photo
+
+
+def _link(src: str, dest: str):
+    """Hard link src to dest (copy if the filesystem refuses)."""
+    try:
+        if os.path.exists(dest):
+            os.remove(dest)
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class MediaCache:
+    def __init__(self, folder: str, max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.probe_hits = 0
+        self.probe_misses = 0
+        self._index = collections.OrderedDict()  # uid -> {"size", "info"}; oldest first
+        self._by_ino = {}  # (device, inode) -> uid, to find cache entries from hard-linked tmp paths
+        self._inflight = {}  # uid -> future of a running download
+        self._index_path = os.path.join(folder, "index.json")
+        if self.enabled:
+            os.makedirs(folder, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _file(self, uid: str):
+        return os.path.join(self.folder, uid)
+
+    def _load(self):
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = []
+        for e in entries:
+            uid = e.get("uid")
+            try:
+                st = os.stat(self._file(uid))
+            except (OSError, TypeError):
+                continue
+            self._index[uid] = {"size": st.st_size, "info": e.get("info")}
+            self._by_ino[(st.st_dev, st.st_ino)] = uid
+        self._evict()
+
+    def _save(self):
+        data = [{"uid": uid, "size": e["size"], "info": e["info"]} for uid, e in self._index.items()]
+        tmp = self._index_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self._index_path)
+        except OSError as e:
+            log.warning("cache index save failed: %s", e)
+
+    def total_bytes(self):
+        return sum(e["size"] for e in self._index.values())
+
+    def contains(self, uid: str):
+        return bool(uid) and uid in self._index
+
+    def contains_msg(self, msg):
+        return self.enabled and self.contains(getattr(_media_of(msg), "file_unique_id", None))
+
+    def _evict(self):
+        total = self.total_bytes()
+        while total > self.max_bytes and self._index:
+            uid, e = self._index.popitem(last=False)
+            total -= e["size"]
+            path = self._file(uid)
+            try:
+                st = os.stat(path)
+                self._by_ino.pop((st.st_dev, st.st_ino), None)
+                os.remove(path)
+            except OSError:
+                pass
+            log.info("cache evicted %s (%d bytes)", uid, e["size"])
+
+    def _add(self, uid: str, path: str):
+        st = os.stat(path)
+        self._index[uid] = {"size": st.st_size, "info": None}
+        self._by_ino[(st.st_dev, st.st_ino)] = uid
+
+    async def fetch(self, msg, dest: str, download):
+        """
+        Make msg's media available at dest. Served from the cache on a hit,
+        otherwise fetched with `await download(msg, path)` into the cache first.
+        Files without a file_unique_id or bigger than the budget bypass the cache.
+        Returns True on success.
+        """
+        media = _media_of(msg)
+        uid = getattr(media, "file_unique_id", None)
+        size = getattr(media, "file_size", 0) or 0
+        if not self.enabled or not uid or size > self.max_bytes:
+            return await download(msg, dest)
+        if uid in self._index and os.path.exists(self._file(uid)):
+            self.hits += 1
+            self._index.move_to_end(uid)
+            _link(self._file(uid), dest)
+            return True
+        fut = self._inflight.get(uid)
+        if fut is not None:
+            # same file is already being downloaded for another job
+            ok = await asyncio.shield(fut)
+            if ok and uid in self._index:
+                self.hits += 1
+                _link(self._file(uid), dest)
+            return ok and os.path.exists(dest)
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[uid] = fut
+        part = self._file(uid) + ".part"
+        ok = False
+        try:
+            ok = await download(msg, part)
+            if ok and os.path.exists(part):
+                os.replace(part, self._file(uid))
+                self._add(uid, self._file(uid))
+                _link(self._file(uid), dest)
+                self._evict()
+                self._save()
+            else:
+                ok = False
+        except Exception:
+            log.exception("cache download failed for %s", uid)
+            ok = False
+        finally:
+            self._inflight.pop(uid, None)
+            fut.set_result(ok)
+            if os.path.exists(part):
+                try:
+                    os.remove(part)
+                except OSError:
+                    pass
+        return ok
+
+    def _uid_for_path(self, path: str):
+        try:
+            st = os.stat(path)
+            return self._by_ino.get((st.st_dev, st.st_ino))
+        except OSError:
+            return None
+
+    def probe_info(self, path: str):
+        """Cached ffprobe result for a path handed out by fetch(), or None."""
+        uid = self._uid_for_path(path) if self.enabled else None
+        info = self._index[uid]["info"] if uid in self._index else None
+        if info is not None:
+            self.probe_hits += 1
+        elif uid:
+            self.probe_misses += 1
+        return info
+
+    def store_probe(self, path: str, info: dict):
+        uid = self._uid_for_path(path) if self.enabled else None
+        if uid in self._index and info is not None:
+            self._index[uid]["info"] = info
+            self._save()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "probe_hits": self.probe_hits,
+            "probe_misses": self.probe_misses,
+            "entries": len(self._index),
+            "bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+        }
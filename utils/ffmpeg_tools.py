@@ -1,2 +1,655 @@
+"""
+ffmpeg / ffprobe helpers used by the merge flows in bot.py.
+
+The main piece here is the concat planner: it probes the inputs and decides
+whether they can be joined with the concat demuxer (`-c copy`), whether only
+the audio needs to be normalised first, or whether a full re-encode is needed.
+"""
+
+import asyncio
+import glob
+import json
+import logging
+import math
+import os
+import shlex
+from fractions import Fraction
+
+log = logging.getLogger(__name__)
+
+# audio codecs that can go into an .mp4 container without re-encoding
+MP4_AUDIO_CODECS = {"aac", "mp3", "ac3", "eac3", "alac"}
+
+# common target used when only the audio of some inputs has to be re-encoded
+AUDIO_TARGET = {"codec_name": "aac", "sample_rate": "44100", "channels": 2}
+
+# audio codecs the sequential audio concat can stream-copy, and the file type for each
+AUDIO_COPY_EXT = {"mp3": "mp3", "aac": "m4a"}
+
+# encoder per output file type when audio has to be re-encoded
+AUDIO_ENCODERS = {"mp3": "-c:a libmp3lame -q:a 4", "m4a": "-c:a aac -b:a 192k"}
+
+# single-pass EBU R128 loudness normalisation; loudnorm works at 192 kHz
+# internally, so resample back afterwards
+LOUDNORM = "loudnorm=I=-16:TP=-1.5:LRA=11,aformat=sample_rates=44100"
+
+# re-encoded audio is ffmpeg's aac default (~128k); counted when fitting a bitrate
+AUDIO_BITRATE = 128000
+
+# below this many bits per pixel per frame a bitrate-capped encode looks worse
+# than just sending the video in parts
+MIN_BITS_PER_PIXEL = 0.04
+
+# parts are cut at keyframes, so aim a bit under the limit
+SPLIT_HEADROOM = 0.9
+SEGMENT_MARK_LEAD = 0.1  # s, see segment_marks
+
+# ranges a long re-encode is cut into for the parallel encode: long enough
+# that process start-up doesn't matter, short enough that every core gets work
+SEGMENT_MIN_SECONDS = 20
+SEGMENT_MAX_SECONDS = 120
+
+# ffmpeg timeouts: a fixed allowance (start-up, probing, slow disk) plus wall
+# seconds per second of media, by the kind of work the command does
+TIMEOUT_BASE = 60
+TIMEOUT_PER_SECOND = {"copy": 0.25, "audio": 0.5, "transcode": 3.0}
+TIMEOUT_UNKNOWN = 600  # when the duration couldn't be probed
+
+# rough cpu-seconds per second of media for admission / queue order (estimate_cost);
+# a re-encode scales with the output's pixel rate relative to 720p30
+COST_PER_SECOND = {"copy": 0.02, "audio": 0.05, "transcode": 1.0}
+COST_REFERENCE_PIXEL_RATE = 1280 * 720 * 30
+
+# /merge_vv preview: this many seconds either side of each join, small and
+# cheap enough to be sent back within seconds of the second video arriving
+PREVIEW_SECONDS = 6
+PREVIEW_HEIGHT = 240
+PREVIEW_FPS = 15
+
+
 def debug(cmd):
     print("Running:", cmd)
+
+
+async def ffprobe(path: str, timeout: int = 60):
+    """
+    Run ffprobe on path and return the parsed json (streams + format).
+    Returns None if ffprobe fails.
+    """
+    cmd = [
+        "ffprobe", "-v", "error", "-print_format", "json",
+        "-show_streams", "-show_format", path,
+    ]
+    return await _probe_json(cmd, path, timeout)
+
+
+async def _probe_json(cmd: list, path: str, timeout: int):
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            log.warning("ffprobe timeout: %s", path)
+            return None
+        if proc.returncode != 0:
+            log.warning("ffprobe failed on %s: %s", path, err.decode(errors="ignore").strip())
+            return None
+        return json.loads(out.decode(errors="ignore") or "{}")
+    except Exception as e:
+        log.warning("ffprobe error on %s: %s", path, e)
+        return None
+
+
+def _fps(rate: str):
+    # plain float so media_info stays json-serialisable (the download cache stores it)
+    try:
+        return float(Fraction(rate)) if rate and rate != "0/0" else None
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def media_info(probe: dict):
+    """
+    Reduce ffprobe output to what the planner cares about:
+    {"duration": float, "bit_rate": int or None, "video": {...} or None, "audio": {...} or None}
+    Only the first video / audio stream is looked at (same as the merge commands).
+    """
+    probe = probe or {}
+    fmt = probe.get("format") or {}
+    info = {"duration": 0.0, "bit_rate": None, "video": None, "audio": None}
+    try:
+        info["duration"] = float(fmt.get("duration") or 0)
+    except ValueError:
+        pass
+    if str(fmt.get("bit_rate", "")).isdigit():
+        info["bit_rate"] = int(fmt["bit_rate"])
+    for s in probe.get("streams") or []:
+        kind = s.get("codec_type")
+        if kind == "video" and info["video"] is None:
+            # cover art in audio files shows up as a video stream
+            if (s.get("disposition") or {}).get("attached_pic"):
+                continue
+            info["video"] = {
+                "codec_name": s.get("codec_name"),
+                "profile": s.get("profile"),
+                "width": s.get("width"),
+                "height": s.get("height"),
+                "pix_fmt": s.get("pix_fmt"),
+                "fps": _fps(s.get("avg_frame_rate")) or _fps(s.get("r_frame_rate")),
+                "bit_rate": int(s["bit_rate"]) if str(s.get("bit_rate", "")).isdigit() else None,
+            }
+        elif kind == "audio" and info["audio"] is None:
+            info["audio"] = {
+                "codec_name": s.get("codec_name"),
+                "profile": s.get("profile"),
+                "sample_rate": s.get("sample_rate"),
+                "channels": s.get("channels"),
+                "bit_rate": int(s["bit_rate"]) if str(s.get("bit_rate", "")).isdigit() else None,
+            }
+    return info
+
+
+async def probe_media(path: str):
+    """ffprobe + media_info in one go. Returns None when the file can't be probed."""
+    probe = await ffprobe(path)
+    if probe is None:
+        return None
+    return media_info(probe)
+
+
+async def keyframe_index(path: str, timeout: int = 300):
+    """
+    Keyframes of path's first video stream, read from the packet headers only
+    (nothing is decoded, so this is quick even for long files):
+    {"keyframes": [(seconds, frames up to the next keyframe), ...], "duration": video end}
+    Times are relative to the file start, the way -ss takes them. None on failure.
+    """
+    cmd = [
+        "ffprobe", "-v", "error", "-print_format", "json", "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,duration_time,flags:format=start_time", path,
+    ]
+    probe = await _probe_json(cmd, path, timeout)
+    if not probe:
+        return None
+    try:
+        start = float((probe.get("format") or {}).get("start_time") or 0)
+    except ValueError:
+        start = 0.0
+    packets = []
+    for p in probe.get("packets") or []:
+        try:
+            packets.append((float(p["pts_time"]) - start, float(p.get("duration_time") or 0), "K" in p.get("flags", "")))
+        except (KeyError, ValueError):
+            continue
+    packets.sort()
+    keyframes = []
+    for t, _, key in packets:
+        if key:
+            keyframes.append([t, 0])
+        if keyframes:
+            keyframes[-1][1] += 1
+    if not keyframes:
+        return None
+    end = max(t + d for t, d, _ in packets)
+    return {"keyframes": [tuple(k) for k in keyframes], "duration": end}
+
+
+def _same_video(a: dict, b: dict):
+    if not a or not b:
+        return False
+    for key in ("codec_name", "profile", "width", "height", "pix_fmt"):
+        if a.get(key) != b.get(key):
+            return False
+    fa, fb = a.get("fps"), b.get("fps")
+    if fa is None or fb is None:
+        return False
+    # phones report 29.97 vs 30000/1001 style rates, allow tiny drift
+    return abs(float(fa) - float(fb)) < 0.01
+
+
+def _same_audio(a: dict, b: dict):
+    if not a or not b:
+        return False
+    return all(a.get(k) == b.get(k) for k in ("codec_name", "profile", "sample_rate", "channels"))
+
+
+def plan_concat(infos: list):
+    """
+    Decide how to join the probed inputs (list of media_info dicts).
+
+    Returns {"mode": ..., "reason": str} where mode is one of:
+      "copy"       -> all streams compatible, concat demuxer with -c copy
+      "copy_video" -> video compatible, audio differs; re-encode only the audio
+                      of each input, then concat demuxer with -c copy
+      "transcode"  -> filter_complex concat (full re-encode)
+    """
+    if not infos or any(i is None for i in infos):
+        return {"mode": "transcode", "reason": "probe failed"}
+    first = infos[0]
+    if not first["video"]:
+        return {"mode": "transcode", "reason": "no video stream"}
+    if not all(_same_video(first["video"], i["video"]) for i in infos[1:]):
+        return {"mode": "transcode", "reason": "video streams differ"}
+    has_audio = [bool(i["audio"]) for i in infos]
+    if not any(has_audio):
+        return {"mode": "copy", "reason": "video-only, streams match"}
+    if not all(has_audio):
+        return {"mode": "transcode", "reason": "some inputs have no audio"}
+    if all(_same_audio(first["audio"], i["audio"]) for i in infos[1:]):
+        return {"mode": "copy", "reason": "all streams match"}
+    return {"mode": "copy_video", "reason": "audio streams differ"}
+
+
+def plan_replace_audio(video_info: dict, audio_info: dict):
+    """
+    For /merge_va: the video stream is always copied, the audio is copied too
+    when its codec can live in an mp4. Returns {"audio_copy": bool, "reason": str}.
+    """
+    if not audio_info or not audio_info.get("audio"):
+        return {"audio_copy": False, "reason": "audio not probed"}
+    codec = audio_info["audio"].get("codec_name")
+    if codec in MP4_AUDIO_CODECS:
+        return {"audio_copy": True, "reason": f"{codec} fits mp4"}
+    return {"audio_copy": False, "reason": f"{codec} needs re-encode"}
+
+
+def predict_size(infos: list, sizes: list, mode: str, frame: tuple = None):
+    """
+    Expected output bytes of a concat, before running it.
+    Stream copy moves the inputs' bytes as they are, so it is their file sizes.
+    A re-encode is estimated from each input's probed bitrate x duration,
+    scaled by how much its picture grows or shrinks to the output frame.
+    """
+    if mode != "transcode":
+        return sum(sizes)
+    total = 0
+    for info, size in zip(infos, sizes):
+        dur = (info or {}).get("duration") or 0
+        rate = (info or {}).get("bit_rate") or (size * 8 / dur if dur else 0)
+        est = rate * dur / 8 if rate and dur else size
+        v = (info or {}).get("video") or {}
+        if frame and v.get("width") and v.get("height"):
+            est *= (frame[0] * frame[1]) / (v["width"] * v["height"])
+        total += est
+    return int(total)
+
+
+def fit_bitrate(duration: float, max_bytes: int, audio_bitrate: int = AUDIO_BITRATE):
+    """Video bitrate (bit/s) that keeps duration seconds plus audio under max_bytes; 0 if impossible."""
+    if duration <= 0:
+        return 0
+    budget = max_bytes * SPLIT_HEADROOM * 8 / duration
+    return max(0, int(budget - audio_bitrate))
+
+
+def min_video_bitrate(frame: tuple, fps: float):
+    """Lowest bitrate still worth encoding at frame=(w, h) and fps."""
+    w, h = frame
+    return int(w * h * (fps or 30) * MIN_BITS_PER_PIXEL)
+
+
+def split_parts(predicted: int, max_bytes: int):
+    """How many parts a predicted size needs to fit max_bytes each."""
+    return max(1, math.ceil(predicted / (max_bytes * SPLIT_HEADROOM)))
+
+
+def plan_output(infos: list, sizes: list, mode: str, max_bytes: int, frame: tuple = None, fps: float = None):
+    """
+    Decide how a concat result stays under max_bytes (Telegram's upload limit).
+    Returns {"predicted": bytes, "video_bitrate": bit/s or None, "segment_marks": [s, ...] or None, "reason": str}:
+      nothing set        -> predicted size fits
+      video_bitrate      -> re-encode capped to a bitrate that fits (only for transcode plans,
+                            and only if the picture stays above MIN_BITS_PER_PIXEL)
+      segment_marks      -> write numbered parts, cut at these times (see segment_marks)
+    Copy plans are always split rather than re-encoded: cutting is free, encoding isn't.
+    """
+    predicted = predict_size(infos, sizes, mode, frame)
+    res = {"predicted": predicted, "video_bitrate": None, "segment_marks": None, "reason": "fits"}
+    duration = sum((i or {}).get("duration") or 0 for i in infos)
+    if predicted <= max_bytes or duration <= 0:
+        return res
+    if mode == "transcode" and frame:
+        rate = fit_bitrate(duration, max_bytes)
+        if rate >= min_video_bitrate(frame, fps):
+            res.update(video_bitrate=rate, reason=f"capped at {rate // 1000} kb/s to fit")
+            return res
+    parts = split_parts(predicted, max_bytes)
+    res.update(segment_marks=segment_marks(duration, parts), reason=f"split into {parts} parts")
+    return res
+
+
+def job_timeout(duration: float, mode: str):
+    """Seconds an ffmpeg run over duration seconds of media may take (mode: copy / audio / transcode)."""
+    if not duration or duration <= 0:
+        return TIMEOUT_UNKNOWN
+    return int(TIMEOUT_BASE + duration * TIMEOUT_PER_SECOND[mode])
+
+
+def estimate_cost(duration: float, mode: str, frame: tuple = None, fps: float = None):
+    """Estimated cpu-seconds of processing duration seconds of media (mode: copy / audio / transcode)."""
+    cost = (duration or 0) * COST_PER_SECOND[mode]
+    if mode == "transcode" and frame:
+        cost *= frame[0] * frame[1] * (fps or 30) / COST_REFERENCE_PIXEL_RATE
+    return cost
+
+
+def output_frame(infos: list):
+    """(frame, fps) a re-encoded concat is made at: the first input's, or (None, None) if unknown."""
+    first = infos[0] if infos and infos[0] else None
+    if first and first["video"] and first["video"].get("width"):
+        return (first["video"]["width"], first["video"]["height"]), first["video"].get("fps")
+    return None, None
+
+
+def segment_length(duration: float, jobs: int):
+    """Target seconds per range so duration spreads over jobs encoders (clamped to SEGMENT_MIN/MAX_SECONDS)."""
+    return min(SEGMENT_MAX_SECONDS, max(SEGMENT_MIN_SECONDS, duration / max(1, jobs)))
+
+
+def plan_segments(index: dict, target: float):
+    """
+    Group one input's GOPs (keyframe_index) into ranges of about target seconds.
+    Ranges start on keyframes, so each one decodes from its own first frame and
+    nothing is decoded twice. Returns [(start seconds, input frames or None = to the end)].
+    """
+    ranges, start, frames = [], 0.0, 0
+    for i, (t, n) in enumerate(index["keyframes"]):
+        # no cut that would leave a tail much shorter than a range
+        if i and t - start >= target and index["duration"] - t >= target / 2:
+            ranges.append((start, frames))
+            start, frames = t, 0
+        frames += n
+    ranges.append((start, None))
+    return ranges
+
+
+def segment_marks(duration: float, parts: int):
+    """
+    Cut times that split duration into parts even shares: parts - 1 marks, so
+    the tail always stays in the last part. Each mark sits SEGMENT_MARK_LEAD
+    before its even share: the muxer cuts at the first keyframe at/after a
+    mark and one sitting right on it (e.g. where two clips were joined) can
+    otherwise be skipped for the next one.
+    """
+    share = duration / parts
+    return [max(0.0, share * i - SEGMENT_MARK_LEAD) for i in range(1, parts)]
+
+
+def part_pattern(out: str):
+    """segment muxer pattern for out: x.mp4 -> x.part%03d.mp4"""
+    stem, ext = os.path.splitext(out)
+    return f"{stem}.part%03d{ext}"
+
+
+def part_files(out: str):
+    """The parts written for out by a split (empty if it wasn't split)."""
+    stem, ext = os.path.splitext(out)
+    return sorted(glob.glob(glob.escape(stem) + ".part[0-9][0-9][0-9]" + ext))
+
+
+def segment_args(out: str, marks: list):
+    """Output options that write out as numbered parts cut at the first keyframe at/after each mark."""
+    return (
+        f"-f segment -segment_times {','.join(f'{t:.3f}' for t in marks)} -reset_timestamps 1 "
+        f"-segment_format mp4 -segment_format_options movflags=+faststart "
+        f"{shlex.quote(part_pattern(out))}"
+    )
+
+
+def _output(out: str, segment_marks: list = None):
+    if segment_marks:
+        return segment_args(out, segment_marks)
+    return f"-movflags +faststart {shlex.quote(out)}"
+
+
+def split_cmd(src: str, out: str, marks: list):
+    """Cut an existing file into parts at keyframes without re-encoding."""
+    return f"ffmpeg -y -i {shlex.quote(src)} -map 0 -c copy {segment_args(out, marks)}"
+
+
+def plan_audio_concat(infos: list, normalize: bool = False):
+    """
+    For /merge_aa concat (one track after the other).
+    Returns {"copy": bool, "ext": "mp3" / "m4a", "reason": str}: copy when all
+    inputs share codec, profile, sample rate and channels, the codec can be
+    written as-is and no loudness normalisation (a filter) was asked for.
+    """
+    if not infos or any(not i or not i.get("audio") for i in infos):
+        return {"copy": False, "ext": "mp3", "reason": "probe failed"}
+    first = infos[0]["audio"]
+    codec = first.get("codec_name")
+    if normalize:
+        return {"copy": False, "ext": "mp3", "reason": "loudness normalisation"}
+    if codec not in AUDIO_COPY_EXT:
+        return {"copy": False, "ext": "mp3", "reason": f"{codec} is re-encoded"}
+    if not all(_same_audio(first, i["audio"]) for i in infos[1:]):
+        return {"copy": False, "ext": "mp3", "reason": "audio streams differ"}
+    return {"copy": True, "ext": AUDIO_COPY_EXT[codec], "reason": f"all {codec}, same parameters"}
+
+
+def write_concat_list(paths: list, list_path: str):
+    """Write a concat demuxer list file for paths."""
+    with open(list_path, "w", encoding="utf-8") as f:
+        for p in paths:
+            # concat list quoting: ' -> '\''
+            escaped = os.path.abspath(p).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    return list_path
+
+
+def concat_copy_cmd(list_path: str, out: str, segment_marks: list = None):
+    """concat demuxer + stream copy; with segment_marks the result is written as parts instead."""
+    return (
+        f"ffmpeg -y -f concat -safe 0 -i {shlex.quote(list_path)} "
+        f"-map 0:v:0 -map 0:a:0? -c copy {_output(out, segment_marks)}"
+    )
+
+
+def normalize_audio_cmd(src: str, out: str):
+    """Copy the video of src, re-encode its audio to AUDIO_TARGET (for copy_video plans)."""
+    t = AUDIO_TARGET
+    return (
+        f"ffmpeg -y -i {shlex.quote(src)} -map 0:v:0 -map 0:a:0 -c:v copy "
+        f"-c:a {t['codec_name']} -ar {t['sample_rate']} -ac {t['channels']} "
+        f"-movflags +faststart {shlex.quote(out)}"
+    )
+
+
+def concat_transcode_cmd(paths: list, out: str, preset: str = "veryfast", size: tuple = None, fps: float = None,
+                         video_bitrate: int = None, segment_marks: list = None):
+    """
+    filter_complex concat over all paths (full re-encode).
+    With size=(w, h) every input is scaled/padded to that frame first, so clips
+    shot at different resolutions can still be joined. fps resamples every
+    input to one frame rate; without it, mixed-rate inputs make the muxer
+    duplicate frames and the encode crawls.
+    video_bitrate caps the encode (to fit an upload limit); segment_marks
+    writes numbered parts, with keyframes forced close to every mark.
+    """
+    inputs = " ".join(f"-i {shlex.quote(p)}" for p in paths)
+    chains, labels = [], ""
+    for i in range(len(paths)):
+        filters = _frame_filters(size, fps)
+        if filters:
+            chains.append(f"[{i}:v:0]{','.join(filters)}[v{i}]")
+            labels += f"[v{i}][{i}:a:0]"
+        else:
+            labels += f"[{i}:v:0][{i}:a:0]"
+    graph = ";".join(chains + [f"{labels}concat=n={len(paths)}:v=1:a=1[outv][outa]"])
+    # keyframes on every cut mark, plus in between so a part that comes out
+    # bigger than predicted can still be re-cut without re-encoding
+    rate = _rate_args(video_bitrate, keyframe_spacing(segment_marks))
+    return (
+        f"ffmpeg -y {inputs} "
+        f"-filter_complex \"{graph}\" "
+        f"-map \"[outv]\" -map \"[outa]\" -preset {preset} {rate}{_output(out, segment_marks)}"
+    )
+
+
+def _frame_filters(size: tuple = None, fps: float = None):
+    """Scale/pad to size=(w, h) and resample to fps (see concat_transcode_cmd)."""
+    filters = []
+    if size:
+        w, h = size
+        filters.append(f"scale={w}:{h}:force_original_aspect_ratio=decrease,pad={w}:{h}:(ow-iw)/2:(oh-ih)/2,setsar=1")
+    if fps:
+        filters.append(f"fps={fps:g}")
+    return filters
+
+
+def keyframe_spacing(segment_marks: list = None):
+    """Forced-keyframe interval (s) for an encode that is cut at segment_marks: a quarter part, or None."""
+    if not segment_marks:
+        return None
+    return (segment_marks[0] + SEGMENT_MARK_LEAD) / 4
+
+
+def _rate_args(video_bitrate: int = None, keyframe_every: float = None):
+    rate = ""
+    if video_bitrate:
+        rate = f"-b:v {video_bitrate} -maxrate {int(video_bitrate * 1.2)} -bufsize {video_bitrate * 2} "
+    if keyframe_every:
+        rate += f"-force_key_frames \"expr:gte(t,n_forced*{keyframe_every:.3f})\" "
+    return rate
+
+
+def segment_encode_cmd(src: str, out: str, start: float = 0.0, frames: int = None, size: tuple = None,
+                       fps: float = None, preset: str = "veryfast", video_bitrate: int = None,
+                       keyframe_every: float = None, threads: int = None):
+    """
+    Video only of one range of src for the parallel encode (plan_segments):
+    from the keyframe at start for frames input frames (None = to the end).
+    The seek is not accurate on purpose: ffmpeg starts decoding at that
+    keyframe and keeps it. Every range gets the same filters and encoder
+    settings, so concat_segments_cmd can join them with stream copy.
+    """
+    # just past the keyframe, so a rounded pts_time can't land on the one before it
+    seek = f"-noaccurate_seek -ss {start + 0.0005:.6f} " if start > 0 else ""
+    filters = [f"trim=end_frame={frames}"] if frames else []
+    filters += ["setpts=PTS-STARTPTS"] + _frame_filters(size, fps) + ["format=yuv420p"]
+    threads = f"-threads {threads} " if threads else ""
+    return (
+        f"ffmpeg -y {seek}-i {shlex.quote(src)} -map 0:v:0 -an "
+        f"-vf \"{','.join(filters)}\" -c:v libx264 -preset {preset} {threads}"
+        f"{_rate_args(video_bitrate, keyframe_every)}{shlex.quote(out)}"
+    )
+
+
+def concat_audio_track_cmd(paths: list, durations: list, out: str):
+    """
+    The audio of all paths joined into one aac track (the parallel encode's
+    audio, done in one pass: cheap next to the video, and no encoder priming
+    gaps at the range joins). Each input's audio is padded / cut to that
+    input's video duration so it stays in step with the video.
+    """
+    inputs = " ".join(f"-i {shlex.quote(p)}" for p in paths)
+    chains = [f"[{i}:a:0]apad,atrim=0:{d:.6f},asetpts=PTS-STARTPTS[a{i}]" for i, d in enumerate(durations)]
+    labels = "".join(f"[a{i}]" for i in range(len(paths)))
+    graph = ";".join(chains + [f"{labels}concat=n={len(paths)}:v=0:a=1[outa]"])
+    return (
+        f"ffmpeg -y {inputs} -filter_complex \"{graph}\" -map \"[outa]\" "
+        f"-c:a {AUDIO_TARGET['codec_name']} -ar {AUDIO_TARGET['sample_rate']} -ac {AUDIO_TARGET['channels']} "
+        f"{shlex.quote(out)}"
+    )
+
+
+def concat_segments_cmd(list_path: str, audio: str, out: str, segment_marks: list = None):
+    """Stitch the encoded video ranges (concat demuxer) with the audio track, all stream copy."""
+    return (
+        f"ffmpeg -y -f concat -safe 0 -i {shlex.quote(list_path)} -i {shlex.quote(audio)} "
+        f"-map 0:v:0 -map 1:a:0 -c copy {_output(out, segment_marks)}"
+    )
+
+
+def preview_frame(frame: tuple = None, height: int = PREVIEW_HEIGHT):
+    """The preview's (w, h): frame scaled down to height (never up), even sizes."""
+    if not frame:
+        return 426, height
+    w, h = frame
+    height = min(height, h)
+    return max(2, round(w * height / h / 2) * 2), height - height % 2
+
+
+def preview_cmd(paths: list, durations: list, out: str, frame: tuple = None, audio: bool = True,
+                seconds: float = PREVIEW_SECONDS):
+    """
+    Low-resolution look at the joins of a concat: the last `seconds` of the
+    first input, then the first `seconds` of every following one, scaled to
+    preview_frame(frame) at PREVIEW_FPS and encoded ultrafast at a low quality.
+    audio=False when an input has no audio track (the preview is then silent).
+    """
+    inputs = []
+    for i, (p, d) in enumerate(zip(paths, durations)):
+        start = max(0.0, (d or 0) - seconds) if i == 0 else 0.0
+        seek = f"-ss {start:.3f} " if start else ""
+        inputs.append(f"{seek}-t {seconds:g} -i {shlex.quote(p)}")
+    chains, labels = [], ""
+    for i in range(len(paths)):
+        filters = _frame_filters(preview_frame(frame), PREVIEW_FPS)
+        chains.append(f"[{i}:v:0]{','.join(filters)},setpts=PTS-STARTPTS[v{i}]")
+        labels += f"[v{i}]"
+        if audio:
+            chains.append(f"[{i}:a:0]aformat=sample_rates=44100:channel_layouts=mono,asetpts=PTS-STARTPTS[a{i}]")
+            labels += f"[a{i}]"
+    graph = ";".join(chains + [f"{labels}concat=n={len(paths)}:v=1:a={int(audio)}[outv]" + ("[outa]" if audio else "")])
+    maps = "-map \"[outv]\" " + ("-map \"[outa]\" -c:a aac -b:a 48k " if audio else "-an ")
+    return (
+        f"ffmpeg -y {' '.join(inputs)} -filter_complex \"{graph}\" {maps}"
+        f"-c:v libx264 -preset ultrafast -crf 34 -pix_fmt yuv420p -movflags +faststart {shlex.quote(out)}"
+    )
+
+
+def thumbnail_cmd(src: str, out: str, quality: int = 3, max_side: int = 320):
+    """Shrink an image to fit max_side x max_side and write it as JPEG (quality 2 = best .. 31 = worst)."""
+    scale = f"scale='min({max_side},iw)':'min({max_side},ih)':force_original_aspect_ratio=decrease"
+    return f"ffmpeg -y -i {shlex.quote(src)} -vf \"{scale}\" -frames:v 1 -q:v {quality} {shlex.quote(out)}"
+
+
+def amix_cmd(paths: list, out: str, normalize: bool = False):
+    """Mix all paths into one mp3 track with amix (+ loudnorm in the same pass)."""
+    inputs = " ".join(f"-i {shlex.quote(p)}" for p in paths)
+    graph = f"amix=inputs={len(paths)}:duration=longest:dropout_transition=2"
+    if normalize:
+        graph += "," + LOUDNORM
+    return (
+        f"ffmpeg -y {inputs} "
+        f"-filter_complex \"{graph}\" "
+        f"-c:a libmp3lame -q:a 4 {shlex.quote(out)}"
+    )
+
+
+def audio_concat_copy_cmd(list_path: str, out: str):
+    """Audio tracks one after the other, stream copy (see plan_audio_concat)."""
+    faststart = "-movflags +faststart " if out.endswith(".m4a") else ""
+    return (
+        f"ffmpeg -y -f concat -safe 0 -i {shlex.quote(list_path)} "
+        f"-map 0:a:0 -c copy {faststart}{shlex.quote(out)}"
+    )
+
+
+def audio_concat_cmd(paths: list, out: str, normalize: bool = False):
+    """Audio tracks one after the other, re-encoded for out's file type (+ loudnorm in the same pass)."""
+    inputs = " ".join(f"-i {shlex.quote(p)}" for p in paths)
+    labels = "".join(f"[{i}:a:0]" for i in range(len(paths)))
+    graph = f"{labels}concat=n={len(paths)}:v=0:a=1"
+    if normalize:
+        graph += "," + LOUDNORM
+    ext = os.path.splitext(out)[1].lstrip(".")
+    return (
+        f"ffmpeg -y {inputs} "
+        f"-filter_complex \"{graph}[outa]\" -map \"[outa]\" "
+        f"{AUDIO_ENCODERS.get(ext, AUDIO_ENCODERS['mp3'])} {shlex.quote(out)}"
+    )
+
+
+def replace_audio_cmd(video: str, audio: str, out: str, audio_copy: bool = False):
+    acodec = "-c:a copy " if audio_copy else ""
+    return (
+        f"ffmpeg -y -i {shlex.quote(video)} -i {shlex.quote(audio)} "
+        f"-c:v copy {acodec}-map 0:v:0 -map 1:a:0 -shortest {shlex.quote(out)}"
+    )
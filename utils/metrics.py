@@ -0,0 +1,116 @@
+"""
+Per-stage timing histograms and a small Prometheus-style /metrics endpoint.
+
+Handlers wrap each stage of a job (queue wait, download, probe, ffmpeg,
+upload) in `metrics.timer(stage)`; the seconds land in one histogram per
+stage. Point-in-time values (queue depth, running ffmpeg processes, tmp
+bytes) are registered as gauges with a callback and read at scrape time.
+
+serve() starts an aiohttp server on the running event loop, so it shares the
+loop with the bot instead of needing a thread or another process.
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# seconds; covers a cached probe (ms) up to a long re-encode (30 min)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)  # per bucket, not cumulative
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, le in enumerate(self.buckets):
+            if value <= le:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        """[(le, count <= le), ...] ending with +Inf."""
+        out, running = [], 0
+        for le, n in zip(self.buckets, self.counts):
+            running += n
+            out.append((le, running))
+        out.append(("+Inf", self.count))
+        return out
+
+
+class Metrics:
+    def __init__(self, prefix: str = "mergebot"):
+        self.prefix = prefix
+        self.stages = {}  # stage -> Histogram
+        self.failures = {}  # stage -> count of timed blocks that raised
+        self.gauges = {}  # name -> (help, callback)
+
+    def observe(self, stage: str, seconds: float):
+        hist = self.stages.get(stage)
+        if hist is None:
+            hist = self.stages[stage] = Histogram()
+        hist.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Time the with-block into the stage's histogram (also when it raises)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.failures[stage] = self.failures.get(stage, 0) + 1
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def gauge(self, name: str, help_text: str, callback):
+        self.gauges[name] = (help_text, callback)
+
+    def render(self):
+        """Prometheus text exposition format."""
+        p = self.prefix
+        lines = [
+            f"# HELP {p}_stage_seconds Time spent per job stage.",
+            f"# TYPE {p}_stage_seconds histogram",
+        ]
+        for stage, hist in sorted(self.stages.items()):
+            for le, n in hist.cumulative():
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {n}')
+            lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {hist.sum:.6f}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+        lines.append(f"# HELP {p}_stage_failures_total Timed stages that raised.")
+        lines.append(f"# TYPE {p}_stage_failures_total counter")
+        for stage, n in sorted(self.failures.items()):
+            lines.append(f'{p}_stage_failures_total{{stage="{stage}"}} {n}')
+        for name, (help_text, callback) in sorted(self.gauges.items()):
+            try:
+                value = callback()
+            except Exception:
+                log.exception("metrics gauge %s failed", name)
+                continue
+            lines.append(f"# HELP {p}_{name} {help_text}")
+            lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int):
+        """Serve GET /metrics on the current loop. Returns the aiohttp runner (call .cleanup() to stop)."""
+        from aiohttp import web
+
+        async def handle(_request):
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        web_app = web.Application()
+        web_app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(web_app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        log.info("metrics on http://%s:%d/metrics", host, port)
+        return runner
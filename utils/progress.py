@@ -0,0 +1,175 @@
+"""
+ffmpeg progress parsing and rate-limited status message updates.
+
+run_cmd adds `-progress pipe:1` to ffmpeg commands when a ProgressReporter is
+given and feeds every stdout line into it. The reporter turns `out_time_us`
+into percent / ETA against the probed duration and edits one Telegram status
+message at most once per `interval` seconds, backing off on flood waits.
+"""
+
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "8"))
+
+
+def fmt_seconds(sec: float):
+    sec = max(0, int(sec))
+    h, rem = divmod(sec, 3600)
+    m, s = divmod(rem, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m:02d}:{s:02d}"
+
+
+def progress_bar(fraction: float, width: int = 12):
+    filled = int(round(max(0.0, min(1.0, fraction)) * width))
+    return "█" * filled + "░" * (width - filled)
+
+
+class ProgressReporter:
+    """
+    Collects `key=value` lines from ffmpeg's -progress output and edits
+    `message` with percent / speed / ETA.
+    """
+
+    def __init__(self, message, label: str = "Processing", total: float = 0.0, interval: float = None):
+        self.message = message
+        self.label = label
+        self.total = total or 0.0
+        self.interval = PROGRESS_INTERVAL if interval is None else interval
+        self.out_time = 0.0
+        self.speed = None
+        self._block = {}
+        self._started = time.monotonic()
+        self._next_edit = 0.0
+        self._last_text = None
+
+    def set_total(self, seconds: float):
+        if seconds and seconds > 0:
+            self.total = float(seconds)
+
+    async def feed_line(self, line: str):
+        """Feed one stdout line; a `progress=` line closes a block and may trigger an edit."""
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            return False
+        self._block[key] = value
+        if key != "progress":
+            return True
+        block, self._block = self._block, {}
+        # out_time_ms is microseconds too (historic ffmpeg naming)
+        us = block.get("out_time_us") or block.get("out_time_ms")
+        try:
+            self.out_time = max(self.out_time, int(us) / 1_000_000)
+        except (TypeError, ValueError):
+            pass
+        speed = (block.get("speed") or "").rstrip("x").strip()
+        try:
+            self.speed = float(speed)
+        except ValueError:
+            pass
+        if value != "end":
+            await self.update()
+        return True
+
+    def render(self):
+        elapsed = time.monotonic() - self._started
+        lines = [f"⚙️ {self.label}..."]
+        if self.total:
+            frac = min(self.out_time / self.total, 0.999)
+            lines.append(f"{progress_bar(frac)} {frac * 100:.1f}%")
+            if self.out_time > 0 and elapsed > 0:
+                rate = self.out_time / elapsed
+                lines.append(f"ETA {fmt_seconds((self.total - self.out_time) / rate)}")
+        else:
+            lines.append(f"{fmt_seconds(self.out_time)} processed")
+        if self.speed:
+            lines.append(f"speed {self.speed:.2f}x")
+        return "\n".join(lines)
+
+    async def update(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now < self._next_edit:
+            return
+        self._next_edit = now + self.interval
+        await self._edit(self.render())
+
+    async def done(self, text: str):
+        """Final edit (ignores the interval, still respects a pending flood wait)."""
+        if time.monotonic() < self._next_edit - self.interval:
+            return
+        await self._edit(text)
+
+    async def _edit(self, text: str):
+        if text == self._last_text or self.message is None:
+            return
+        try:
+            await self.message.edit_text(text)
+            self._last_text = text
+        except Exception as e:
+            # pyrogram's FloodWait carries the wait in seconds as .value
+            wait = getattr(e, "value", None)
+            if isinstance(wait, (int, float)):
+                self._next_edit = time.monotonic() + wait + self.interval
+            log.debug("progress edit failed: %s", e)
+
+
+class CombinedProgress:
+    """
+    Adds up the -progress output of several ffmpeg processes running side by
+    side (the ranges of a parallel encode) and feeds the sum into one
+    reporter (ProgressReporter or ProgressRelay), as if a single ffmpeg was
+    running. Each process gets its own part(): run_cmd(..., progress=combined.part(i)).
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self._done = {}  # part key -> seconds encoded
+        self._speed = {}  # part key -> speed, dropped once the part ends
+
+    def set_total(self, seconds: float):
+        self.target.set_total(seconds)
+
+    def part(self, key):
+        return _Part(self, key)
+
+    async def _update(self, key, seconds: float, speed, ended: bool):
+        self._done[key] = seconds
+        if ended:
+            self._speed.pop(key, None)
+        elif speed is not None:
+            self._speed[key] = speed
+        await self.target.feed_line(f"out_time_us={int(sum(self._done.values()) * 1_000_000)}")
+        await self.target.feed_line(f"speed={sum(self._speed.values()):.2f}x")
+        await self.target.feed_line("progress=continue")
+
+
+class _Part:
+    def __init__(self, combined: CombinedProgress, key):
+        self.combined = combined
+        self.key = key
+        self._block = {}
+
+    def set_total(self, seconds: float):
+        pass
+
+    async def feed_line(self, line: str):
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            return False
+        self._block[key] = value
+        if key != "progress":
+            return True
+        block, self._block = self._block, {}
+        try:
+            seconds = int(block.get("out_time_us") or block.get("out_time_ms")) / 1_000_000
+        except (TypeError, ValueError):
+            return True
+        try:
+            speed = float((block.get("speed") or "").rstrip("x").strip())
+        except ValueError:
+            speed = None
+        await self.combined._update(self.key, max(0.0, seconds), speed, value == "end")
+        return True
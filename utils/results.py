@@ -0,0 +1,100 @@
+"""
+Result cache: identical merge requests are answered with the already
+uploaded output instead of being downloaded, encoded and uploaded again.
+
+The key is the action plus the inputs' file_unique_ids (in order) plus the
+settings that end up baked into the uploaded file (the thumbnail). The
+caption is not part of it: it is sent fresh with every reply. The value is
+the Telegram file_id(s) of the sent result (several for a result that went
+out in parts), which any chat can re-send instantly.
+
+Entries live in SQLite, bounded by count (least recently used go first) and
+by age.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key       TEXT PRIMARY KEY,
+    kind      TEXT NOT NULL,      -- video / audio
+    file_ids  TEXT NOT NULL,      -- json list, in part order
+    created   REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits      INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS results_last_used ON results(last_used);
+"""
+
+
+def result_key(action: str, input_uids: list, *settings):
+    """Stable key for an action over inputs (file_unique_ids) with the given settings."""
+    raw = json.dumps([action, list(input_uids), [s or "" for s in settings]])
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, db_path: str, max_entries: int, max_age: float):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(db_path)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key: str):
+        """{"kind", "file_ids"} for key, or None. Counts as a use for the LRU order."""
+        if not self.enabled:
+            return None
+        row = self._db.execute(
+            "SELECT kind, file_ids, created FROM results WHERE key = ?", (key,),
+        ).fetchone()
+        now = time.time()
+        if row is None or now - row[2] > self.max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute("UPDATE results SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        self._db.commit()
+        return {"kind": row[0], "file_ids": json.loads(row[1])}
+
+    def put(self, key: str, kind: str, file_ids: list):
+        if not self.enabled or not file_ids:
+            return
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO results (key, kind, file_ids, created, last_used) VALUES (?, ?, ?, ?, ?)",
+            (key, kind, json.dumps(file_ids), now, now),
+        )
+        self._evict(now)
+        self._db.commit()
+
+    def forget(self, key: str):
+        """Drop an entry whose file_id Telegram no longer accepts."""
+        self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+        self._db.commit()
+
+    def _evict(self, now: float):
+        self._db.execute("DELETE FROM results WHERE created < ?", (now - self.max_age,))
+        (count,) = self._db.execute("SELECT COUNT(*) FROM results").fetchone()
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            log.info("result cache evicted %d entries", count - self.max_entries)
+
+    def stats(self):
+        (count,) = self._db.execute("SELECT COUNT(*) FROM results").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count, "max_entries": self.max_entries}
@@ -0,0 +1,192 @@
+"""
+Bounded job scheduler for ffmpeg work.
+
+Handlers submit a coroutine factory; a fixed pool of worker tasks runs at most
+`slots` of them at once. Jobs are ordered by lane (Pro before Free, HTTP API
+batches last), so the "faster queue" in the plan menu is real, and within a
+lane by arrival pushed back by the job's estimated cost (COST_WEIGHT): small
+merges overtake big ones that arrived shortly before them, but a big job is
+never starved.
+A single owner gets at most `per_owner` slots at once; their other jobs wait
+while everyone else's run.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+# lanes, lower runs first
+PRIORITY_PRO = 0
+PRIORITY_FREE = 1
+PRIORITY_BATCH = 2  # HTTP API batches: only what chat users leave free
+
+# queue order: a job sorts as if it had arrived this many seconds later per
+# estimated cpu-second (ffmpeg_tools.estimate_cost)
+COST_WEIGHT = 0.2
+
+
+def default_per_owner():
+    """USER_MAX_RUNNING env var: slots one user's jobs may hold at once (0 = no limit)."""
+    try:
+        return max(0, int(os.environ.get("USER_MAX_RUNNING", "1")))
+    except ValueError:
+        return 1
+
+
+def default_slots():
+    """FFMPEG_SLOTS env var, else the number of cores."""
+    try:
+        slots = int(os.environ.get("FFMPEG_SLOTS", "0"))
+    except ValueError:
+        slots = 0
+    return slots if slots > 0 else (os.cpu_count() or 1)
+
+
+class Job:
+    def __init__(self, job_id: int, owner, priority: int, factory, label: str = "", cost: float = 0.0):
+        self.id = job_id
+        self.owner = owner
+        self.priority = priority
+        self.factory = factory
+        self.label = label
+        self.cost = cost
+        self.future = asyncio.get_running_loop().create_future()
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def key(self):
+        return (self.priority, self.created + self.cost * COST_WEIGHT, self.id)
+
+
+class JobHandle:
+    """
+    What /cancel needs to stop one job. The job's coroutine runs as its own
+    task through run(); cancel() drops it from the queue if it hasn't started,
+    or cancels that task, and run_cmd kills the ffmpeg process group it is
+    waiting on. run() then returns CANCELLED right away, so the slot frees up.
+    """
+
+    CANCELLED = (-1, "", "Cancelled.")
+
+    def __init__(self, owner=None, label: str = ""):
+        self.owner = owner
+        self.label = label
+        self.cancelled = False
+        self.job = None  # the scheduler Job, for jobs queued locally
+        self._task = None
+
+    async def run(self, coro):
+        if self.cancelled:
+            coro.close()
+            return self.CANCELLED
+        self._task = asyncio.ensure_future(coro)
+        try:
+            return await self._task
+        except asyncio.CancelledError:
+            # our own cancel(); anything else (shutdown) keeps propagating
+            if self.cancelled and self._task.cancelled():
+                return self.CANCELLED
+            raise
+
+    def cancel(self):
+        self.cancelled = True
+        if self.job is not None and self.job.started is None:
+            self.job.future.cancel()
+        if self._task is not None:
+            self._task.cancel()
+
+
+class JobScheduler:
+    def __init__(self, slots: int = None, per_owner: int = None):
+        self.slots = slots or default_slots()
+        self.per_owner = default_per_owner() if per_owner is None else per_owner
+        self._queue = None
+        self._workers = []
+        self._waiting = set()
+        self._running = set()
+        self._held = {}  # owner -> jobs taken off the queue while the owner was at per_owner
+        self._ids = itertools.count(1)
+
+    def _ensure_started(self):
+        # started lazily so the queue binds to the loop pyrogram runs on
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+            for i in range(self.slots):
+                self._workers.append(asyncio.create_task(self._worker(i)))
+            log.info("Scheduler started with %d ffmpeg slots", self.slots)
+
+    async def _worker(self, n: int):
+        while True:
+            _, job = await self._queue.get()
+            if job.future.cancelled():
+                self._waiting.discard(job)
+                self._queue.task_done()
+                continue
+            if self.owner_full(job.owner):
+                # back in line once one of the owner's running jobs ends
+                self._held.setdefault(job.owner, []).append(job)
+                self._queue.task_done()
+                continue
+            self._waiting.discard(job)
+            self._running.add(job)
+            job.started = time.time()
+            try:
+                result = await job.factory()
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                log.exception("job %s (%s) failed", job.id, job.label)
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                job.finished = time.time()
+                self._running.discard(job)
+                held = self._held.get(job.owner)
+                if held:
+                    nxt = min(held, key=Job.key)
+                    held.remove(nxt)
+                    if not held:
+                        del self._held[job.owner]
+                    self._queue.put_nowait((nxt.key(), nxt))
+                self._queue.task_done()
+
+    def owner_full(self, owner):
+        if not self.per_owner or owner is None:
+            return False
+        return sum(1 for j in self._running if j.owner == owner) >= self.per_owner
+
+    def submit(self, factory, owner=None, priority: int = PRIORITY_FREE, label: str = "", cost: float = 0.0):
+        """
+        Queue factory (a zero-arg callable returning a coroutine); cost is the
+        job's estimated cpu-seconds and only affects its place in line.
+        Returns (job, position) where position 1 means it starts as soon as a slot frees up.
+        Await job.future for the factory's result.
+        """
+        self._ensure_started()
+        job = Job(next(self._ids), owner, priority, factory, label, cost)
+        self._waiting.add(job)
+        # a job cancelled while queued stops counting right away, not when a worker pops it
+        job.future.add_done_callback(lambda f: f.cancelled() and self._waiting.discard(job))
+        self._queue.put_nowait((job.key(), job))
+        return job, self.position(job)
+
+    def position(self, job: Job):
+        """1-based place in line (0 once the job is running or done)."""
+        if job not in self._waiting:
+            return 0
+        return sum(1 for j in self._waiting if j.key() <= job.key())
+
+    def queue_depth(self):
+        return len(self._waiting)
+
+    def active(self):
+        return len(self._running)
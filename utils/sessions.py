@@ -0,0 +1,118 @@
+"""
+SQLite-backed store for the per-chat pending state (`pending` in bot.py).
+
+It keeps the dict-style interface bot.py already used (get / [] / in / pop),
+with an in-memory copy of every live state so handlers keep working on the
+same dict object, and writes every change through to SQLite so sessions
+survive a restart. Every state gets an expiry from SESSION_TTLS based on its
+action; expire() removes and returns the stale ones so the caller can delete
+their files.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+# seconds a pending state may sit idle, per action
+DEFAULT_TTL = int(os.environ.get("SESSION_TTL", "3600"))
+SESSION_TTLS = {
+    "set_thumb": 600,
+    "set_meta": 600,
+    "merge_vv_wait_second": DEFAULT_TTL,
+    # the preview job (queue wait + encode) must finish before its files are swept
+    "merge_vv_previewing": 2 * DEFAULT_TTL,
+    "merge_vv_confirm": DEFAULT_TTL,
+    "merge_aa_wait_second": DEFAULT_TTL,
+    "merge_va_wait_audio": DEFAULT_TTL,
+    "session_collect": 2 * DEFAULT_TTL,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    chat_id INTEGER PRIMARY KEY,
+    owner   INTEGER,
+    action  TEXT,
+    state   TEXT NOT NULL,
+    updated REAL NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions(expires);
+"""
+
+
+def ttl_for(action: str):
+    return SESSION_TTLS.get(action, DEFAULT_TTL)
+
+
+class SessionStore:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self._live = {}  # chat_id -> state dict (same object handlers mutate)
+        for chat_id, raw in self._db.execute("SELECT chat_id, state FROM sessions"):
+            try:
+                self._live[chat_id] = json.loads(raw)
+            except ValueError:
+                log.warning("dropping unreadable session for chat %s", chat_id)
+                self._db.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+        self._db.commit()
+
+    # dict-style access used by the handlers
+    def get(self, chat_id, default=None):
+        return self._live.get(chat_id, default)
+
+    def __getitem__(self, chat_id):
+        return self._live[chat_id]
+
+    def __contains__(self, chat_id):
+        return chat_id in self._live
+
+    def __setitem__(self, chat_id, state: dict):
+        self._live[chat_id] = state
+        self.save(chat_id)
+
+    def __len__(self):
+        return len(self._live)
+
+    def pop(self, chat_id, default=None):
+        state = self._live.pop(chat_id, default)
+        self._db.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+        self._db.commit()
+        return state
+
+    def save(self, chat_id):
+        """Write the live state of chat_id through to SQLite and push its expiry out."""
+        state = self._live.get(chat_id)
+        if state is None:
+            return
+        now = time.time()
+        action = state.get("action")
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions (chat_id, owner, action, state, updated, expires) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (chat_id, state.get("owner"), action, json.dumps(state), now, now + ttl_for(action)),
+        )
+        self._db.commit()
+
+    def items(self):
+        return list(self._live.items())
+
+    def expire(self, now: float = None):
+        """Remove sessions past their expiry; returns [(chat_id, state), ...]."""
+        now = now or time.time()
+        rows = self._db.execute("SELECT chat_id FROM sessions WHERE expires <= ?", (now,)).fetchall()
+        expired = []
+        for (chat_id,) in rows:
+            state = self._live.pop(chat_id, None)
+            if state is not None:
+                expired.append((chat_id, state))
+        if rows:
+            self._db.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+            self._db.commit()
+        return expired
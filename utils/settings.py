@@ -0,0 +1,139 @@
+"""
+Per-user settings: result title / caption and custom thumbnail.
+
+Every user's settings are read from SQLite once and then served from memory;
+changes are written through right away. Thumbnails are stored already
+converted to what Telegram accepts for a video thumb (JPEG, <= 320px per
+side, < 200 KB, see ffmpeg_tools.thumbnail_cmd), one file per user; the bytes
+of the THUMB_CACHE_SIZE most recently used ones are kept in memory.
+
+Telegram can't reuse a thumbnail by file_id (it has to be uploaded with each
+video), so what we keep is the file_id of the photo the user sent: it is used
+to show the thumbnail and to fetch it again if the JPEG is gone (e.g. after a
+dyno restart wiped the disk but the database survived).
+"""
+
+import collections
+import logging
+import os
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+THUMB_MAX_SIDE = 320
+THUMB_MAX_BYTES = 200 * 1024
+THUMB_CACHE_SIZE = 64  # thumbnails kept in memory, at most ~12 MB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_settings (
+    user_id       INTEGER PRIMARY KEY,
+    title         TEXT,
+    caption       TEXT,
+    thumb_file_id TEXT,
+    updated       REAL NOT NULL
+);
+"""
+
+FIELDS = ("title", "caption", "thumb_file_id")
+
+
+class SettingsStore:
+    def __init__(self, db_path: str, thumbs_dir: str):
+        self.db_path = db_path
+        self.thumbs_dir = thumbs_dir
+        os.makedirs(thumbs_dir, exist_ok=True)
+        self._db = sqlite3.connect(db_path)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self._cache = {}  # user_id -> settings dict
+        self._thumbs = collections.OrderedDict()  # user_id -> jpeg bytes or None, least recently used first
+
+    def get(self, user_id: int):
+        """The user's settings dict ({"title", "caption", "thumb_file_id"}, values may be None)."""
+        s = self._cache.get(user_id)
+        if s is None:
+            row = self._db.execute(
+                "SELECT title, caption, thumb_file_id FROM user_settings WHERE user_id = ?", (user_id,),
+            ).fetchone()
+            s = dict(zip(FIELDS, row or (None, None, None)))
+            self._cache[user_id] = s
+        return s
+
+    def update(self, user_id: int, **changes):
+        s = dict(self.get(user_id))
+        s.update(changes)
+        self._db.execute(
+            "INSERT OR REPLACE INTO user_settings (user_id, title, caption, thumb_file_id, updated) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id, s["title"], s["caption"], s["thumb_file_id"], time.time()),
+        )
+        self._db.commit()
+        self._cache[user_id] = s
+        return s
+
+    # ---- title / caption ----
+    def meta(self, user_id: int):
+        """{"title", "caption"} or None when nothing is set (same shape the old meta.json had)."""
+        s = self.get(user_id)
+        if not s["title"] and not s["caption"]:
+            return None
+        return {"title": s["title"] or "", "caption": s["caption"] or ""}
+
+    def set_meta(self, user_id: int, title: str, caption: str):
+        self.update(user_id, title=title, caption=caption)
+
+    def clear_meta(self, user_id: int):
+        """Returns False if there was nothing to clear."""
+        if self.meta(user_id) is None:
+            return False
+        self.update(user_id, title=None, caption=None)
+        return True
+
+    def caption_for(self, user_id: int):
+        meta = self.meta(user_id)
+        if not meta:
+            return ""
+        return f"{meta['title']}\n\n{meta['caption']}".strip()
+
+    # ---- thumbnail ----
+    def thumb_path(self, user_id: int):
+        return os.path.join(self.thumbs_dir, f"{user_id}.jpg")
+
+    def has_thumb(self, user_id: int):
+        return bool(self.get(user_id)["thumb_file_id"]) or os.path.exists(self.thumb_path(user_id))
+
+    def set_thumb(self, user_id: int, jpeg_path: str, file_id: str = None):
+        """Take over an already converted jpeg as the user's thumbnail."""
+        os.replace(jpeg_path, self.thumb_path(user_id))
+        self._thumbs.pop(user_id, None)
+        self.update(user_id, thumb_file_id=file_id)
+
+    def clear_thumb(self, user_id: int):
+        """Returns False if there was no thumbnail."""
+        had = self.has_thumb(user_id)
+        self._thumbs.pop(user_id, None)
+        try:
+            os.remove(self.thumb_path(user_id))
+        except OSError:
+            pass
+        if had:
+            self.update(user_id, thumb_file_id=None)
+        return had
+
+    def thumb_bytes(self, user_id: int):
+        """The converted thumbnail's bytes (cached), or None if unset / the file is missing."""
+        if user_id in self._thumbs:
+            self._thumbs.move_to_end(user_id)
+            return self._thumbs[user_id]
+        data = None
+        if self.has_thumb(user_id):
+            try:
+                with open(self.thumb_path(user_id), "rb") as f:
+                    data = f.read()
+            except OSError:
+                data = None
+        self._thumbs[user_id] = data
+        if len(self._thumbs) > THUMB_CACHE_SIZE:
+            self._thumbs.popitem(last=False)
+        return data
@@ -0,0 +1,179 @@
+"""
+Stream Telegram media straight into ffmpeg through named FIFOs.
+
+Instead of downloading an input to data/tmp and then letting ffmpeg read it,
+a MediaFeed creates a FIFO, hands its path to ffmpeg as an input and pumps
+`client.stream_media(msg)` chunks into it while ffmpeg is running. Transfer
+and encoding overlap and nothing touches the disk.
+
+Only inputs ffmpeg reads front-to-back can be fed this way (mp3, ogg/opus,
+wav, flac, adts aac ...). mp4/m4a may need to seek to the moov atom, so those
+keep using the normal download.
+
+The FIFO is opened and written non-blocking from the event loop, so no
+executor thread ever waits on ffmpeg. Every feed holds one of pyrogram's
+transmission slots (get_file_semaphore) for its whole stream. A run's feeds
+must all get one at once, or ffmpeg waits on an input that never starts, so
+StreamBudget hands them out all-or-nothing and runs stream at most
+StreamBudget.total inputs.
+"""
+
+import asyncio
+import contextlib
+import errno
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+# containers ffmpeg can demux from a non-seekable pipe
+STREAMABLE_MIMES = {
+    "audio/mpeg", "audio/mp3", "audio/ogg", "audio/opus", "audio/x-opus+ogg",
+    "audio/wav", "audio/x-wav", "audio/flac", "audio/x-flac", "audio/aac",
+    "audio/x-matroska", "video/x-matroska", "video/webm", "video/mp2t",
+}
+
+
+def media_of(msg):
+    """The downloadable media object of a message (or None)."""
+    return msg.audio or msg.voice or msg.video or msg.document
+
+
+def mime_of(msg):
+    return (getattr(media_of(msg), "mime_type", None) or "").lower()
+
+
+def is_streamable(msg):
+    """True when msg's media can be read by ffmpeg sequentially from a pipe."""
+    if not hasattr(os, "mkfifo"):
+        return False
+    return mime_of(msg) in STREAMABLE_MIMES
+
+
+FIFO_POLL = 0.05  # seconds between tries to open the FIFO before ffmpeg has
+FINISH_GRACE = 2  # seconds finish() lets a pump end on its own after ffmpeg exited
+
+
+async def _writable(fd: int):
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    loop.add_writer(fd, lambda: ready.done() or ready.set_result(None))
+    try:
+        await ready
+    finally:
+        loop.remove_writer(fd)
+
+
+async def _write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        try:
+            n = os.write(fd, view)
+        except BlockingIOError:
+            await _writable(fd)
+            continue
+        view = view[n:]
+
+
+class StreamBudget:
+    """
+    Transmission slots for streamed runs. reserve(n) waits until n slots are
+    free and takes them together, so two runs can never each hold part of
+    what they need. The client's max_concurrent_transmissions must be at
+    least `total`.
+    """
+
+    def __init__(self, total: int):
+        self.total = max(1, total)
+        self.used = 0
+        self._cond = None
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, n: int):
+        n = min(n, self.total)
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.total - self.used >= n)
+            self.used += n
+        try:
+            yield
+        finally:
+            self.used -= n
+            async with self._cond:
+                self._cond.notify_all()
+
+
+class MediaFeed:
+    """
+    One Telegram message -> one FIFO. Call start() before launching ffmpeg
+    with `path` as an input, and finish() once ffmpeg has exited.
+    """
+
+    def __init__(self, client, msg, path: str):
+        self.client = client
+        self.msg = msg
+        self.path = path
+        self.bytes = 0
+        self.error = None
+        self._opened = False
+        self._task = None
+
+    def start(self):
+        os.mkfifo(self.path)
+        self._task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        # a non-blocking open of the write end fails (ENXIO) until ffmpeg has
+        # the read end open; poll instead of parking a thread in open()
+        while True:
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    self.error = e
+                    return
+            await asyncio.sleep(FIFO_POLL)
+        self._opened = True
+        try:
+            async for chunk in self.client.stream_media(self.msg):
+                await _write_all(fd, chunk)
+                self.bytes += len(chunk)
+        except BrokenPipeError:
+            # ffmpeg stopped reading (-shortest, error, ...); not our failure
+            pass
+        except Exception as e:
+            self.error = e
+            log.warning("stream feed %s failed: %s", self.path, e)
+        finally:
+            os.close(fd)
+
+    async def finish(self, grace: float = FINISH_GRACE):
+        """
+        Call once ffmpeg has exited: stop the pump and remove the FIFO.
+        Returns True if the media was streamed without error.
+        """
+        if self._task is None:
+            return False
+        if not self._opened:
+            # ffmpeg exited without opening the FIFO: nothing will ever read it
+            self._task.cancel()
+            self.error = self.error or RuntimeError("ffmpeg never opened the stream")
+        else:
+            # ffmpeg stopped reading; the next write would fail with a broken
+            # pipe, but the pump may be waiting on Telegram for that chunk
+            await asyncio.wait({self._task}, timeout=grace)
+            self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            if not self._task.cancelled():
+                raise
+        except Exception as e:
+            self.error = self.error or e
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        return self.error is None
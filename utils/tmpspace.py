@@ -0,0 +1,185 @@
+"""
+Temp-space manager for data/tmp.
+
+Tracks how many bytes are on disk (from a periodic scan done in a worker
+thread, never on the event loop) plus how many bytes in-flight jobs have
+reserved but not written yet. New work must reserve() its expected size
+first; if that would exceed the quota or eat into the disk's last
+`min_free_bytes`, the manager tries a cleanup and otherwise makes the caller
+wait (up to `wait` seconds) before refusing with TempSpaceError.
+
+Cleanup removes files older than `max_age`, then the oldest files until usage
+is back under the quota. Paths returned by the `in_use` callback (pending
+sessions, queued/running jobs) are never touched.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TempSpaceError(Exception):
+    pass
+
+
+class Reservation:
+    def __init__(self, manager, nbytes: int):
+        self.manager = manager
+        self.nbytes = nbytes
+        self.released = False
+
+    def release(self, written=False):
+        """
+        Give the space back. written=True when the bytes now sit on disk (e.g. a
+        finished download), or how many of them do when that's less than reserved.
+        """
+        if not self.released:
+            self.released = True
+            self.manager._release(self.nbytes, written)
+
+
+class TempSpaceManager:
+    def __init__(self, folder: str, quota_bytes: int, min_free_bytes: int = 0,
+                 max_age: int = 3600, in_use=None):
+        self.folder = folder
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.max_age = max_age
+        self.in_use = in_use or (lambda: set())
+        self.used = 0  # bytes on disk at the last scan (+ released reservations since)
+        self.reserved = 0
+        self.evicted_files = 0
+        self._changed = None
+        self._cleanup_lock = None
+        self._scanned = False
+
+    def _event(self):
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    def _scan(self):
+        files = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        files.append((entry.path, st.st_size, st.st_mtime))
+                except OSError:
+                    pass
+        return files
+
+    def _evict(self, files, protected, need):
+        """Runs in a worker thread. Returns (bytes left, bytes freed)."""
+        now = time.time()
+        used = sum(size for _, size, _ in files)
+        freed = 0
+        keep = []
+        for path, size, mtime in sorted(files, key=lambda f: f[2]):
+            if os.path.abspath(path) in protected:
+                continue
+            if now - mtime > self.max_age:
+                if self._remove(path):
+                    used -= size
+                    freed += size
+            else:
+                keep.append((path, size))
+        # still over quota: drop the oldest unprotected files
+        for path, size in keep:
+            if used + self.reserved + need <= self.quota_bytes:
+                break
+            if self._remove(path):
+                used -= size
+                freed += size
+        return used, freed
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            self.evicted_files += 1
+            return True
+        except OSError:
+            return False
+
+    async def cleanup(self, need: int = 0):
+        """Scan + evict off the event loop, making room for `need` more bytes. Returns bytes freed."""
+        if self._cleanup_lock is None:
+            self._cleanup_lock = asyncio.Lock()
+        async with self._cleanup_lock:
+            loop = asyncio.get_running_loop()
+            protected = {os.path.abspath(p) for p in self.in_use() if p}
+            files = await loop.run_in_executor(None, self._scan)
+            self.used, freed = await loop.run_in_executor(None, self._evict, files, protected, need)
+            self._scanned = True
+            if freed:
+                log.info("tmp cleanup freed %d bytes, %d bytes in use", freed, self.used)
+                self._event().set()
+            return freed
+
+    def disk_free(self):
+        try:
+            return shutil.disk_usage(self.folder).free
+        except OSError:
+            return 0
+
+    def _fits(self, nbytes: int):
+        if self.used + self.reserved + nbytes > self.quota_bytes:
+            return False
+        return self.disk_free() - self.reserved - nbytes >= self.min_free_bytes
+
+    async def reserve(self, nbytes: int, wait: float = 120):
+        """
+        Reserve nbytes of temp space. Waits up to `wait` seconds for space to
+        free up; raises TempSpaceError if it doesn't (or can never fit).
+        """
+        nbytes = max(0, int(nbytes))
+        if nbytes > self.quota_bytes:
+            raise TempSpaceError(f"job needs {nbytes} bytes, quota is {self.quota_bytes}")
+        deadline = time.monotonic() + wait
+        if not self._scanned:
+            await self.cleanup(nbytes)
+        while not self._fits(nbytes):
+            # rescan: finished jobs delete their files without telling us
+            await self.cleanup(nbytes)
+            if self._fits(nbytes):
+                break
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise TempSpaceError("not enough temp space")
+            ev = self._event()
+            ev.clear()
+            try:
+                await asyncio.wait_for(ev.wait(), timeout=min(left, 10))
+            except asyncio.TimeoutError:
+                pass
+        self.reserved += nbytes
+        return Reservation(self, nbytes)
+
+    def _release(self, nbytes: int, written: bool):
+        self.reserved = max(0, self.reserved - nbytes)
+        if written:
+            # counted as used until the next scan sees the real file
+            self.used += nbytes if written is True else min(int(written), nbytes)
+        self._event().set()
+
+    async def run_forever(self, interval: float = 60):
+        while True:
+            try:
+                await self.cleanup()
+            except Exception:
+                log.exception("tmp cleanup failed")
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return {
+            "used": self.used,
+            "reserved": self.reserved,
+            "quota": self.quota_bytes,
+            "disk_free": self.disk_free(),
+            "evicted_files": self.evicted_files,
+        }